@@ -0,0 +1,84 @@
+"""Construction check of the processing engine against a real Sentinel 2 / Sentinel 3 product pair.
+
+The engine is constructed from the given products, which parses their metadata, and its processing graph is
+built without running any step. The check fails if the metadata the steps depend on is missing, if a step reads
+or writes a product without a path, or if the graph has a product produced twice or cyclic dependencies. The
+parsed metadata, the product paths and the steps with their dependencies are printed.
+"""
+import sys
+import shutil
+import argparse
+import tempfile
+
+from senet.engine import senet, _dependencies
+
+# Metadata read by the steps of the engine
+S2_METADATA = ["satellite", "datetime", "str_datetime", "processing_level", "tile_id", "crs"]
+S3_METADATA = ["satellite", "datetime", "str_datetime", "processing_level", "type", "md_file", "crs"]
+
+
+def check_engine(engine:senet):
+    """Checks the metadata and the processing graph of an engine.
+
+    Args:
+        engine (senet): Constructed engine
+
+    Returns:
+        list: Problems found, empty if there are none
+    """
+    problems = []
+    for label, image, attributes in [("Sentinel 2", engine.s2, S2_METADATA), ("Sentinel 3", engine.s3, S3_METADATA)]:
+        for attribute in attributes:
+            value = getattr(image, attribute)
+            print("{} {:<17s}{}".format(label, attribute, value))
+            if value is None:
+                problems.append("{} metadata {} was not parsed".format(label, attribute))
+
+    steps = engine.steps()
+    for s in steps:
+        for key in s.inputs + s.outputs:
+            if key not in engine.paths:
+                problems.append("Step {} uses product {} that has no path".format(s.name, key))
+    try:
+        dependencies = _dependencies(steps)
+    except ValueError as e:
+        problems.append(str(e))
+        return problems
+
+    print("Products:")
+    for key, path in engine.paths.items():
+        print("  {:<20s}{}".format(key, path))
+    print("Steps:")
+    for s in steps:
+        print("  {:<24s}{:<9s}after {}".format(s.name, s.resource, ", ".join(sorted(dependencies[s.name])) or "-"))
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("s2path", help="Path to the Sentinel 2 L2A product (.SAFE)")
+    parser.add_argument("s3path", help="Path to the Sentinel 3 SLSTR L2 LST product (.SEN3)")
+    parser.add_argument("--aoi", default="POLYGON((10.5 36.5, 11.2 36.5, 11.2 37.1, 10.5 37.1, 10.5 36.5))",
+                        help="Area of interest as WKT geometry in WGS 84")
+    parser.add_argument("--gpt", default="gpt", help="Path to SNAP GPT, which is not run")
+    parser.add_argument("--output-folder", default=None, help="Output folder. Defaults to a temporary folder")
+    parser.add_argument("--fused", action="store_true", help="Check the graph of the fused pipeline")
+    options = parser.parse_args()
+
+    output_folder = options.output_folder or tempfile.mkdtemp()
+    try:
+        engine = senet(options.s2path, options.s3path, options.aoi, options.gpt, output_folder, fused=options.fused)
+        problems = check_engine(engine)
+    finally:
+        if options.output_folder is None:
+            shutil.rmtree(output_folder, ignore_errors=True)
+
+    for problem in problems:
+        print("FAIL: {}".format(problem))
+    if not problems:
+        print("OK: engine constructed from {} and {}".format(engine.s2.name, engine.s3.name))
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
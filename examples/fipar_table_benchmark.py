@@ -0,0 +1,63 @@
+"""Speed and accuracy benchmark of the calc_F_theta_campbell table against the exact pyTSEB function.
+
+The table is built (or loaded from --cache-file) and evaluated on random sun zenith angles within a narrow
+range, as in a single scene, and effective LAI. The script reports the build or load time, the accuracy bound
+of the table, the largest error measured on the random pixels and the evaluation time of both methods. It
+also runs the fraction of green vegetation with and without the table and reports the largest difference.
+"""
+import sys
+import time
+import argparse
+import numpy as np
+from pyTSEB import TSEB
+from senet.core.fipar_table import fipar_table
+from senet.core.frac_green import converge_fraction_green
+
+
+def best_time(function, repeat):
+    """Fastest of repeat runs of function [s]."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--pixels", type=int, default=2000000, help="Number of random pixels")
+    parser.add_argument("--sza", type=float, default=30., help="Lowest sun zenith angle of the pixels [degrees]")
+    parser.add_argument("--sza-range", type=float, default=1.5, help="Range of the sun zenith angle of the pixels [degrees]")
+    parser.add_argument("--cache-file", default=None, help="Table cache file")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of measurements, the fastest is reported")
+    options = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    sza = (options.sza + options.sza_range * rng.random(options.pixels)).astype(np.float32)
+    lai = (8 * rng.random(options.pixels)).astype(np.float32)
+    fapar = (0.95 * rng.random(options.pixels)).astype(np.float32)
+
+    start = time.perf_counter()
+    table = fipar_table(cache_file=options.cache_file)
+    print("Table built or loaded in {:.3f} s, {:.1f} MB".format(time.perf_counter() - start, table.corners.nbytes / 1e6))
+    print("Accuracy bound of the table: {:.2e}".format(table.max_error))
+
+    exact = TSEB.calc_F_theta_campbell(sza.astype(np.float64), lai.astype(np.float64), w_C=1, Omega0=1, x_LAD=1)
+    print("Largest error on the random pixels: {:.2e}".format(np.max(np.abs(table(sza, lai) - exact))))
+
+    exact_time = best_time(lambda: TSEB.calc_F_theta_campbell(sza, lai, w_C=1, Omega0=1, x_LAD=1), options.repeat)
+    table_time = best_time(lambda: table(sza, lai), options.repeat)
+    print("Exact: {:.4f} s, table: {:.4f} s, speedup {:.2f}x".format(exact_time, table_time, exact_time / table_time))
+
+    shape = (1, options.pixels)
+    f_g_exact, _ = converge_fraction_green(sza.reshape(shape), fapar.reshape(shape), lai.reshape(shape), 0.01)
+    f_g_table, _ = converge_fraction_green(sza.reshape(shape), fapar.reshape(shape), lai.reshape(shape), 0.01,
+                                           fipar_table=table)
+    print("Largest difference of the fraction of green vegetation: {:.2e}".format(
+        np.nanmax(np.abs(f_g_table - f_g_exact))))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
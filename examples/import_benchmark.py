@@ -0,0 +1,84 @@
+"""Import time benchmark for the senet modules.
+
+Every module is imported in a fresh interpreter. The script reports the import time and lists the
+heavy dependencies (snappy/JVM, GDAL, netCDF4, CDS API, pyTSEB, pyDMS, ...) that were loaded as a
+side effect of the import. These should only be loaded on first use. The exit code is non-zero if a
+module takes longer than the time budget to import or loads a heavy dependency.
+"""
+import sys
+import json
+import argparse
+import subprocess
+
+MODULES = [
+    "senet.sentinels",
+    "senet.get_creodias",
+    "senet.timezone",
+    "senet.core.snappy_utils",
+    "senet.core.dimap_utils",
+    "senet.core.packed_pixels",
+    "senet.core.static_layers",
+    "senet.core.sharpener_models",
+    "senet.core.gdal_utils",
+    "senet.core.graphs",
+    "senet.core.leaf_spectra",
+    "senet.core.fipar_table",
+    "senet.core.frac_green",
+    "senet.core.structural_params",
+    "senet.core.aerodynamic_roughness",
+    "senet.core.warp_to_template",
+    "senet.core.solar_geometry",
+    "senet.core.data_mining_sharpener",
+    "senet.core.ecmwf_utils",
+    "senet.core.ecmwf_data_download",
+    "senet.core.ecmwf_data_preparation",
+    "senet.core.longwave_irradiance",
+    "senet.core.net_shortwave_radiation",
+    "senet.core.surrogate",
+    "senet.core.energy_fluxes",
+    "senet.core.daily_evapotranspiration",
+    "senet.core.fused_pipeline",
+]
+
+HEAVY_DEPENDENCIES = ["snappy", "jpy", "gdal", "osgeo", "netCDF4", "cdsapi", "pyTSEB", "pyDMS", "sklearn",
+                      "pandas", "geopandas", "pyproj", "sentinelsat", "creodias_finder", "timezonefinder"]
+
+PROBE = """
+import sys, time, json
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+heavy = [name for name in {heavy!r} if name in sys.modules]
+print(json.dumps({{"time": elapsed, "heavy": heavy}}))
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--budget", type=float, default=1.0, help="Maximum import time of a module in seconds")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of measurements, the fastest is reported")
+    options = parser.parse_args()
+
+    failed = False
+    for module in MODULES:
+        results = []
+        for _ in range(options.repeat):
+            run = subprocess.run([sys.executable, "-c", PROBE.format(module=module, heavy=HEAVY_DEPENDENCIES)],
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+            if run.returncode != 0:
+                results = None
+                break
+            results.append(json.loads(run.stdout.strip().splitlines()[-1]))
+        if results is None:
+            print("{:<42s} import failed: {}".format(module, run.stderr.strip().splitlines()[-1]))
+            failed = True
+            continue
+        best = min(results, key=lambda r: r["time"])
+        status = "OK" if best["time"] <= options.budget and not best["heavy"] else "FAIL"
+        failed = failed or status == "FAIL"
+        print("{:<42s}{:>8.3f} s  {:<4s} {}".format(module, best["time"], status, ", ".join(best["heavy"])))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,168 @@
+"""Peak memory (RSS) regression check for the core processing stages.
+
+Every measurement runs in a fresh process so that its peak resident set size is not hidden by earlier
+measurements. The products of an already processed scene are used as inputs and the outputs are written
+to a scratch folder.
+
+For every stage, the bands of its input products are first read twice, side by side: as before the reads
+took a data type (every band read into a float64 array and converted to float32) and with the float32 read
+path. The check fails if the float32 path does not have the lower peak RSS. Then the stage itself runs,
+unless --read-only is given. Run with --save to store the stage measurements as the new baseline, or without
+it to compare against a stored baseline and fail if a stage grew by more than the given tolerance. With
+--block-size the stages run block by block, which bounds their peak memory by the block size.
+"""
+import os
+import sys
+import json
+import argparse
+import resource
+import tempfile
+import importlib
+import multiprocessing
+from datetime import datetime
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "memory_baseline.json")
+
+# Stages that can run block by block
+BLOCK_STAGES = ["leaf_spectra", "fraction_green", "str_parameters", "aerodynamic_roughness", "longwave_irradiance",
+                "net_shortwave_radiation", "energy_fluxes", "daily_evapotranspiration"]
+
+
+def stages(options, output_folder):
+    """Stage name, function and arguments of every measured core stage."""
+    s2 = lambda suffix: os.path.join(options.s2_folder, "{}_{}.dim".format(options.prefix, suffix))
+    s3 = lambda name: os.path.join(options.s3_folder, name + ".dim")
+    out = lambda name: os.path.join(output_folder, name + ".dim")
+    return {
+        "leaf_spectra": ("senet.core.leaf_spectra", "leaf_spectra",
+                         [s2("BIO"), out("LEAF-REFL-TRAN")]),
+        "fraction_green": ("senet.core.frac_green", "fraction_green",
+                           [s2("SUN-ZEN-ANG"), s2("BIO"), 0.01, out("FV")]),
+        "str_parameters": ("senet.core.structural_params", "str_parameters",
+                           [s2("LC"), s2("BIO"), s2("FV"), "land_cover_CCILandCover-2015",
+                            True, True, True, True, True, True, out("STR-PARAM")]),
+        "aerodynamic_roughness": ("senet.core.aerodynamic_roughness", "aerodynamic_roughness",
+                                  [s2("BIO"), s2("STR-PARAM"), out("AERO-ROUGH")]),
+        "longwave_irradiance": ("senet.core.longwave_irradiance", "longwave_irradiance",
+                                [options.meteo, out("LONG_IRRAD")]),
+        "net_shortwave_radiation": ("senet.core.net_shortwave_radiation", "net_shortwave_radiation",
+                                    [s2("LEAF-REFL-TRAN"), s2("BIO"), s2("STR-PARAM"), options.meteo,
+                                     s3("LST_OBS-GEOM-REPROJ"), out("NET-RAD")]),
+        "sharpen": ("senet.core.data_mining_sharpener", "sharpen",
+                    [s2("REFL"), s3("LST_data"), s2("ELEV"), s3("LST_OBS-GEOM-REPROJ"), s3("LST_MASK"),
+                     options.datetime, out("LST_SHARP")]),
+        "energy_fluxes": ("senet.core.energy_fluxes", "energy_fluxes",
+                          [s3("LST_SHARP"), s3("LST_OBS-GEOM-REPROJ"), s2("BIO"), s2("STR-PARAM"), s2("FV"),
+                           s2("AERO-ROUGH"), options.meteo, s2("NET-RAD"), options.longwave_irradiance, s2("MASK"),
+                           out("EN-FLUX")]),
+        "daily_evapotranspiration": ("senet.core.daily_evapotranspiration", "daily_evapotranspiration",
+                                     [s2("EN-FLUX"), options.meteo, out("EVAP")]),
+    }
+
+
+def run_stage(module, function, args, kwargs):
+    """Runs one stage and returns the peak RSS of the process in MB."""
+    getattr(importlib.import_module(module), function)(*args, **kwargs)
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def read_inputs(products, legacy):
+    """Reads all bands of the products as float32 arrays and returns the peak RSS of the process in MB.
+
+    With legacy, every band is read into a float64 array and converted to float32 afterwards, as the stages did
+    before read_snappy_product took a data type. Otherwise the bands are read directly into float32 arrays.
+    """
+    import numpy as np
+    import senet.core.snappy_utils as su
+
+    bands = []
+    for file_path in products:
+        band_names = [band['band_name'] for band in su.get_bands_info(file_path)]
+        if legacy:
+            bands.extend(su.read_snappy_product(file_path, band_name, dtype=np.float64)[0].astype(np.float32)
+                         for band_name in band_names)
+        else:
+            bands.extend(su.read_snappy_bands(file_path, band_names)[0])
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def in_fresh_process(context, function, *args):
+    """Runs function in a new worker process and returns its result."""
+    with context.Pool(1, maxtasksperchild=1) as pool:
+        return pool.apply(function, args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--s2-folder", required=True, help="Folder of the processed Sentinel 2 products (.SAFE)")
+    parser.add_argument("--prefix", required=True, help="Prefix of the Sentinel 2 product names, e.g. 32SPF_20220808T095559")
+    parser.add_argument("--s3-folder", required=True, help="Folder of the processed Sentinel 3 products (.SEN3)")
+    parser.add_argument("--meteo", required=True, help="Path to the meteorological product (from prepare)")
+    parser.add_argument("--longwave-irradiance", required=True, help="Path to the longwave irradiance product")
+    parser.add_argument("--datetime", type=lambda s: datetime.strptime(s, "%Y-%m-%dT%H:%M"), default=None,
+                        help="Sentinel 3 acquisition time (UTC) as YYYY-MM-DDTHH:MM, required by sharpen")
+    parser.add_argument("--stages", nargs="+", default=None, help="Stages to measure. Defaults to all stages")
+    parser.add_argument("--read-only", action="store_true", help="Only compare the read paths, without running the stages")
+    parser.add_argument("--save", action="store_true", help="Store the stage measurements as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.05, help="Allowed relative growth of peak RSS")
+    parser.add_argument("--baseline", default=BASELINE, help="Path to the baseline JSON file")
+    parser.add_argument("--block-size", type=int, default=None, help="Run the per-pixel stages in blocks of this size")
+    options = parser.parse_args()
+
+    output_folder = tempfile.mkdtemp()
+    all_stages = stages(options, output_folder)
+    names = options.stages or list(all_stages)
+    for name in names:
+        if name not in all_stages:
+            parser.error("Unknown stage {}, must be one of {}".format(name, list(all_stages)))
+    if "sharpen" in names and options.datetime is None and not options.read_only:
+        parser.error("--datetime is required to run sharpen")
+    # A new worker for every measurement, so that each one starts from a clean process
+    context = multiprocessing.get_context("spawn")
+    failed = False
+
+    print("{:<28s}{:>14s}{:>14s}".format("Inputs read of", "float64 path", "float32 path"))
+    for name in names:
+        module, function, args = all_stages[name]
+        products = [a for a in args if isinstance(a, str) and a.endswith(".dim") and os.path.exists(a)]
+        legacy = in_fresh_process(context, read_inputs, products, True)
+        current = in_fresh_process(context, read_inputs, products, False)
+        status = "OK" if current < legacy else "FAIL"
+        failed = failed or status == "FAIL"
+        print("{:<28s}{:>11.1f} MB{:>11.1f} MB ({:+.1%}) {}".format(name, legacy, current, (current - legacy) / legacy,
+                                                                     status))
+    if options.read_only:
+        return 1 if failed else 0
+
+    results = {}
+    for name in names:
+        module, function, args = all_stages[name]
+        kwargs = {"block_size": options.block_size} if options.block_size and name in BLOCK_STAGES else {}
+        results[name] = in_fresh_process(context, run_stage, module, function, args, kwargs)
+        print("{:<28s}{:>10.1f} MB".format(name, results[name]))
+
+    if options.save:
+        with open(options.baseline, "w") as fp:
+            json.dump(results, fp, indent=4)
+        print("Baseline saved to {}".format(options.baseline))
+        return 1 if failed else 0
+
+    if not os.path.exists(options.baseline):
+        print("No baseline found at {}. Run with --save to store one.".format(options.baseline))
+        return 1 if failed else 0
+
+    with open(options.baseline) as fp:
+        baseline = json.load(fp)
+    for name, peak in results.items():
+        if name not in baseline:
+            continue
+        change = (peak - baseline[name]) / baseline[name]
+        status = "OK" if change <= options.tolerance else "FAIL"
+        failed = failed or status == "FAIL"
+        print("{:<28s}{:>10.1f} MB -> {:>10.1f} MB ({:+.1%}) {}".format(name, baseline[name], peak, change, status))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
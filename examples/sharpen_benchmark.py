@@ -0,0 +1,150 @@
+"""Peak memory (RSS) and timing of the sharpener with the float32 feature cube against the former VRT stack.
+
+Before the feature cube, sharpen saved cos theta to a GeoTIFF and stacked it with the reflectance and DEM
+products through a chain of VRTs (merge_raster_layers), which pyDMS then decoded again for training and again
+for application. Both ways of stacking the high-resolution predictors are run on the same scene, each in a
+fresh process, followed by the training, the application and the residual analysis of the sharpener. The
+script reports the peak RSS of each process, the time of every step and the residual RMSE of both runs.
+"""
+import sys
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import multiprocessing
+import os.path as pth
+from datetime import datetime
+
+METHODS = ["vrt", "cube"]
+
+
+def high_res_stack(method, sentinel_2_reflectance, temp_dem_file, cos_theta, temp_dir):
+    """Stacks the reflectance, DEM and cos theta into one raster readable by GDAL.
+
+    Returns:
+        str: Path to the stacked raster
+        gu.feature_cube: Feature cube, None for the VRT stack
+    """
+    import senet.core.gdal_utils as gu
+
+    temp_refl_file = gu.product_to_gdal(sentinel_2_reflectance)
+    if method == "vrt":
+        proj, gt = gu.raster_info(temp_dem_file)[0:2]
+        temp_cos_theta_file = pth.join(temp_dir, 'cos_theta.tif')
+        gu.save_image(cos_theta, gt, proj, temp_cos_theta_file)
+        vrt_filename = pth.join(temp_dir, 'high_res.vrt')
+        gu.merge_raster_layers([temp_refl_file, temp_dem_file, temp_cos_theta_file], vrt_filename, separate=True)
+        return vrt_filename, None
+    proj, gt, _, _, _, n_refl_bands = gu.raster_info(temp_refl_file)[0:6]
+    height, width = cos_theta.shape
+    cube = gu.feature_cube(width, height, proj, gt, n_refl_bands + 2, temp_dir=temp_dir)
+    cube.append_raster(temp_refl_file)
+    cube.append_raster(temp_dem_file)
+    cube.append('cos_theta', cos_theta)
+    return cube.to_vrt(), cube
+
+
+def run_sharpener(method, options):
+    """Sharpens the scene with one way of stacking the predictors.
+
+    Returns:
+        dict: Peak RSS of the process [MB], time of every step [s] and residual RMSE [K]
+    """
+    import senet.core.gdal_utils as gu
+    import senet.core.snappy_utils as su
+    from senet.core.sharpener_models import residual_rmse
+    from senet.core.solar_geometry import incidence_angle, terrain_terms
+    gu._gdal()
+    from pyDMS.pyDMS import DecisionTreeSharpener
+
+    temp_dir = tempfile.mkdtemp()
+    result = {}
+    start = time.perf_counter()
+    temp_dem_file = gu.product_to_gdal(options.dem, [options.elevation_band])
+    slope = gu.raster_data(gu.slope_from_dem(temp_dem_file, pth.join(temp_dir, 'slope.tif')))
+    aspect = gu.raster_data(gu.aspect_from_dem(temp_dem_file, pth.join(temp_dir, 'aspect.tif')))
+    try:
+        lat, lon = su.read_snappy_bands(options.geometry, ['latitude_tx', 'longitude_tx'])[0]
+    except RuntimeError:
+        lat, lon = su.read_snappy_bands(options.geometry, ['latitude_in', 'longitude_in'])[0]
+    doy = options.datetime.timetuple().tm_yday
+    ftime = options.datetime.hour + options.datetime.minute/60.0
+    cos_theta = incidence_angle(lat, lon, doy, ftime, stdlon=0, terrain=terrain_terms(slope, aspect))
+    slope = aspect = lat = lon = None
+    result["illumination"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    high_res_filename, cube = high_res_stack(method, options.reflectance, temp_dem_file, cos_theta, temp_dir)
+    cos_theta = None
+    result["stack"] = time.perf_counter() - start
+
+    temp_lst_file = gu.product_to_gdal(options.lst, ["LST"])
+    temp_mask_file = gu.product_to_gdal(options.mask)
+    flags = [int(i) for i in options.good_quality_flags.split(",")]
+    disaggregator = DecisionTreeSharpener(
+        highResFiles=[high_res_filename], lowResFiles=[temp_lst_file], lowResQualityFiles=[temp_mask_file],
+        lowResGoodQualityFlags=flags, cvHomogeneityThreshold=0., movingWindowSize=options.moving_window_size,
+        disaggregatingTemperature=True,
+        baggingRegressorOpt={"n_jobs": options.parallel_jobs, "n_estimators": 30, "max_samples": 0.8,
+                             "max_features": 0.8})
+    start = time.perf_counter()
+    disaggregator.trainSharpener()
+    result["train"] = time.perf_counter() - start
+    start = time.perf_counter()
+    downscaled_file = disaggregator.applySharpener(high_res_filename, temp_lst_file)
+    result["apply"] = time.perf_counter() - start
+    start = time.perf_counter()
+    residual_image, _ = disaggregator.residualAnalysis(downscaled_file, temp_lst_file, temp_mask_file,
+                                                       doCorrection=True)
+    result["residual"] = time.perf_counter() - start
+    result["rmse"] = residual_rmse(residual_image.GetRasterBand(1).ReadAsArray(), gu.raster_data(temp_mask_file), flags)
+    # ru_maxrss is in kilobytes on Linux
+    result["peak"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+    if cube is not None:
+        cube.remove()
+    for temp_path in [temp_dem_file, temp_lst_file, temp_mask_file]:
+        gu.remove_gdal_file(temp_path)
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--reflectance", required=True, help="Path to the Sentinel 2 reflectance product")
+    parser.add_argument("--lst", required=True, help="Path to the Sentinel 3 LST product")
+    parser.add_argument("--dem", required=True, help="Path to the high resolution DEM product")
+    parser.add_argument("--geometry", required=True, help="Path to the high resolution S3 observation geometry product")
+    parser.add_argument("--mask", required=True, help="Path to the LST quality mask product")
+    parser.add_argument("--datetime", required=True, type=lambda s: datetime.strptime(s, "%Y-%m-%dT%H:%M"),
+                        help="Sentinel 3 acquisition time (UTC) as YYYY-MM-DDTHH:MM")
+    parser.add_argument("--elevation-band", default="elevation", help="Name of the elevation band")
+    parser.add_argument("--good-quality-flags", default="1", help="Good quality mask values")
+    parser.add_argument("--moving-window-size", type=int, default=30, help="Moving window size")
+    parser.add_argument("--parallel-jobs", type=int, default=1, help="Parallel jobs of the regressor")
+    options = parser.parse_args()
+
+    # A new worker for every method, so that each peak RSS starts from a clean process
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    for method in METHODS:
+        with context.Pool(1, maxtasksperchild=1) as pool:
+            results[method] = pool.apply(run_sharpener, (method, options))
+
+    steps = ["illumination", "stack", "train", "apply", "residual"]
+    print("{:<14s}".format("") + "".join("{:>14s}".format(method) for method in METHODS))
+    print("{:<14s}".format("peak RSS") + "".join("{:>11.1f} MB".format(results[m]["peak"]) for m in METHODS))
+    for step in steps:
+        print("{:<14s}".format(step) + "".join("{:>12.2f} s".format(results[m][step]) for m in METHODS))
+    print("{:<14s}".format("total") + "".join("{:>12.2f} s".format(sum(results[m][s] for s in steps)) for m in METHODS))
+    print("{:<14s}".format("residual RMSE") + "".join("{:>12.3f} K".format(results[m]["rmse"]) for m in METHODS))
+    vrt, cube = results["vrt"], results["cube"]
+    print("Feature cube against the VRT stack: peak RSS {:+.1%}, stack, train and apply time {:+.1%}".format(
+        (cube["peak"] - vrt["peak"]) / vrt["peak"],
+        sum(cube[s] - vrt[s] for s in steps[1:4]) / sum(vrt[s] for s in steps[1:4])))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
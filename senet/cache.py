@@ -0,0 +1,268 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import inspect
+import threading
+
+# Size of the chunks files are read in while hashing
+_HASH_CHUNK_BYTES = 1 << 24
+
+
+def product_files(file_path:str):
+    """Lists the files making up a product.
+
+    Args:
+        file_path (str): Path to a file, a directory or a BEAM-DIMAP .dim header
+
+    Returns:
+        list: Paths of the file, of all files in the directory, or of the .dim header and the files in its .data directory
+    """
+    paths = [file_path]
+    if os.path.splitext(file_path)[1].lower() == ".dim":
+        paths.append(os.path.splitext(file_path)[0] + ".data")
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                files.extend(os.path.join(root, name) for name in sorted(names))
+        elif os.path.isfile(path):
+            files.append(path)
+    return files
+
+
+def _product_size(file_path:str):
+    return sum(os.path.getsize(f) for f in product_files(file_path))
+
+
+def _remove_product(file_path:str):
+    paths = [file_path]
+    if os.path.splitext(file_path)[1].lower() == ".dim":
+        paths.append(os.path.splitext(file_path)[0] + ".data")
+    for path in paths:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+
+def _link_or_copy(src:str, dst:str):
+    """Hard links a file, or copies it where the link fails (e.g. across filesystems)."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+    return dst
+
+
+def _link_product(src_file_path:str, dst_file_path:str):
+    src_paths = [src_file_path]
+    dst_paths = [dst_file_path]
+    if os.path.splitext(src_file_path)[1].lower() == ".dim":
+        src_paths.append(os.path.splitext(src_file_path)[0] + ".data")
+        dst_paths.append(os.path.splitext(dst_file_path)[0] + ".data")
+    for src, dst in zip(src_paths, dst_paths):
+        if os.path.isdir(src):
+            shutil.copytree(src, dst, copy_function=_link_or_copy)
+        elif os.path.exists(src):
+            _link_or_copy(src, dst)
+
+
+class step_cache():
+    """Content-addressed cache of the products written by the pipeline steps.
+
+    The key of a step is computed from the content of its input products, its parameters and the source
+    of the code it runs. When an artifact with the same key exists, its outputs are restored instead of
+    running the step. A change of an input therefore only reruns the steps that depend on it. Artifacts
+    are evicted in least recently used order when the cache grows beyond its size budget.
+
+    Artifacts are hard linked to the outputs when they are on the same filesystem, and copied otherwise, so
+    that storing and restoring large products does not write them again. A linked output shares its file with
+    the artifact, so the outputs of a step are removed before it runs and it writes new files instead of
+    rewriting the stored ones in place.
+    """
+
+    def __init__(self, cache_dir:str, max_bytes:int = 50 * 2**30):
+        """
+        Args:
+            cache_dir (str): Folder to store the artifacts
+            max_bytes (int, optional): Size budget of the stored artifacts in bytes. Defaults to 50 GiB
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.artifacts_dir = os.path.join(cache_dir, "artifacts")
+        if not os.path.exists(self.artifacts_dir):
+            os.makedirs(self.artifacts_dir)
+        self._lock = threading.Lock()
+        # File digests are memoized on (size, modification time) so that unchanged files are hashed only once
+        self._digests_path = os.path.join(cache_dir, "digests.json")
+        self._digests = {}
+        if os.path.exists(self._digests_path):
+            try:
+                with open(self._digests_path) as fp:
+                    self._digests = json.load(fp)
+            except ValueError:
+                self._digests = {}
+
+    def file_digest(self, file_path:str):
+        """SHA-256 digest of the content of a file."""
+        stat = os.stat(file_path)
+        signature = [stat.st_size, stat.st_mtime_ns]
+        path = os.path.abspath(file_path)
+        with self._lock:
+            entry = self._digests.get(path)
+        if entry is not None and entry[:2] == signature:
+            return entry[2]
+
+        digest = hashlib.sha256()
+        with open(file_path, "rb") as fp:
+            for chunk in iter(lambda: fp.read(_HASH_CHUNK_BYTES), b""):
+                digest.update(chunk)
+        digest = digest.hexdigest()
+        with self._lock:
+            self._digests[path] = signature + [digest]
+        return digest
+
+    def product_digest(self, file_path:str):
+        """SHA-256 digest of the content of all files of a product."""
+        files = product_files(file_path)
+        if not files:
+            raise FileNotFoundError(file_path + " does not exist")
+        base = os.path.dirname(os.path.abspath(file_path))
+        digest = hashlib.sha256()
+        for f in files:
+            digest.update(os.path.relpath(os.path.abspath(f), base).encode())
+            digest.update(self.file_digest(f).encode())
+        return digest.hexdigest()
+
+    def key(self, name:str, inputs:list, params:dict = None, code:list = None):
+        """Computes the cache key of a step.
+
+        Args:
+            name (str): Step name
+            inputs (list): Paths to the input products
+            params (dict, optional): Step parameters, which must be serializable to JSON or have a stable str. Defaults to None
+            code (list, optional): Functions, modules or paths of files whose source the step depends on. Defaults to None
+
+        Returns:
+            str: Hexadecimal key
+        """
+        digest = hashlib.sha256(name.encode())
+        for path in inputs:
+            digest.update(self.product_digest(path).encode())
+        digest.update(json.dumps(params or {}, sort_keys=True, default=str).encode())
+        for item in code or []:
+            source = item if isinstance(item, str) else inspect.getsourcefile(item)
+            digest.update(self.file_digest(source).encode())
+        return digest.hexdigest()
+
+    def restore(self, key:str, outputs:list):
+        """Restores the outputs of a step from its artifact.
+
+        Outputs that already exist with the stored content are left untouched.
+
+        Returns:
+            bool: True if the artifact exists and the outputs were restored
+        """
+        artifact_dir = os.path.join(self.artifacts_dir, key)
+        manifest_path = os.path.join(artifact_dir, "manifest.json")
+        try:
+            with open(manifest_path) as fp:
+                manifest = json.load(fp)
+        except (OSError, ValueError):
+            return False
+        if sorted(manifest["outputs"]) != sorted(os.path.basename(o) for o in outputs):
+            return False
+
+        for output in outputs:
+            digest = manifest["outputs"][os.path.basename(output)]
+            if product_files(output) and self.product_digest(output) == digest:
+                continue
+            _remove_product(output)
+            output_dir = os.path.dirname(output)
+            if output_dir and not os.path.exists(output_dir):
+                os.makedirs(output_dir)
+            _link_product(os.path.join(artifact_dir, os.path.basename(output)), output)
+        # The modification time of the manifest is the last access time used for eviction
+        os.utime(manifest_path)
+        return True
+
+    def store(self, key:str, name:str, outputs:list):
+        """Stores the outputs of a step as the artifact of the key and evicts old artifacts."""
+        artifact_dir = os.path.join(self.artifacts_dir, key)
+        if os.path.exists(artifact_dir):
+            return
+        # Link to a temporary folder first, so that a crash never leaves a partial artifact
+        temp_dir = os.path.join(self.cache_dir, "tmp-" + uuid.uuid4().hex)
+        os.makedirs(temp_dir)
+        try:
+            manifest = {"step": name, "created": time.time(), "outputs": {}}
+            for output in outputs:
+                manifest["outputs"][os.path.basename(output)] = self.product_digest(output)
+                _link_product(output, os.path.join(temp_dir, os.path.basename(output)))
+            manifest["size"] = sum(_product_size(os.path.join(temp_dir, os.path.basename(o))) for o in outputs)
+            with open(os.path.join(temp_dir, "manifest.json"), "w") as fp:
+                json.dump(manifest, fp, indent=4)
+            os.rename(temp_dir, artifact_dir)
+        except OSError:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            if not os.path.exists(artifact_dir):
+                raise
+        self.evict()
+
+    def evict(self):
+        """Removes the least recently used artifacts until the cache fits its size budget."""
+        with self._lock:
+            artifacts = []
+            for key in os.listdir(self.artifacts_dir):
+                manifest_path = os.path.join(self.artifacts_dir, key, "manifest.json")
+                try:
+                    with open(manifest_path) as fp:
+                        size = json.load(fp)["size"]
+                    artifacts.append((os.path.getmtime(manifest_path), size, key))
+                except (OSError, ValueError, KeyError):
+                    continue
+            total = sum(size for _, size, _ in artifacts)
+            for _, size, key in sorted(artifacts):
+                if total <= self.max_bytes:
+                    break
+                shutil.rmtree(os.path.join(self.artifacts_dir, key), ignore_errors=True)
+                total -= size
+
+    def save(self):
+        """Saves the memoized file digests."""
+        with self._lock:
+            temp_path = self._digests_path + "." + uuid.uuid4().hex
+            with open(temp_path, "w") as fp:
+                json.dump(self._digests, fp)
+            os.replace(temp_path, self._digests_path)
+
+    def run(self, name:str, function, inputs:list, outputs:list, params:dict = None, code:list = None):
+        """Runs a step unless its outputs can be restored from the cache.
+
+        Args:
+            name (str): Step name
+            function (callable): Function running the step
+            inputs (list): Paths to the input products
+            outputs (list): Paths to the output products
+            params (dict, optional): Step parameters. Defaults to None
+            code (list, optional): Functions, modules or paths of files whose source the step depends on. Defaults to None
+
+        Returns:
+            bool: True if the outputs were restored from the cache
+        """
+        key = self.key(name, inputs, params, code)
+        if self.restore(key, outputs):
+            print("INFO: Restored outputs of step {} from cache".format(name))
+            self.save()
+            return True
+        # Outputs may be linked to an artifact, which writing them in place would change
+        for output in outputs:
+            _remove_product(output)
+        function()
+        self.store(key, name, outputs)
+        self.save()
+        return False
@@ -1,8 +1,39 @@
 import numpy as np
-import pyTSEB.resistances as res
 import senet.core.snappy_utils as su
+from senet.core.packed_pixels import packed_pixels
 
-def aerodynamic_roughness(lai_map:str, landcover_params_map:str, output_file:str,soil_roughness:float = 0.01):
+def compute_aerodynamic_roughness(lai:np.array, height:np.array, height_width_ratio:np.array, fractional_cover:np.array,
+    classification:np.array, soil_roughness:float = 0.01):
+    """Estimates aerodynamic roughness length for momentum transport [m] and zero-plane displacement height [m].
+
+    Args:
+        lai (np.array): Leaf area index
+        height (np.array): Vegetation height [m]
+        height_width_ratio (np.array): Vegetation height to width ratio
+        fractional_cover (np.array): Vegetation fractional cover
+        classification (np.array): IGBP landcover classification
+        soil_roughness (float): Soil roughness in meters [m]. Range from (0, 1]. Defaults to 0.01
+
+    Returns:
+        dict: Band name and data of the roughness length and zero-plane displacement height
+    """
+    import pyTSEB.resistances as res
+
+    # Pixels with leaf area index, packed as bare soil pixels followed by vegetated pixels
+    pixels = packed_pixels(lai <= 0, lai > 0)
+    bare, veg = pixels.groups
+    z_OM = pixels.full()
+    d_0 = pixels.full()
+
+    z_OM[bare] = soil_roughness
+    d_0[bare] = 0
+
+    z_OM[veg], d_0[veg] = res.calc_roughness(*[pixels.pack(a, veg) for a in [lai, height, height_width_ratio,
+                                                                           classification, fractional_cover]])
+
+    return {'roughness_length': pixels.unpack(z_OM), 'zero_plane_displacement': pixels.unpack(d_0)}
+
+def aerodynamic_roughness(lai_map:str, landcover_params_map:str, output_file:str,soil_roughness:float = 0.01, block_size:int = None):
     """Estimates aerodynamic roughness length for momentum transport [m] and 
     zero-plane displacement height [m] based on the leaf area index (LAI) and the maps of
     vegetation structural parameters.
@@ -12,28 +43,14 @@ def aerodynamic_roughness(lai_map:str, landcover_params_map:str, output_file:str
         landcover_params_map (str, pathlike): Path to vegetation structural parameters product
         soil_roughness (float): Soil roughness in meters [m]. Range from (0, 1]. Defaults to 0.01
         output_file (str): Path to save the product
+        block_size (int, optional): Process the scene in blocks of block_size x block_size pixels to bound memory use. Defaults to the whole scene
     """
-    lai, geo_coding = su.read_snappy_product(lai_map, 'lai')
-    lai = lai.astype(np.float32)
-    height = su.read_snappy_product(landcover_params_map, 'veg_height')[0].astype(np.float32)
-    height_width_ratio = su.read_snappy_product(landcover_params_map, 'veg_height_width_ratio')[0].astype(np.float32)
-    fractional_cover = su.read_snappy_product(landcover_params_map, 'veg_fractional_cover')[0].astype(np.float32)
-    classification = su.read_snappy_product(landcover_params_map, 'igbp_classification')[0].astype(np.float32)
-    
-    z_OM = np.full(lai.shape, np.nan, np.float32)
-    d_0 = np.full(lai.shape, np.nan, np.float32)
-
-    i = lai <= 0
-    z_OM[i] = soil_roughness
-    d_0[i] = 0
-
-    i = lai > 0
-    z_OM[i], d_0[i] = res.calc_roughness(lai[i], height[i], height_width_ratio[i],
-                                         classification[i], fractional_cover[i])
-    
-    band_data = [
-            {'band_name': 'roughness_length', 'band_data': z_OM},
-            {'band_name': 'zero_plane_displacement', 'band_data': d_0}
-    ]
-
-    su.write_snappy_product(output_file, band_data, 'aerodynamicRoughness', geo_coding)
+    def compute(bands):
+        [lai], [height, height_width_ratio, fractional_cover, classification] = bands
+        return {'aerodynamicRoughness': compute_aerodynamic_roughness(lai, height, height_width_ratio, fractional_cover,
+                                                                      classification, soil_roughness)}
+
+    su.map_blocks([(lai_map, ['lai']),
+                   (landcover_params_map, ['veg_height', 'veg_height_width_ratio', 'veg_fractional_cover',
+                                           'igbp_classification'])],
+                  compute, {'aerodynamicRoughness': (output_file, 'aerodynamicRoughness')}, block_size)
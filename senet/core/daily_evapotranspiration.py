@@ -1,28 +1,36 @@
 import numpy as np
-from pyTSEB import meteo_utils as met
 
 import senet.core.snappy_utils as su
 
-def daily_evapotranspiration(ief_file:str, mi_file:str, output_file:str):
+def compute_daily_evapotranspiration(le:np.array, sdn:np.array, sdn_24:np.array):
+    """Estimates daily evapotranspiration by extrapolating instantaneous latent heat flux using daily solar irradiance.
+
+    Args:
+        le (np.array): Instantaneous latent heat flux [W/m^{2}]
+        sdn (np.array): Instantaneous clear sky solar irradiance [W/m^{2}]
+        sdn_24 (np.array): Average daily solar irradiance [W/m^{2}]
+
+    Returns:
+        dict: Band name and data of the daily evapotranspiration [mm/day]
+    """
+    from pyTSEB import meteo_utils as met
+
+    return {'daily_evapotranspiration': met.flux_2_evaporation(sdn_24 * le / sdn, t_k=20+273.15, time_domain=24)}
+
+def daily_evapotranspiration(ief_file:str, mi_file:str, output_file:str, block_size:int = None):
     """Estimates daily evapotranspiration by extrapolating instantaneous latent heat flux using daily solar irradiance.
 
     Args:
         ief_file (str): Path to energy fluxes product
         mi_file (str): Path to meteorological data product (from prepare)
         output_file (str): Path to store daily evapotranspiration [mm/day]
+        block_size (int, optional): Process the scene in blocks of block_size x block_size pixels to bound memory use. Defaults to the whole scene
     """
 
-    # Read the required data
-    le_band, geo_coding = su.read_snappy_product(ief_file, 'latent_heat_flux')
-    le_band = le_band.astype(np.float32)
-    sdn_band = su.read_snappy_product(mi_file, 'clear_sky_solar_radiation')[0].astype(np.float32)
-    sdn_24_band = su.read_snappy_product(mi_file, 'average_daily_solar_irradiance')[0].astype(np.float32)
-
-    le = np.array(le_band)
-    sdn = np.array(sdn_band)
-    sdn_24 = np.array(sdn_24_band)
+    def compute(bands):
+        [le], [sdn, sdn_24] = bands
+        return {'dailySpectra': compute_daily_evapotranspiration(le, sdn, sdn_24)}
 
-    et_daily = met.flux_2_evaporation(sdn_24 * le / sdn, t_k=20+273.15, time_domain=24)
-    
-    su.write_snappy_product(output_file, [{'band_name': 'daily_evapotranspiration', 'band_data': et_daily}],
-                            'dailySpectra', geo_coding)
+    su.map_blocks([(ief_file, ['latent_heat_flux']),
+                   (mi_file, ['clear_sky_solar_radiation', 'average_daily_solar_irradiance'])],
+                  compute, {'dailySpectra': (output_file, 'dailySpectra')}, block_size)
@@ -1,16 +1,27 @@
+import time
+import shutil
+import resource
 import tempfile
 import numpy as np
-import os
 import os.path as pth
 
-from pyDMS.pyDMS import DecisionTreeSharpener
-
 import senet.core.gdal_utils as gu
 import senet.core.snappy_utils as su
+from senet.core.static_layers import static_layers
+from senet.core.sharpener_models import sharpener_models, residual_rmse
+from senet.core.solar_geometry import incidence_angle, terrain_terms
+# The solar angle functions lived in this module before solar_geometry and are re-exported for existing callers
+from senet.core.solar_geometry import declination_angle, hour_angle, incidence_angle_tilted
+
+__all__ = ['sharpen', 'TERRAIN_LAYERS', 'declination_angle', 'hour_angle', 'incidence_angle_tilted']
+
+# Layers of the static_layers store of a tile that sharpen derives from the DEM and the pixel coordinates
+TERRAIN_LAYERS = ['slope', 'aspect', 'cos_slope', 'sin_slope_cos_aspect', 'sin_slope_sin_aspect', 'latitude', 'longitude']
 
 def sharpen(sentinel_2_reflectance:str, sentinel_3_lst:str, high_res_dem:str, high_res_geom:str, lst_quality_mask:str,
     date_time_utc:str, output:str, elevation_band:str = "elevation", cv_homogeneity_threshold:float = .0, lst_good_quality_flags:str = "1",
-    moving_window_size:int = 30, parallel_jobs:int = 1):
+    moving_window_size:int = 30, parallel_jobs:int = 1, static:static_layers = None,
+    models:sharpener_models = None):
     """Data Mining Sharpener Python implementation for sharpening SLSTR Land Surface Temperature to Sentinel-2 spatial resolution.
 
     Args:
@@ -26,58 +37,66 @@ def sharpen(sentinel_2_reflectance:str, sentinel_3_lst:str, high_res_dem:str, hi
         lst_good_quality_flags (str, optional):Good quality mask values. Defaults to "1"      
         moving_window_size (int, optional): Moving window size. Defaults to 3
         parallel_jobs (int, optional): Parallel jobs. Defaults to 1
+        static (static_layers, optional): Store of the static layers of the tile. The slope, aspect, their trigonometric
+            terms (see solar_geometry.terrain_terms) and the pixel coordinates are stored on the first run and loaded
+            afterwards instead of being derived from the DEM. Defaults to deriving them on every run
+        models (sharpener_models, optional): Store of the trained regressors of the tile. The regressor trained on the
+            closest acquisition is reused instead of training a new one, unless its residual RMSE shows that it drifted.
+            Newly trained regressors are stored. Defaults to training a new regressor on every run
     """
+    # pyDMS imports GDAL, which has to be set up by gdal_utils first
+    gu._gdal()
+    from pyDMS.pyDMS import DecisionTreeSharpener
 
     # Derive illumination conditions from the DEM
     print('INFO: Deriving solar illumination conditions...')
-    temp_file = tempfile.NamedTemporaryFile(suffix=".tif", delete=False)
-    temp_dem_file = temp_file.name
-    temp_file.close()
-    su.copy_bands_to_file(high_res_dem, temp_dem_file, [elevation_band])
-    temp_slope_file = gu.slope_from_dem(temp_dem_file)
-    temp_aspect_file = gu.aspect_from_dem(temp_dem_file)
-    slope = gu.raster_data(temp_slope_file)
-    aspect = gu.raster_data(temp_aspect_file)
-    try:
-        lat = su.read_snappy_product(high_res_geom, 'latitude_tx')[0]
-    except RuntimeError:
-        lat = su.read_snappy_product(high_res_geom, 'latitude_in')[0]
-    try:
-        lon = su.read_snappy_product(high_res_geom, 'longitude_tx')[0]
-    except RuntimeError:
-        lon = su.read_snappy_product(high_res_geom, 'longitude_in')[0]
+    # BEAM-DIMAP inputs are read by GDAL through VRTs over their band images, derived layers go to a temporary folder
+    temp_dir = tempfile.mkdtemp()
+    temp_dem_file = gu.product_to_gdal(high_res_dem, [elevation_band])
+    if static is not None and static.has(*TERRAIN_LAYERS):
+        terrain = [static.load(name) for name in TERRAIN_LAYERS[2:5]]
+        lat, lon = static.load('latitude'), static.load('longitude')
+    else:
+        temp_slope_file = gu.slope_from_dem(temp_dem_file, pth.join(temp_dir, 'slope.tif'))
+        temp_aspect_file = gu.aspect_from_dem(temp_dem_file, pth.join(temp_dir, 'aspect.tif'))
+        slope = gu.raster_data(temp_slope_file)
+        aspect = gu.raster_data(temp_aspect_file)
+        terrain = terrain_terms(slope, aspect)
+        try:
+            lat, lon = su.read_snappy_bands(high_res_geom, ['latitude_tx', 'longitude_tx'])[0]
+        except RuntimeError:
+            lat, lon = su.read_snappy_bands(high_res_geom, ['latitude_in', 'longitude_in'])[0]
+        if static is not None:
+            static.store(dict(zip(TERRAIN_LAYERS, [np.asarray(slope, np.float32), np.asarray(aspect, np.float32)] +
+                                  list(terrain) + [lat, lon])))
+        slope = None
+        aspect = None
     doy = date_time_utc.timetuple().tm_yday
     ftime = date_time_utc.hour + date_time_utc.minute/60.0
-    cos_theta = incidence_angle_tilted(lat, lon, doy, ftime, stdlon=0, A_ZS=aspect, slope=slope)
-    proj, gt = gu.raster_info(temp_dem_file)[0:2]
-    temp_cos_theta_file = pth.splitext(temp_dem_file)[0] + '_cos_theta.tif'
-    fp = gu.save_image(cos_theta, gt, proj, temp_cos_theta_file)
-    fp = None
-    slope = None
-    aspect = None
-    cos_theta = None
+    cos_theta = incidence_angle(lat, lon, doy, ftime, stdlon=0, terrain=terrain)
+    terrain = None
+    lat = None
+    lon = None
 
     print('INFO: Preparing high-resolution data...')
-    # Combine all high-resolution data into one virtual raster
-    temp_file = tempfile.NamedTemporaryFile(suffix=".tif", delete=False)
-    temp_refl_file = temp_file.name
-    temp_file.close()
-    su.copy_bands_to_file(sentinel_2_reflectance, temp_refl_file)
-    vrt_filename = pth.splitext(temp_refl_file)[0]+".vrt"
-    fp = gu.merge_raster_layers([temp_refl_file, temp_dem_file, temp_cos_theta_file],
-                                vrt_filename, separate=True)
-    fp = None
-    high_res_filename = vrt_filename
+    # Stack all high-resolution predictors once into a float32 feature cube, read by both training and application
+    start = time.perf_counter()
+    temp_refl_file = gu.product_to_gdal(sentinel_2_reflectance)
+    proj, gt, _, _, _, n_refl_bands = gu.raster_info(temp_refl_file)[0:6]
+    height, width = cos_theta.shape
+    cube = gu.feature_cube(width, height, proj, gt, n_refl_bands + 2, temp_dir=temp_dir)
+    cube.append_raster(temp_refl_file)
+    cube.append_raster(temp_dem_file)
+    cube.append('cos_theta', cos_theta)
+    cos_theta = None
+    high_res_filename = cube.to_vrt()
+    io_time = time.perf_counter() - start
+    print("INFO: Feature cube of {} bands ({:.1f} MB, {}) built in {:.2f} s".format(
+        len(cube.bands), cube.nbytes / 2**20, "in memory" if cube.in_memory else "on disk", io_time))
 
-    # Save low resolution files as geotiffs
-    temp_file = tempfile.NamedTemporaryFile(suffix=".tif", delete=False)
-    temp_lst_file = temp_file.name
-    temp_file.close()
-    su.copy_bands_to_file(sentinel_3_lst, temp_lst_file, ["LST"])
-    temp_file = tempfile.NamedTemporaryFile(suffix=".tif", delete=False)
-    temp_mask_file = temp_file.name
-    temp_file.close()
-    su.copy_bands_to_file(lst_quality_mask, temp_mask_file)
+    # Make low resolution files readable by GDAL
+    temp_lst_file = gu.product_to_gdal(sentinel_3_lst, ["LST"])
+    temp_mask_file = gu.product_to_gdal(lst_quality_mask)
 
     # Set options of the disaggregator
     flags = [int(i) for i in lst_good_quality_flags.split(",")]
@@ -91,103 +110,66 @@ def sharpen(sentinel_2_reflectance:str, sentinel_3_lst:str, high_res_dem:str, hi
          "disaggregatingTemperature":  True,
          "baggingRegressorOpt":        {"n_jobs": parallel_jobs, "n_estimators": 30,
                                         "max_samples": 0.8, "max_features": 0.8}}
-    disaggregator = DecisionTreeSharpener(**dms_options)
+    quality = gu.raster_data(temp_mask_file)
+
+    def train():
+        print("INFO: Training regressor...")
+        start = time.perf_counter()
+        disaggregator = DecisionTreeSharpener(**dms_options)
+        disaggregator.trainSharpener()
+        print("INFO: Regressor trained in {:.2f} s".format(time.perf_counter() - start))
+        return disaggregator
+
+    def apply(disaggregator):
+        print("INFO: Sharpening...")
+        start = time.perf_counter()
+        downscaled_file = disaggregator.applySharpener(high_res_filename, temp_lst_file)
+        print("INFO: Sharpened in {:.2f} s".format(time.perf_counter() - start))
+        print("INFO: Residual analysis...")
+        residual_image, corrected_image = disaggregator.residualAnalysis(downscaled_file,
+                                                                         temp_lst_file,
+                                                                         temp_mask_file,
+                                                                         doCorrection=True)
+        rmse = residual_rmse(residual_image.GetRasterBand(1).ReadAsArray(), quality, flags)
+        print("INFO: Residual RMSE: {:.3f} K".format(rmse))
+        return corrected_image, rmse
+
+    # Reuse the sharpener of a nearby acquisition with the same predictors, low resolution grid and options
+    stored = None
+    if models is not None:
+        config = {key: value for key, value in dms_options.items() if not key.endswith("Files")}
+        # The number of parallel jobs does not change the trained regressor
+        config["baggingRegressorOpt"] = {key: value for key, value in config["baggingRegressorOpt"].items()
+                                         if key != "n_jobs"}
+        models = models.sub(config=config, high_res_bands=[band_name for band_name, _ in cube.bands],
+                            low_res_grid=gu.raster_info(temp_lst_file)[0:4])
+        stored = models.latest(date_time_utc.date())
 
     # Do the sharpening
-    print("INFO: Training regressor...")
-    disaggregator.trainSharpener()
-    print("INFO: Sharpening...")
-    downscaled_file = disaggregator.applySharpener(high_res_filename, temp_lst_file)
-    print("INFO: Residual analysis...")
-    residual_image, corrected_image = disaggregator.residualAnalysis(downscaled_file,
-                                                                     temp_lst_file,
-                                                                     temp_mask_file,
-                                                                     doCorrection=True)
+    if stored is not None:
+        print("INFO: Reusing the regressor trained on {}".format(stored.date))
+        corrected_image, rmse = apply(stored.model)
+        if models.drifted(stored, rmse):
+            print("INFO: Residual RMSE of the reused regressor is above {:.1f} times the in-sample {:.3f} K of its "
+                  "training scene, training a new one".format(models.drift_ratio, stored.residual_rmse))
+            stored = None
+    if stored is None:
+        disaggregator = train()
+        corrected_image, rmse = apply(disaggregator)
+        if models is not None:
+            models.store(date_time_utc.date(), disaggregator, rmse)
     # Save the sharpened file
     band = {"band_name": "sharpened_LST", "description": "Sharpened Sentinel-3 LST", "unit": "K",
             "band_data": corrected_image.GetRasterBand(1).ReadAsArray()}
     geo_coding = su.get_product_info(sentinel_2_reflectance)[1]
     su.write_snappy_product(output, [band], "sharpenedLST", geo_coding)
+    print("INFO: Sharpening peak memory: {:.0f} MB".format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
 
     # Clean up
     try:
-        os.remove(temp_dem_file)
-        os.remove(temp_aspect_file)
-        os.remove(temp_slope_file)
-        os.remove(temp_cos_theta_file)
-        os.remove(temp_refl_file)
-        os.remove(temp_lst_file)
-        os.remove(temp_mask_file)
+        cube.remove()
+        for temp_path in [temp_dem_file, temp_refl_file, temp_lst_file, temp_mask_file]:
+            gu.remove_gdal_file(temp_path)
+        shutil.rmtree(temp_dir)
     except Exception:
         pass
-
-
-def declination_angle(doy:int):
-    """Calculates the Earth declination angle.
-
-    Args:
-        doy (int, float): Day of year
-
-    Returns:
-        float: Declination angle [radians]
-    """
-
-    declination = np.radians(23.45) * np.sin((2.0 * np.pi * doy / 365.0) - 1.39)
-
-    return declination
-
-
-def hour_angle(ftime:float, declination:float, lon:float, stdlon:float = .0):
-    """Calculates the hour angle.
-
-    Args:
-        ftime (float): Time of the day [decimal hours]
-        declination (float): Declination angle [radians]
-        lon (float): Longitude of the site [degrees]
-        stdlon (float, optional): Longitude of the standard meridian that represents ftime time zone. Defaults to 0.
-
-    Returns:
-        float: hour angle [radians]
-    """
-
-    EOT = 0.258 * np.cos(declination) - 7.416 * np.sin(declination) - \
-          3.648 * np.cos(2.0 * declination) - 9.228 * np.sin(2.0 * declination)
-    LC = (stdlon - lon) / 15.
-    time_corr = (-EOT / 60.) + LC
-    solar_time = ftime - time_corr
-    # Get the hour angle
-    w = np.radians((12.0 - solar_time) * 15.)
-
-    return w
-
-
-def incidence_angle_tilted(lat:float, lon:float, doy:int, ftime:float, stdlon:float = .0, A_ZS:float = .0, slope:float = .0):
-    """Calculates the incidence solar angle over a tilted flat surface.
-
-    Args:
-        lat (float, np.array): Latitude [degrees]
-        lon (float, np.array): Longitude [degrees]
-        doy (int): Day of year
-        ftime (float): Time of the day [decimal hours]
-        stdlon (float, optional): Longitude of the standard meridian that represents ftime time zone. Defaults to .0
-        A_ZS (float, np.array, optional): Surface azimuth angle, measured clockwise from north [degrees]. Defaults to .0
-        slope (float, optional): Slope angle [radians]. Defaults to .0
-
-    Returns:
-        [float, np.array]: Cosine of the incidence angle
-    """
-
-    # Get the declination and hour angle
-    delta = declination_angle(doy)
-    omega = hour_angle(ftime, delta, lon, stdlon=stdlon)
-
-    # Convert remaining angles into radians
-    lat, A_ZS, slope = map(np.radians, [lat, A_ZS, slope])
-
-    cos_theta_i = (np.sin(delta) * np.sin(lat) * np.cos(slope)
-                   + np.sin(delta) * np.cos(lat) * np.sin(slope) * np.cos(A_ZS)
-                   + np.cos(delta) * np.cos(lat) * np.cos(slope) * np.cos(omega)
-                   - np.cos(delta) * np.sin(lat) * np.sin(slope) * np.cos(A_ZS) * np.cos(omega)
-                   - np.cos(delta) * np.sin(slope) * np.sin(A_ZS) * np.sin(omega))
-
-    return cos_theta_i
\ No newline at end of file
@@ -0,0 +1,416 @@
+"""Pure Python reader and writer for BEAM-DIMAP products.
+
+A BEAM-DIMAP product is a .dim XML header plus a .data directory holding one ENVI .hdr/.img pair
+per band. The band images are raw, band sequential rasters, so they can be exposed as numpy.memmap
+views and written with ndarray.tofile without starting SNAP and its JVM. Geocoding is kept as the
+Coordinate_Reference_System and Geoposition elements of the .dim file, which are copied verbatim to
+the written products so that SNAP reads them back with the same geocoding.
+"""
+import os
+import re
+import xml.etree.ElementTree as Etree
+from collections import namedtuple
+
+import numpy as np
+
+# DIMAP band data types
+DATA_TYPES = {
+    "int8": np.int8,
+    "uint8": np.uint8,
+    "int16": np.int16,
+    "uint16": np.uint16,
+    "int32": np.int32,
+    "uint32": np.uint32,
+    "int64": np.int64,
+    "float32": np.float32,
+    "float64": np.float64,
+}
+
+# ENVI header data type codes
+ENVI_DATA_TYPES = {
+    1: np.uint8,
+    2: np.int16,
+    3: np.int32,
+    4: np.float32,
+    5: np.float64,
+    12: np.uint16,
+    13: np.uint32,
+    14: np.int64,
+    15: np.uint64,
+}
+
+# Number of pixels written at a time when converting band data to the stored type
+_WRITE_CHUNK_PIXELS = 1 << 22
+
+# Band data types written as such, band data of any other type is written as float32
+_WRITE_TYPES = {"uint8": (1, ">u1"), "float32": (4, ">f4")}
+
+DimapGeoCoding = namedtuple("DimapGeoCoding", ["crs_wkt", "image_to_model", "elements"])
+DimapGeoCoding.__doc__ = """Geocoding of a BEAM-DIMAP product with a map (CRS) geocoding.
+
+    crs_wkt (str): WKT of the coordinate reference system
+    image_to_model (tuple): Image to map affine transform (m00, m10, m01, m11, m02, m12)
+    elements (list): Serialized Coordinate_Reference_System and Geoposition elements of the .dim file
+"""
+
+
+class DimapNotSupportedError(RuntimeError):
+    """Raised for products that the pure Python backend cannot handle (virtual bands, pixel geocodings)."""
+
+
+def dim_paths(file_path:str):
+    """Returns the paths of the .dim header and the .data directory of a product."""
+    base = os.path.splitext(file_path)[0]
+    return base + ".dim", base + ".data"
+
+
+def geotransform(geo_coding:DimapGeoCoding):
+    """Converts the image to model transform of a geocoding to a GDAL geotransform.
+
+    Args:
+        geo_coding (DimapGeoCoding): Product geocoding
+
+    Returns:
+        tuple: GDAL geotransform (x origin, pixel width, row rotation, y origin, column rotation, pixel height)
+    """
+    m00, m10, m01, m11, m02, m12 = geo_coding.image_to_model
+    return (m02, m00, m01, m12, m10, m11)
+
+
+def make_geo_coding(crs_wkt:str, gdal_geotransform:tuple):
+    """Creates a map geocoding from a CRS and a GDAL geotransform.
+
+    Args:
+        crs_wkt (str): WKT of the coordinate reference system
+        gdal_geotransform (tuple): GDAL geotransform
+
+    Returns:
+        DimapGeoCoding: Geocoding that can be written to BEAM-DIMAP products
+    """
+    x0, dx, rx, y0, ry, dy = gdal_geotransform
+    image_to_model = (dx, ry, rx, dy, x0, y0)
+    crs = Etree.Element("Coordinate_Reference_System")
+    Etree.SubElement(crs, "WKT").text = crs_wkt
+    geoposition = Etree.Element("Geoposition")
+    Etree.SubElement(geoposition, "IMAGE_TO_MODEL_TRANSFORM").text = ",".join(repr(float(v)) for v in image_to_model)
+    elements = [Etree.tostring(crs, encoding="unicode"), Etree.tostring(geoposition, encoding="unicode")]
+    return DimapGeoCoding(crs_wkt, image_to_model, elements)
+
+
+def _text(element, tag:str, default=None):
+    child = element.find(tag)
+    if child is None or child.text is None:
+        return default
+    return child.text.strip()
+
+
+def _read_geo_coding(root):
+    """Reads the map geocoding of a .dim document. Returns None for other geocodings."""
+    crs = root.find("Coordinate_Reference_System")
+    geoposition = None
+    for element in root.findall("Geoposition"):
+        # Scene geocoding is the one that does not refer to a band
+        if element.find("BAND_INDEX") is None:
+            geoposition = element
+            break
+    if crs is None or geoposition is None:
+        return None
+    wkt = _text(crs, "WKT")
+    transform = _text(geoposition, "IMAGE_TO_MODEL_TRANSFORM")
+    if wkt is None or transform is None:
+        return None
+    image_to_model = tuple(float(v) for v in transform.split(","))
+    elements = [Etree.tostring(crs, encoding="unicode"), Etree.tostring(geoposition, encoding="unicode")]
+    return DimapGeoCoding(wkt, image_to_model, elements)
+
+
+def read_envi_header(hdr_path:str):
+    """Reads an ENVI header file.
+
+    Args:
+        hdr_path (str): Path to .hdr file
+
+    Returns:
+        dict: Header keys (lower case) and their string values. Values in braces are returned without the braces
+    """
+    with open(hdr_path, "r") as fp:
+        content = fp.read()
+    header = {}
+    for match in re.finditer(r"^\s*([^=\n]+?)\s*=\s*(\{[^}]*\}|[^\n]*)", content, re.MULTILINE):
+        value = match.group(2).strip()
+        if value.startswith("{"):
+            value = value[1:-1].strip()
+        header[match.group(1).strip().lower()] = value
+    return header
+
+
+def read_dimap_info(file_path:str):
+    """Reads the header of a BEAM-DIMAP product.
+
+    Args:
+        file_path (str): Path to the .dim file
+
+    Returns:
+        dict: Product 'name', 'product_type', 'width', 'height', 'geo_coding' (DimapGeoCoding or None)
+            and 'bands', a list of band dictionaries
+    """
+    dim_path, data_dir = dim_paths(file_path)
+    root = Etree.parse(dim_path).getroot()
+    width = int(_text(root, "Raster_Dimensions/NCOLS"))
+    height = int(_text(root, "Raster_Dimensions/NROWS"))
+
+    data_files = {}
+    for data_file in root.findall("Data_Access/Data_File"):
+        href = data_file.find("DATA_FILE_PATH").get("href")
+        data_files[int(_text(data_file, "BAND_INDEX"))] = os.path.join(os.path.dirname(dim_path), href)
+
+    bands = []
+    for info in root.findall("Image_Interpretation/Spectral_Band_Info"):
+        index = int(_text(info, "BAND_INDEX"))
+        hdr_path = data_files.get(index)
+        band = {
+            "band_name": _text(info, "BAND_NAME"),
+            "band_index": index,
+            "description": _text(info, "BAND_DESCRIPTION", ""),
+            "unit": _text(info, "PHYSICAL_UNIT", ""),
+            "data_type": _text(info, "DATA_TYPE", "float32"),
+            "width": int(_text(info, "BAND_RASTER_WIDTH", width)),
+            "height": int(_text(info, "BAND_RASTER_HEIGHT", height)),
+            "scaling_factor": float(_text(info, "SCALING_FACTOR", 1.0)),
+            "scaling_offset": float(_text(info, "SCALING_OFFSET", 0.0)),
+            "log10_scaled": _text(info, "LOG10_SCALED", "false").lower() == "true",
+            "no_data_value_used": _text(info, "NO_DATA_VALUE_USED", "false").lower() == "true",
+            "no_data_value": float(_text(info, "NO_DATA_VALUE", 0.0)),
+            "virtual": _text(info, "VIRTUAL_BAND", "false").lower() == "true" or info.find("EXPRESSION") is not None,
+            "hdr_path": hdr_path,
+            "img_path": os.path.splitext(hdr_path)[0] + ".img" if hdr_path else None,
+        }
+        bands.append(band)
+
+    return {
+        "name": _text(root, "Dataset_Id/DATASET_NAME", os.path.splitext(os.path.basename(dim_path))[0]),
+        "product_type": _text(root, "Production/PRODUCT_TYPE", ""),
+        "width": width,
+        "height": height,
+        "geo_coding": _read_geo_coding(root),
+        "bands": bands,
+    }
+
+
+def _find_band(info:dict, band_name:str, file_path:str):
+    if band_name is None:
+        band = info["bands"][0]
+    else:
+        band = next((b for b in info["bands"] if b["band_name"] == band_name), None)
+        if band is None:
+            raise RuntimeError(file_path + " does not contain band " + band_name)
+    if band["virtual"] or band["img_path"] is None or not os.path.exists(band["img_path"]):
+        raise DimapNotSupportedError(file_path + " band " + band["band_name"] + " has no image file")
+    return band
+
+
+def open_dimap_band(file_path:str, band_name:str = None, mode:str = "r", info:dict = None):
+    """Exposes the stored (raw) values of a band as a zero-copy memory map.
+
+    Args:
+        file_path (str): Path to the .dim file
+        band_name (str, optional): Name of the band. Defaults to the first band of the product
+        mode (str, optional): numpy.memmap mode. Defaults to "r"
+        info (dict, optional): Product header from read_dimap_info, to avoid parsing it again. Defaults to None
+
+    Returns:
+        np.memmap: (height, width) view of the band image. Values are not scaled to geophysical units
+    """
+    if info is None:
+        info = read_dimap_info(file_path)
+    band = _find_band(info, band_name, file_path)
+    header = read_envi_header(band["hdr_path"]) if os.path.exists(band["hdr_path"]) else {}
+    if "data type" in header:
+        dtype = np.dtype(ENVI_DATA_TYPES[int(header["data type"])])
+        # ENVI has no signed byte type
+        if band["data_type"] == "int8":
+            dtype = np.dtype(np.int8)
+    else:
+        dtype = np.dtype(DATA_TYPES[band["data_type"]])
+    byte_order = ">" if header.get("byte order", "1") == "1" else "<"
+    return np.memmap(band["img_path"], dtype=dtype.newbyteorder(byte_order), mode=mode,
+                     offset=int(header.get("header offset", 0)), shape=(band["height"], band["width"]))
+
+
+def read_dimap_band(file_path:str, band_name:str = None, dtype=np.float32, out:np.array = None,
+                    window:tuple = None, info:dict = None):
+    """Reads the geophysical values of a band, like snappy's Band.readPixels.
+
+    Args:
+        file_path (str): Path to the .dim file
+        band_name (str, optional): Name of the band. Defaults to the first band of the product
+        dtype (np.dtype, optional): Data type of the returned array. Ignored if out is given. Defaults to np.float32
+        out (np.array, optional): Preallocated buffer with the shape of the window. Defaults to None
+        window (tuple, optional): Pixel window (x, y, width, height) to read. Defaults to the whole band
+        info (dict, optional): Product header from read_dimap_info, to avoid parsing it again. Defaults to None
+
+    Returns:
+        np.array: Band data
+    """
+    if info is None:
+        info = read_dimap_info(file_path)
+    band = _find_band(info, band_name, file_path)
+    view = open_dimap_band(file_path, band["band_name"], info=info)
+    if window is not None:
+        x, y, width, height = window
+        view = view[y:y + height, x:x + width]
+    if out is None:
+        out = np.empty(view.shape, dtype)
+    elif out.shape != view.shape:
+        raise ValueError("Output buffer shape {} does not match window shape {}".format(out.shape, view.shape))
+
+    factor, offset = band["scaling_factor"], band["scaling_offset"]
+    if factor != 1.0 or offset != 0.0 or band["log10_scaled"]:
+        np.multiply(view, factor, out=out, casting="unsafe")
+        out += offset
+        if band["log10_scaled"]:
+            np.power(10, out, out=out)
+    else:
+        # Byte swapping and type conversion in a single pass
+        out[...] = view
+    return out
+
+
+def write_data_type(band:dict):
+    """Data type a band is written with: uint8 for uint8 band data, float32 otherwise."""
+    data = band.get("band_data")
+    return "uint8" if data is not None and np.asarray(data).dtype == np.uint8 else "float32"
+
+
+def _write_envi_header(hdr_path:str, band_name:str, width:int, height:int, description:str = "",
+    data_type:str = "float32"):
+    with open(hdr_path, "w") as fp:
+        fp.write("ENVI\n")
+        fp.write("description = {{{}}}\n".format(description or "Sentinel Application Platform (SNAP) Data Product"))
+        fp.write("samples = {}\n".format(width))
+        fp.write("lines = {}\n".format(height))
+        fp.write("bands = 1\n")
+        fp.write("header offset = 0\n")
+        fp.write("file type = ENVI Standard\n")
+        fp.write("data type = {}\n".format(_WRITE_TYPES[data_type][0]))
+        fp.write("interleave = bsq\n")
+        fp.write("byte order = 1\n")
+        fp.write("band names = {{ {} }}\n".format(band_name))
+
+
+def _write_dim_header(dim_path:str, bands:list, product_name:str, geo_coding:DimapGeoCoding, width:int, height:int):
+    data_dir = os.path.basename(os.path.splitext(dim_path)[0]) + ".data"
+    root = Etree.Element("Dimap_Document", name=os.path.basename(dim_path))
+    metadata_id = Etree.SubElement(root, "Metadata_Id")
+    Etree.SubElement(metadata_id, "METADATA_FORMAT", version="2.12.1").text = "DIMAP"
+    Etree.SubElement(metadata_id, "METADATA_PROFILE").text = "BEAM-DATAMODEL-V1"
+    dataset_id = Etree.SubElement(root, "Dataset_Id")
+    Etree.SubElement(dataset_id, "DATASET_SERIES").text = "BEAM-PRODUCT"
+    Etree.SubElement(dataset_id, "DATASET_NAME").text = product_name
+    production = Etree.SubElement(root, "Production")
+    Etree.SubElement(production, "DATASET_PRODUCER_NAME")
+    Etree.SubElement(production, "PRODUCT_TYPE").text = product_name
+    if geo_coding is not None:
+        for element in geo_coding.elements:
+            root.append(Etree.fromstring(element))
+    dimensions = Etree.SubElement(root, "Raster_Dimensions")
+    Etree.SubElement(dimensions, "NCOLS").text = str(width)
+    Etree.SubElement(dimensions, "NROWS").text = str(height)
+    Etree.SubElement(dimensions, "NBANDS").text = str(len(bands))
+    data_access = Etree.SubElement(root, "Data_Access")
+    Etree.SubElement(data_access, "DATA_FILE_FORMAT").text = "ENVI"
+    Etree.SubElement(data_access, "DATA_FILE_FORMAT_DESC").text = "ENVI File Format"
+    Etree.SubElement(data_access, "DATA_FILE_ORGANISATION").text = "BAND_SEPARATE"
+    for index, b in enumerate(bands):
+        data_file = Etree.SubElement(data_access, "Data_File")
+        Etree.SubElement(data_file, "DATA_FILE_PATH", href="{}/{}.hdr".format(data_dir, b["band_name"]))
+        Etree.SubElement(data_file, "BAND_INDEX").text = str(index)
+    interpretation = Etree.SubElement(root, "Image_Interpretation")
+    for index, b in enumerate(bands):
+        info = Etree.SubElement(interpretation, "Spectral_Band_Info")
+        Etree.SubElement(info, "BAND_INDEX").text = str(index)
+        Etree.SubElement(info, "BAND_DESCRIPTION").text = b.get("description") or None
+        Etree.SubElement(info, "BAND_NAME").text = b["band_name"]
+        Etree.SubElement(info, "BAND_RASTER_WIDTH").text = str(width)
+        Etree.SubElement(info, "BAND_RASTER_HEIGHT").text = str(height)
+        Etree.SubElement(info, "DATA_TYPE").text = write_data_type(b)
+        Etree.SubElement(info, "PHYSICAL_UNIT").text = b.get("unit") or None
+        Etree.SubElement(info, "SOLAR_FLUX").text = "0.0"
+        Etree.SubElement(info, "BAND_WAVELEN").text = "0.0"
+        Etree.SubElement(info, "BANDWIDTH").text = "0.0"
+        Etree.SubElement(info, "SCALING_FACTOR").text = "1.0"
+        Etree.SubElement(info, "SCALING_OFFSET").text = "0.0"
+        Etree.SubElement(info, "LOG10_SCALED").text = "false"
+        Etree.SubElement(info, "NO_DATA_VALUE_USED").text = "false"
+        Etree.SubElement(info, "NO_DATA_VALUE").text = "0.0"
+    tree = Etree.ElementTree(root)
+    tree.write(dim_path, encoding="ISO-8859-1", xml_declaration=True)
+
+
+class dimap_writer():
+    """A BEAM-DIMAP product open for writing, band images are memory maps filled window by window."""
+
+    def __init__(self, file_path:str, bands:list, product_name:str, geo_coding:DimapGeoCoding, width:int, height:int):
+        """A BEAM-DIMAP product open for writing.
+
+        Args:
+            file_path (str): Path to store the product
+            bands (list): Band dictionaries with 'band_name' and optionally 'description' and 'unit' keys
+            product_name (str): Name of the product
+            geo_coding (DimapGeoCoding): Geocoding of the product
+            width (int): Scene width in pixels
+            height (int): Scene height in pixels
+        """
+        self.dim_path, self.data_dir = dim_paths(file_path)
+        self.width = width
+        self.height = height
+        os.makedirs(self.data_dir, exist_ok=True)
+        _write_dim_header(self.dim_path, bands, product_name, geo_coding, width, height)
+        self.images = {}
+        for b in bands:
+            base = os.path.join(self.data_dir, b["band_name"])
+            data_type = write_data_type(b)
+            _write_envi_header(base + ".hdr", b["band_name"], width, height, b.get("description", ""), data_type)
+            self.images[b["band_name"]] = np.memmap(base + ".img", dtype=_WRITE_TYPES[data_type][1], mode="w+",
+                                                    shape=(height, width))
+
+    def write(self, band_name:str, data:np.array, window:tuple = None):
+        """Writes band data into a window of the product.
+
+        Args:
+            band_name (str): Name of the band
+            data (np.array): Band data with the shape of the window
+            window (tuple, optional): Pixel window (x, y, width, height). Defaults to the whole scene
+        """
+        x, y, width, height = window if window is not None else (0, 0, self.width, self.height)
+        self.images[band_name][y:y + height, x:x + width] = data
+
+    def close(self):
+        """Flushes the band images to disk."""
+        for image in self.images.values():
+            image.flush()
+        self.images = {}
+
+
+def write_dimap_product(file_path:str, bands:list, product_name:str, geo_coding:DimapGeoCoding):
+    """Writes bands to a new BEAM-DIMAP product with uint8 or float32 band images.
+
+    Args:
+        file_path (str): Path to store the product. The extension is replaced by .dim
+        bands (list): Band dictionaries with 'band_name', 'band_data' and optionally 'description' and 'unit' keys
+        product_name (str): Name of the product
+        geo_coding (DimapGeoCoding): Geocoding of the product
+    """
+    height, width = bands[0]["band_data"].shape
+    dim_path, data_dir = dim_paths(file_path)
+    os.makedirs(data_dir, exist_ok=True)
+    _write_dim_header(dim_path, bands, product_name, geo_coding, width, height)
+    for b in bands:
+        base = os.path.join(data_dir, b["band_name"])
+        data_type = write_data_type(b)
+        _write_envi_header(base + ".hdr", b["band_name"], width, height, b.get("description", ""), data_type)
+        data = np.asarray(b["band_data"]).reshape(-1)
+        with open(base + ".img", "wb") as fp:
+            # Convert to big endian in chunks so that no full-size copy is created
+            for start in range(0, data.size, _WRITE_CHUNK_PIXELS):
+                data[start:start + _WRITE_CHUNK_PIXELS].astype(_WRITE_TYPES[data_type][1]).tofile(fp)
@@ -1,6 +1,5 @@
-import tempfile
 import senet.core.ecmwf_utils as eu
-# snappy_utils should be imported last, as it modifies the system path
+import senet.core.gdal_utils as gu
 import senet.core.snappy_utils as su
 import datetime
 
@@ -23,11 +22,8 @@ def prepare(elevation_map:str, ecmwf_data_file:str, date_time_utc:datetime.datet
         prepare_clear_sky_solar_radiation (bool, optional): Prepare clear sky solar radiation. Defaults to True
         prepare_daily_solar_irradiance (bool, optional): Prepare daily solar irradiance. Defaults to True
     """
-    # Save elevation to GeoTIFF because it will need to be read by GDAL later
-    temp_file = tempfile.NamedTemporaryFile(suffix=".tif", delete=False)
-    temp_elev_path = temp_file.name
-    temp_file.close()
-    su.copy_bands_to_file(elevation_map, temp_elev_path, [elevation_band])
+    # Make elevation readable by GDAL, it will be needed later
+    temp_elev_path = gu.product_to_gdal(elevation_map, [elevation_band])
 
     # Calculate required meteorological parameters
     bands = []
@@ -63,5 +59,8 @@ def prepare(elevation_map:str, ecmwf_data_file:str, date_time_utc:datetime.datet
                       'description': 'Average daily solar irradiance (W/m^2)'})
 
     # Save the output file
-    geo_coding = su.read_snappy_product(elevation_map, elevation_band)[1]
+    geo_coding = su.get_product_info(elevation_map)[1]
     su.write_snappy_product(output_file, bands, 'ecmwfData', geo_coding)
+
+    # Clean up
+    gu.remove_gdal_file(temp_elev_path)
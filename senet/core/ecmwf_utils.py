@@ -2,22 +2,23 @@ import os
 import datetime
 import numpy as np
 cur_path =  os.path.dirname(os.path.abspath(__file__))
-if os.name == 'nt':
-    os.environ["PROJ_LIB"] = os.path.join(cur_path, "../Library/share/proj")
-    os.environ["GDAL_DATA"] = os.path.join(cur_path, "../Library/share/gdal")
-else:
-    os.environ["PROJ_LIB"] = os.path.join(cur_path, "../share/proj")
-    os.environ["GDAL_DATA"] = os.path.join(cur_path, "../share/gdal")
-from osgeo import gdal, osr
-import netCDF4
 
-from pyTSEB import meteo_utils as met
+import senet.core.gdal_utils as gu
 
-if not os.path.isdir(os.path.expanduser('~')) and not os.getenv('CDSAPI_RC', None):
-    os.environ['CDSAPI_RC'] = os.path.join(cur_path, '../../../../.cdsapirc')
-import cdsapi
 
-import senet.core.gdal_utils as gu
+def _gdal():
+    """Imports GDAL and OSR on first use, through gdal_utils so that PROJ and GDAL find their data files."""
+    gu._gdal()
+    from osgeo import gdal, osr
+    return gdal, osr
+
+
+def _cdsapi():
+    """Imports the CDS API client on first use."""
+    if not os.path.isdir(os.path.expanduser('~')) and not os.getenv('CDSAPI_RC', None):
+        os.environ['CDSAPI_RC'] = os.path.join(cur_path, '../../../../.cdsapirc')
+    import cdsapi
+    return cdsapi
 
 # Acceleration of gravity (m s-2)
 GRAVITY = 9.80665
@@ -37,13 +38,14 @@ def download_CDS_data(date_start:str, date_end:str, variables:list, target:str,
 
     # Connect to the server and download the data
     if not os.path.exists(target) or overwrite:
-        c = cdsapi.Client()
+        c = _cdsapi().Client()
         c.retrieve("reanalysis-era5-single-levels", s, target)
         del c
     
     print("Downloaded")
 
 def get_ECMWF_data(ecmwf_data_file, field, timedate_UTC, elev, time_zone):
+    import netCDF4
 
     ncfile = netCDF4.Dataset(ecmwf_data_file, 'r')
     # Find the location of bracketing dates
@@ -115,6 +117,8 @@ def get_ECMWF_data(ecmwf_data_file, field, timedate_UTC, elev, time_zone):
 
 
 def calc_air_temperature_blending_height(ta, ea, p, z_bh, z_ta=2.0):
+    from pyTSEB import meteo_utils as met
+
     if type(ta) is np.ndarray:
         ta = ta.astype(np.float32)
     if type(ea) is np.ndarray:
@@ -155,6 +159,7 @@ def calc_tcwv_cm(tcwv):
 
 
 def _getECMWFTempInterpData(ncfile, var_name, before_I, after_I, frac):
+    gdal, osr = _gdal()
     ds = gdal.Open('NETCDF:"'+ncfile+'":'+var_name)
     if ds is None:
         raise RuntimeError("Variable %s does not exist in file %s." % (var_name, ncfile))
@@ -197,6 +202,8 @@ def _ECMWFRespampleData(data, gt, proj, template_file):
 
 
 def _getECMWFIntegratedData(ncfile, var_name, date_time, time_window=24,):
+    import netCDF4
+    gdal, osr = _gdal()
 
     # Open the netcdf time dataset
     fid = netCDF4.Dataset(ncfile, 'r')
@@ -1,11 +1,714 @@
+import os
+import time
+import atexit
+import multiprocessing
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-from pyTSEB import TSEB
 
 import senet.core.snappy_utils as su
+from senet.core.packed_pixels import packed_pixels
+import senet.core.surrogate as sg
+
+# Number of pixels per chunk the TSEB and OSEB models are run on
+CHUNK_SIZE = 65536
+
+# Relative change of the Monin-Obukhov length below which the stability iteration has converged, as in pyTSEB
+STABILITY_THRESHOLD = 0.001
+
+# Quality flag of the pixels whose fluxes were predicted by the surrogate model instead of running TSEB
+SURROGATE_FLAG = 254
+
+# Per-pixel model input or output stored in shared memory
+_shared_array = namedtuple("_shared_array", ["shm_name", "dtype", "shape"])
+
+_process_pools = {}
+
+# Bands of the energy fluxes product
+BULK_BANDS = ['sensible_heat_flux', 'latent_heat_flux', 'ground_heat_flux', 'net_radiation', 'quality_flag']
+COMPONENT_FLUX_BANDS = ['sensible_heat_flux_canopy', 'sensible_heat_flux_soil', 'latent_heat_flux_canopy',
+                        'latent_heat_flux_soil', 'net_longwave_radiation_canopy', 'net_longwave_radiation_soil']
+COMPONENT_TEMPERATURE_BANDS = ['temperature_canopy', 'temperature_soil', 'temperature_canopy_air']
+AERODYNAMIC_BANDS = ['resistance_surface', 'resistance_canopy', 'resistance_soil', 'friction_velocity',
+                     'monin_obukhov_length']
+# Bands only returned on request. pyTSEB reports the stability iterations of a model run, which are those of its
+# slowest pixel, so chunk_max_iterations is an upper bound of the iterations of a pixel shared by its chunk
+DIAGNOSTIC_BANDS = ['chunk_max_iterations']
+
+# Model parameters of a parameter sweep and their defaults
+SWEEP_PARAMETERS = {'soil_roughness': .01, 'alpha_pt': 1.28, 'atmospheric_measurement_height': 100.0,
+                    'green_vegetation_emissivity': 0.99, 'soil_emissivity': 0.99}
+
+# Bands given by the outputs of OSEB and TSEB_PT, in the order the models return them
+_OSEB_OUTPUTS = ['quality_flag', 'net_longwave_radiation_soil', 'latent_heat_flux_soil', 'sensible_heat_flux_soil',
+                 'ground_heat_flux', 'resistance_surface', 'friction_velocity', 'monin_obukhov_length',
+                 'chunk_max_iterations']
+_TSEB_OUTPUTS = ['quality_flag', 'temperature_soil', 'temperature_canopy', 'temperature_canopy_air',
+                 'net_longwave_radiation_soil', 'net_longwave_radiation_canopy', 'latent_heat_flux_canopy',
+                 'sensible_heat_flux_canopy', 'latent_heat_flux_soil', 'sensible_heat_flux_soil', 'ground_heat_flux',
+                 'resistance_soil', 'resistance_canopy', 'resistance_surface', 'friction_velocity',
+                 'monin_obukhov_length', 'chunk_max_iterations']
+# Model outputs of the sensible heat fluxes, the latent heat fluxes, the friction velocity and the number of
+# iterations, and positional arguments of air temperature, vapour pressure and air pressure
+_STABILITY_OUTPUTS = {
+    "OSEB": ([3], [2], 6, 8, (1, 3, 4)),
+    "TSEB_PT": ([7, 9], [6, 8], 14, 16, (2, 4, 5)),
+}
+# Components summed into the bulk fluxes
+_BULK_COMPONENTS = {
+    'sensible_heat_flux': ['sensible_heat_flux_canopy', 'sensible_heat_flux_soil'],
+    'latent_heat_flux': ['latent_heat_flux_canopy', 'latent_heat_flux_soil'],
+    'net_radiation': ['net_longwave_radiation_canopy', 'net_longwave_radiation_soil'],
+}
+
+
+def _process_pool(workers:int):
+    """Returns a process pool with the given number of workers, reused across calls and shut down at exit.
+
+    The workers are started from a fork server (or spawned where there is none), never forked from this
+    process, which runs the threads of the pipeline steps and of the SNAP JVM. As with any spawned process,
+    the main script of the caller is imported by the workers, so it must be guarded by
+    if __name__ == "__main__".
+    """
+    if workers not in _process_pools:
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+        if not _process_pools:
+            atexit.register(_shutdown_process_pools)
+        _process_pools[workers] = ProcessPoolExecutor(workers, mp_context=context)
+    return _process_pools[workers]
+
+
+def _shutdown_process_pools():
+    """Shuts down the cached process pools."""
+    while _process_pools:
+        _process_pools.popitem()[1].shutdown()
+
+
+def _model_chunk(model:str, args:list, kwargs:dict, rows:list, outputs:_shared_array, start:int, stop:int):
+    """Runs a pyTSEB model on a chunk of the inputs in shared memory and stores the results in shared memory."""
+    from multiprocessing import shared_memory
+    from pyTSEB import TSEB
+
+    def resolve(value):
+        if not isinstance(value, _shared_array):
+            return value
+        shm = shared_memory.SharedMemory(name=value.shm_name)
+        try:
+            return np.array(np.ndarray(value.shape, value.dtype, buffer=shm.buf)[start:stop])
+        finally:
+            shm.close()
+
+    results = getattr(TSEB, model)(*[resolve(a) for a in args], **{k: resolve(v) for k, v in kwargs.items()})
+    shm = shared_memory.SharedMemory(name=outputs.shm_name)
+    try:
+        out = np.ndarray(outputs.shape, outputs.dtype, buffer=shm.buf)
+        for k, row in enumerate(rows):
+            out[k, start:stop] = results[row]
+        del out
+    finally:
+        shm.close()
+
+
+def _run_model(model:str, args:list, kwargs:dict, rows:list, n_pixels:int, workers:int = None,
+    chunk_size:int = CHUNK_SIZE):
+    """Runs a pyTSEB model on packed pixels, in chunks of a fixed number of pixels.
+
+    The chunks are the same whatever the number of workers, so the results do not depend on it.
+
+    Args:
+        model (str): Name of the pyTSEB.TSEB model function
+        args (list): Positional model arguments. 1-D arrays of n_pixels values are per-pixel inputs
+        kwargs (dict): Keyword model arguments. 1-D arrays of n_pixels values are per-pixel inputs
+        rows (list): Indices of the model outputs to keep
+        n_pixels (int): Number of pixels to run the model on
+        workers (int, optional): Number of worker processes. 1 runs the model in this process. Defaults to all cores
+        chunk_size (int, optional): Number of pixels per chunk. Defaults to CHUNK_SIZE
+
+    Returns:
+        np.array: Kept model outputs, with shape (len(rows), n_pixels)
+    """
+    from pyTSEB import TSEB
+
+    chunks = [(start, min(start + chunk_size, n_pixels)) for start in range(0, n_pixels, chunk_size)]
+    per_pixel = lambda value: isinstance(value, np.ndarray) and value.shape == (n_pixels,)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(chunks))
+
+    if workers <= 1:
+        out = np.empty((len(rows), n_pixels))
+        for start, stop in chunks:
+            results = getattr(TSEB, model)(*[a[start:stop] if per_pixel(a) else a for a in args],
+                                           **{k: v[start:stop] if per_pixel(v) else v for k, v in kwargs.items()})
+            for k, row in enumerate(rows):
+                out[k, start:stop] = results[row]
+        return out
+
+    # Per-pixel inputs and the outputs are passed to the workers in shared memory
+    from multiprocessing import shared_memory
+    blocks = []
+
+    def share(value, shape=None):
+        if shape is None and not per_pixel(value):
+            return value
+        dtype = np.dtype(np.float64) if shape is not None else value.dtype
+        shape = shape if shape is not None else (n_pixels,)
+        shm = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * dtype.itemsize))
+        blocks.append(shm)
+        if value is not None:
+            np.ndarray(shape, dtype, buffer=shm.buf)[...] = value
+        return _shared_array(shm.name, dtype.str, shape)
+
+    try:
+        shared_args = [share(a) for a in args]
+        shared_kwargs = {k: share(v) for k, v in kwargs.items()}
+        outputs = share(None, (len(rows), n_pixels))
+        executor = _process_pool(workers)
+        futures = [executor.submit(_model_chunk, model, shared_args, shared_kwargs, rows, outputs, start, stop)
+                   for start, stop in chunks]
+        for future in futures:
+            future.result()
+        return np.array(np.ndarray(outputs.shape, outputs.dtype, buffer=blocks[-1].buf))
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+
+def _take(values, index:np.array, n_pixels:int):
+    """Selects pixels of the per-pixel values of a list or dict of model arguments."""
+    take = lambda v: np.take(v, index) if isinstance(v, np.ndarray) and v.shape == (n_pixels,) else v
+    if isinstance(values, dict):
+        return {k: take(v) for k, v in values.items()}
+    return [take(v) for v in values]
+
+
+def _run_stability_model(model:str, args:list, kwargs:dict, rows:list, n_pixels:int, prior_mol:np.array = None,
+    stability_threshold:float = STABILITY_THRESHOLD, workers:int = None, chunk_size:int = CHUNK_SIZE):
+    """Runs a pyTSEB model, optionally warm started from the Monin-Obukhov length of a previous acquisition.
+
+    With prior_mol, the model is first run with the Monin-Obukhov length fixed to the prior, which is a single
+    stability iteration. Pixels where the length computed from the resulting fluxes differs from the prior by
+    less than stability_threshold (relative) accept the prior and are kept. The other pixels, and those without a
+    prior, are run again with the full stability iteration, so they cost one more pass than a run without prior.
+    This is a prior-acceptance check: at the default threshold, pyTSEB's own convergence tolerance, a length from
+    another acquisition is rarely that close, and the run can then take longer than without prior. A larger
+    threshold keeps more pixels at the cost of fluxes further from the converged ones. Only the Monin-Obukhov
+    length is taken from the prior: pyTSEB derives the friction velocity from it and the wind profile, so a prior
+    friction velocity is not used.
+
+    The number of kept and rerun pixels is printed. The chunk_max_iterations output of a pixel is 1 if its prior
+    was kept, otherwise the iterations of the slowest pixel of its chunk in the full run, plus 1 if a prior was
+    tried. It is an upper bound shared by the chunk, not the iterations of the pixel.
+
+    Args:
+        model (str): Name of the pyTSEB.TSEB model function, OSEB or TSEB_PT
+        args (list): Positional model arguments. 1-D arrays of n_pixels values are per-pixel inputs
+        kwargs (dict): Keyword model arguments. 1-D arrays of n_pixels values are per-pixel inputs
+        rows (list): Indices of the model outputs to keep
+        n_pixels (int): Number of pixels to run the model on
+        prior_mol (np.array, optional): Monin-Obukhov length of a previous run [m], NaN where unknown. Defaults to None
+        stability_threshold (float, optional): Relative difference to the prior Monin-Obukhov length accepted as converged. Defaults to STABILITY_THRESHOLD
+        workers (int, optional): Number of worker processes. 1 runs the model in this process. Defaults to all cores
+        chunk_size (int, optional): Number of pixels per chunk. Defaults to CHUNK_SIZE
+
+    Returns:
+        np.array: Kept model outputs, with shape (len(rows), n_pixels). The chunk_max_iterations output holds
+            the upper bound of the stability iterations of every pixel
+    """
+    if prior_mol is None:
+        return _run_model(model, args, kwargs, rows, n_pixels, workers, chunk_size)
+    h_rows, le_rows, u_row, it_row, meteo_args = _STABILITY_OUTPUTS[model]
+
+    import pyTSEB.MO_similarity as mo
+    import pyTSEB.meteo_utils as met
+
+    needed = list(dict.fromkeys(rows + h_rows + le_rows + [u_row, it_row]))
+    out = np.empty((len(needed), n_pixels))
+    iterations = np.zeros(n_pixels)
+    warm = np.flatnonzero(~np.isnan(prior_mol))
+    tried = np.zeros(n_pixels, bool)
+    tried[warm] = True
+    if warm.size:
+        warm_args = _take(args, warm, n_pixels) if warm.size < n_pixels else args
+        warm_kwargs = _take(kwargs, warm, n_pixels) if warm.size < n_pixels else dict(kwargs)
+        warm_kwargs["const_L"] = prior_mol[warm]
+        results = _run_model(model, warm_args, warm_kwargs, needed, warm.size, workers, chunk_size)
+
+        # Monin-Obukhov length given by the fluxes computed with the prior length
+        ta, ea, p = [warm_args[k] for k in meteo_args]
+        h = sum(results[needed.index(row)] for row in h_rows)
+        le = sum(results[needed.index(row)] for row in le_rows)
+        mol = mo.calc_L(results[needed.index(u_row)], ta, met.calc_rho(p, ea, ta), met.calc_c_p(p, ea), h, le)
+        with np.errstate(invalid="ignore"):
+            converged = np.logical_or(mol == prior_mol[warm],
+                                      np.abs(mol - prior_mol[warm]) < stability_threshold * np.abs(prior_mol[warm]))
+        out[:, warm[converged]] = results[:, converged]
+        iterations[warm[converged]] = 1
+        warm = warm[converged]
+        results = None
+
+    cold = np.setdiff1d(np.arange(n_pixels), warm)
+    if cold.size:
+        results = _run_model(model, _take(args, cold, n_pixels), _take(kwargs, cold, n_pixels), needed, cold.size,
+                             workers, chunk_size)
+        out[:, cold] = results
+        iterations[cold] = results[needed.index(it_row)] + tried[cold]
+    print("INFO: {} prior Monin-Obukhov length kept for {} of {} pixels, {} pixels rerun with the full stability "
+          "iteration".format(model, warm.size, n_pixels, cold.size))
+    out[needed.index(it_row)] = iterations
+    return out[[needed.index(row) for row in rows]]
+
+
+def _run_surrogate_model(model:str, args:list, kwargs:dict, rows:list, n_pixels:int, stratum:np.array,
+    options:sg.surrogate_options, prior_mol:np.array = None, stability_threshold:float = STABILITY_THRESHOLD,
+    workers:int = None, chunk_size:int = CHUNK_SIZE):
+    """Runs a pyTSEB model exactly on a stratified sample of the pixels and predicts the other pixels with a surrogate.
+
+    The surrogate is a regressor of the kept model outputs fitted on the per-pixel model inputs of the sample.
+    Pixels with non-finite inputs, inputs outside the range of the sample, or an uncertain or non-finite
+    prediction are run with the exact model. Predicted pixels get SURROGATE_FLAG as quality flag and 0 as
+    chunk_max_iterations.
+
+    Args:
+        model (str): Name of the pyTSEB.TSEB model function, OSEB or TSEB_PT
+        args (list): Positional model arguments. 1-D arrays of n_pixels values are per-pixel inputs
+        kwargs (dict): Keyword model arguments. 1-D arrays of n_pixels values are per-pixel inputs
+        rows (list): Indices of the model outputs to keep
+        n_pixels (int): Number of pixels to run the model on
+        stratum (np.array): Stratum index of every pixel (see surrogate.strata)
+        options (surrogate_options): Surrogate settings
+        prior_mol (np.array, optional): Monin-Obukhov length of a previous run [m] to warm start the exact runs from. Defaults to None
+        stability_threshold (float, optional): Relative difference to the prior Monin-Obukhov length accepted as converged. Defaults to STABILITY_THRESHOLD
+        workers (int, optional): Number of worker processes. 1 runs the model in this process. Defaults to all cores
+        chunk_size (int, optional): Number of pixels per chunk. Defaults to CHUNK_SIZE
+
+    Returns:
+        np.array: Kept model outputs, with shape (len(rows), n_pixels)
+    """
+    start = time.perf_counter()
+    names = _OSEB_OUTPUTS if model == "OSEB" else _TSEB_OUTPUTS
+    it_row = _STABILITY_OUTPUTS[model][3]
+    # The quality flag of the exact runs tells which sampled pixels are valid for training
+    needed = list(dict.fromkeys([0] + rows))
+    targets = [k for k, row in enumerate(needed) if row not in (0, it_row)]
+    out = np.empty((len(needed), n_pixels))
+
+    def run_exact(index):
+        if index.size:
+            out[:, index] = _run_stability_model(model, _take(args, index, n_pixels), _take(kwargs, index, n_pixels),
+                                                 needed, index.size, None if prior_mol is None else prior_mol[index],
+                                                 stability_threshold, workers, chunk_size)
+
+    per_pixel = [v for v in list(args) + list(kwargs.values()) if isinstance(v, np.ndarray) and v.shape == (n_pixels,)]
+    features = np.column_stack(per_pixel).astype(np.float32) if per_pixel else np.empty((n_pixels, 0), np.float32)
+    per_pixel = None
+    candidates = np.flatnonzero(np.all(np.isfinite(features), axis=1))
+    sample = candidates[sg.stratified_sample(stratum[candidates], options)]
+    run_exact(sample)
+    sample_time = time.perf_counter() - start
+
+    train = np.logical_and(out[0, sample] != 255, np.all(np.isfinite(out[np.ix_(targets, sample)]), axis=0))
+    if not targets or np.count_nonzero(train) < options.min_train_samples:
+        print("INFO: {} surrogate skipped, too few valid sampled pixels".format(model))
+        run_exact(np.setdiff1d(np.arange(n_pixels), sample))
+        return out[[needed.index(row) for row in rows]]
+
+    train_features = features[sample[train]]
+    train_targets = out[np.ix_(targets, sample[train])].T
+    regressor = sg.fit_surrogate(train_features, train_targets, options, workers)
+    rmse, bias = sg.surrogate_error(regressor, train_targets)
+
+    # Predict the other pixels with finite inputs inside the range of the sample
+    rest = np.setdiff1d(candidates, sample)
+    inside = np.all(np.logical_and(features[rest] >= train_features.min(axis=0),
+                                   features[rest] <= train_features.max(axis=0)), axis=1)
+    rest = rest[inside]
+    mean, spread = sg.predict_surrogate(regressor, features[rest], chunk_size)
+    features = None
+    scale = np.std(train_targets, axis=0)
+    scale[scale == 0] = 1
+    predicted = np.logical_and(np.all(spread / scale <= options.max_uncertainty, axis=1),
+                               np.all(np.isfinite(mean), axis=1))
+    out[np.ix_(targets, rest[predicted])] = mean[predicted].T
+    out[0, rest[predicted]] = SURROGATE_FLAG
+    if it_row in needed:
+        out[needed.index(it_row), rest[predicted]] = 0
+    mean = spread = None
+
+    # Exact model for the pixels that could not be predicted
+    fallback = np.setdiff1d(np.arange(n_pixels), np.concatenate([sample, rest[predicted]]))
+    run_exact(fallback)
+
+    elapsed = time.perf_counter() - start
+    speedup = sample_time / max(sample.size, 1) * n_pixels / elapsed if elapsed > 0 else float("nan")
+    print("INFO: {} surrogate: {} of {} pixels sampled, {} predicted, {} exact fallback, estimated speedup {:.1f}x".format(
+        model, sample.size, n_pixels, np.count_nonzero(predicted), fallback.size, speedup))
+    for k, target in enumerate(targets):
+        print("INFO: {} surrogate out-of-bag error of {}: RMSE {:.3f}, bias {:.3f}".format(
+            model, names[needed[target]], rmse[k], bias[k]))
+    return out[[needed.index(row) for row in rows]]
+
+
+def energy_flux_bands(save_component_fluxes:bool = True, save_component_temperature:bool = True,
+    save_aerodynamic_parameters:bool = True):
+    """Lists the bands of the energy fluxes product: the bulk fluxes and the selected groups of other bands.
+
+    Args:
+        save_component_fluxes (bool, optional): Include component fluxes. Defaults to True.
+        save_component_temperature (bool, optional): Include component temperatures. Defaults to True.
+        save_aerodynamic_parameters (bool, optional): Include aerodynamic parameters. Defaults to True.
+
+    Returns:
+        list: Band names
+    """
+    bands = list(BULK_BANDS)
+    if save_component_fluxes:
+        bands += COMPONENT_FLUX_BANDS
+    if save_component_temperature:
+        bands += COMPONENT_TEMPERATURE_BANDS
+    if save_aerodynamic_parameters:
+        bands += AERODYNAMIC_BANDS
+    return bands
+
+
+def _check_outputs(outputs:list):
+    """Checks the requested band names and returns the bands the models have to compute for them."""
+    for name in outputs:
+        if name not in BULK_BANDS + COMPONENT_FLUX_BANDS + COMPONENT_TEMPERATURE_BANDS + AERODYNAMIC_BANDS + \
+                DIAGNOSTIC_BANDS:
+            raise ValueError("Unknown energy fluxes band {}".format(name))
+    # Bands computed by the models, either requested or summed into a requested bulk flux
+    components = set(outputs).difference(_BULK_COMPONENTS)
+    for name in set(outputs).intersection(_BULK_COMPONENTS):
+        components.update(_BULK_COMPONENTS[name])
+    return components
+
+
+def _pack_inputs(inputs:dict, mask:np.array):
+    """Packs the valid pixels of the model inputs, bare soil pixels followed by vegetated pixels.
+
+    Returns:
+        packed_pixels, dict: Packed pixels and packed inputs
+    """
+    lai = inputs['lai']
+    valid = mask == 1
+    pixels = packed_pixels(np.logical_and(lai <= 0, valid), np.logical_and(lai > 0, valid))
+    return pixels, {name: pixels.pack(data) for name, data in inputs.items() if data is not None}
+
+
+def _packed_fluxes(pixels:packed_pixels, inputs:dict, outputs:list, soil_roughness:float, alpha_pt:float,
+    atmospheric_measurement_height:float, green_vegetation_emissivity:float, soil_emissivity:float,
+    stability_threshold:float, workers:int, chunk_size:int, surrogate:sg.surrogate_options = None):
+    """Runs OSEB on the packed bare soil pixels and TSEB_PT on the packed vegetated pixels.
+
+    Args:
+        pixels (packed_pixels): Packed pixels, bare soil pixels followed by vegetated pixels
+        inputs (dict): Packed model inputs, keyed by the argument names of compute_energy_fluxes
+        outputs (list): Names of the bands to compute
+        surrogate (surrogate_options, optional): Predict TSEB_PT with a surrogate model (see _run_surrogate_model). Defaults to None
+
+    Returns:
+        dict: Band name and packed data of the requested bands
+    """
+    components = _check_outputs(outputs)
+    bare, veg = pixels.groups
+    prior_mol = inputs.get('prior_mol')
+    x = lambda name, group: inputs[name][group]
+
+    # Packed bands, filled group by group
+    packed = {name: pixels.full(255, np.uint8) if name == 'quality_flag' else pixels.full() for name in components}
+    rows = [k for k, name in enumerate(_OSEB_OUTPUTS) if name in components]
+    veg_rows = [k for k, name in enumerate(_TSEB_OUTPUTS) if name in components]
+
+    # ======================================
+    # First process bare soil cases
+    if 'temperature_soil' in components:
+        packed['temperature_soil'][bare] = x('lst', bare)
+
+    # Calculate soil fluxes
+    if rows:
+        results = _run_stability_model("OSEB", [x('lst', bare),
+                                                x('ta', bare),
+                                                x('u', bare),
+                                                x('ea', bare),
+                                                x('p', bare),
+                                                x('shortwave_rad_s', bare),
+                                                x('longwave_irrad', bare),
+                                                soil_emissivity,
+                                                x('z_0M', bare),
+                                                x('d_0', bare),
+                                                atmospheric_measurement_height,
+                                                atmospheric_measurement_height],
+                                       {"calcG_params": [[1], 0.35]}, rows, bare.stop - bare.start,
+                                       None if prior_mol is None else prior_mol[bare], stability_threshold,
+                                       workers, chunk_size)
+        for k, row in enumerate(rows):
+            packed[_OSEB_OUTPUTS[row]][bare] = results[k]
+        results = None
+
+    # Set canopy fluxes to 0
+    for name in ['net_longwave_radiation_canopy', 'latent_heat_flux_canopy', 'sensible_heat_flux_canopy']:
+        if name in components:
+            packed[name][bare] = 0.0
+
+    # ======================================
+    # Then process vegetated cases
+    if veg_rows:
+        frac_green = x('frac_green', veg)
+        # Emissivity of canopy containing green and non-green elements.
+        emissivity_veg = green_vegetation_emissivity * frac_green + 0.91 * (1 - frac_green)
+
+        # Caculate component fluxes
+        args = [x('lst', veg),
+                x('vza', veg),
+                x('ta', veg),
+                x('u', veg),
+                x('ea', veg),
+                x('p', veg),
+                x('shortwave_rad_c', veg),
+                x('shortwave_rad_s', veg),
+                x('longwave_irrad', veg),
+                x('lai', veg),
+                x('veg_height', veg),
+                emissivity_veg,
+                soil_emissivity,
+                x('z_0M', veg),
+                x('d_0', veg),
+                atmospheric_measurement_height,
+                atmospheric_measurement_height]
+        kwargs = {"f_c": x('frac_cover', veg),
+                  "f_g": frac_green,
+                  "w_C": x('h_w_ratio', veg),
+                  "leaf_width": x('leaf_width', veg),
+                  "z0_soil": soil_roughness,
+                  "alpha_PT": alpha_pt,
+                  "x_LAD": x('lad', veg),
+                  "calcG_params": [[1], 0.35],
+                  "resistance_form": [0, {}]}
+        prior = None if prior_mol is None else prior_mol[veg]
+        if surrogate is None:
+            results = _run_stability_model("TSEB_PT", args, kwargs, veg_rows, veg.stop - veg.start, prior,
+                                           stability_threshold, workers, chunk_size)
+        else:
+            stratum = sg.strata(inputs['landcover'][veg] if 'landcover' in inputs else None, x('lai', veg),
+                                x('lst', veg), surrogate)
+            results = _run_surrogate_model("TSEB_PT", args, kwargs, veg_rows, veg.stop - veg.start, stratum, surrogate,
+                                           prior, stability_threshold, workers, chunk_size)
+        args = kwargs = None
+        for k, row in enumerate(veg_rows):
+            packed[_TSEB_OUTPUTS[row]][veg] = results[k]
+        results = None
+
+    # Calculate the bulk fluxes
+    if 'latent_heat_flux' in outputs:
+        packed['latent_heat_flux'] = packed['latent_heat_flux_canopy'] + packed['latent_heat_flux_soil']
+    if 'sensible_heat_flux' in outputs:
+        packed['sensible_heat_flux'] = packed['sensible_heat_flux_canopy'] + packed['sensible_heat_flux_soil']
+    if 'net_radiation' in outputs:
+        r_ns = inputs['shortwave_rad_c'] + inputs['shortwave_rad_s']
+        r_nl = packed['net_longwave_radiation_canopy'] + packed['net_longwave_radiation_soil']
+        packed['net_radiation'] = r_ns + r_nl
+    return {name: packed[name] for name in outputs}
+
+
+def _unpack_fluxes(pixels:packed_pixels, packed:dict, suffix:str = ""):
+    """Unpacks bands to scene arrays, pixels outside the mask are left empty."""
+    return {name + suffix: pixels.unpack(data, 255, np.uint8) if name == 'quality_flag' else pixels.unpack(data)
+            for name, data in packed.items()}
+
+
+def compute_energy_fluxes(lst:np.array, vza:np.array, lai:np.array, lad:np.array, frac_cover:np.array, h_w_ratio:np.array,
+    leaf_width:np.array, veg_height:np.array, frac_green:np.array, z_0M:np.array, d_0:np.array, ta:np.array, u:np.array,
+    ea:np.array, p:np.array, shortwave_rad_c:np.array, shortwave_rad_s:np.array, longwave_irrad:np.array, mask:np.array,
+    soil_roughness:float = .01, alpha_pt:float = 1.28, atmospheric_measurement_height:float = 100.0,
+    green_vegetation_emissivity:float = 0.99, soil_emissivity:float = 0.99, save_component_fluxes:bool = True,
+    save_component_temperature:bool = True, save_aerodynamic_parameters:bool = True, workers:int = None,
+    chunk_size:int = CHUNK_SIZE, outputs:list = None, prior_mol:np.array = None,
+    stability_threshold:float = STABILITY_THRESHOLD, surrogate:sg.surrogate_options = None,
+    landcover:np.array = None):
+    """Estimates land surface energy fluxes using One-Source Energy Balance model for bare soil pixels and Two-Source
+    Energy Balance model for vegetated pixels.
+
+    Only the pixels inside the mask are computed. Their inputs are packed once into contiguous 1-D arrays, bare soil
+    pixels first and vegetated pixels after them. Only the model outputs needed for the requested bands are kept,
+    and only the requested bands are unpacked to scene arrays.
+
+    Args:
+        lst (np.array): Land surface temperature [K]
+        vza (np.array): LST view zenith angle [degrees]
+        lai (np.array): Leaf area index
+        lad (np.array): Leaf inclination distribution
+        frac_cover (np.array): Vegetation fractional cover
+        h_w_ratio (np.array): Vegetation height to width ratio
+        leaf_width (np.array): Leaf width [m]
+        veg_height (np.array): Vegetation height [m]
+        frac_green (np.array): Fraction of green vegetation
+        z_0M (np.array): Roughness length for momentum transport [m]
+        d_0 (np.array): Zero-plane displacement height [m]
+        ta (np.array): Air temperature [K]
+        u (np.array): Wind speed [m/s]
+        ea (np.array): Vapour pressure [mb]
+        p (np.array): Air pressure [mb]
+        shortwave_rad_c (np.array): Canopy net shortwave radiation [W/m^{2}]
+        shortwave_rad_s (np.array): Soil net shortwave radiation [W/m^{2}]
+        longwave_irrad (np.array): Longwave irradiance [W/m^{2}]
+        mask (np.array): Sentinel-2 mask, fluxes are estimated where it is 1
+        soil_roughness (float, optional): Soil roughness [m]. Defaults to .01.
+        alpha_pt (float, optional): Alpha pt. Defaults to 1.28.
+        atmospheric_measurement_height (float, optional): Atmospheric measurement height [m]. Defaults to 100.0.
+        green_vegetation_emissivity (float, optional): Green vegetation emissivity. Defaults to 0.99.
+        soil_emissivity (float, optional): Soil emissivity. Defaults to 0.99.
+        save_component_fluxes (bool, optional): Return component fluxes data. Defaults to True.
+        save_component_temperature (bool, optional): Return component temperature data. Defaults to True.
+        save_aerodynamic_parameters (bool, optional): Return aerodynamic parameters. Defaults to True.
+        workers (int, optional): Number of worker processes running the models. 1 runs them in this process. Defaults to all cores.
+        chunk_size (int, optional): Number of pixels per chunk of model runs. Defaults to CHUNK_SIZE.
+        outputs (list, optional): Names of the bands to return (see energy_flux_bands and DIAGNOSTIC_BANDS).
+            Defaults to the bands selected by the save_* flags.
+        prior_mol (np.array, optional): Monin-Obukhov length of a previous acquisition [m] to warm start the stability
+            iteration from (see _run_stability_model). Defaults to None
+        stability_threshold (float, optional): Relative difference to the prior Monin-Obukhov length accepted as
+            converged (see _run_stability_model). Defaults to STABILITY_THRESHOLD
+        surrogate (surrogate_options, optional): Run TSEB exactly on a stratified sample of the vegetated pixels only
+            and predict the others with a surrogate model (see _run_surrogate_model). Defaults to None
+        landcover (np.array, optional): IGBP landcover classification, used to stratify the sample of the
+            surrogate. Defaults to None
+
+    Returns:
+        dict: Band name and data of the energy fluxes. The quality flag is uint8, all other bands are float32
+    """
+    if outputs is None:
+        outputs = energy_flux_bands(save_component_fluxes, save_component_temperature, save_aerodynamic_parameters)
+    inputs = {'lst': lst, 'vza': vza, 'lai': lai, 'lad': lad, 'frac_cover': frac_cover, 'h_w_ratio': h_w_ratio,
+              'leaf_width': leaf_width, 'veg_height': veg_height, 'frac_green': frac_green, 'z_0M': z_0M, 'd_0': d_0,
+              'ta': ta, 'u': u, 'ea': ea, 'p': p, 'shortwave_rad_c': shortwave_rad_c, 'shortwave_rad_s': shortwave_rad_s,
+              'longwave_irrad': longwave_irrad, 'prior_mol': prior_mol,
+              'landcover': landcover if surrogate is not None else None}
+    pixels, inputs = _pack_inputs(inputs, mask)
+    packed = _packed_fluxes(pixels, inputs, outputs, soil_roughness, alpha_pt, atmospheric_measurement_height,
+                            green_vegetation_emissivity, soil_emissivity, stability_threshold, workers, chunk_size,
+                            surrogate)
+    return _unpack_fluxes(pixels, packed)
+
+
+def compute_energy_fluxes_sweep(lst:np.array, vza:np.array, lai:np.array, lad:np.array, frac_cover:np.array,
+    h_w_ratio:np.array, leaf_width:np.array, veg_height:np.array, frac_green:np.array, z_0M:np.array, d_0:np.array,
+    ta:np.array, u:np.array, ea:np.array, p:np.array, shortwave_rad_c:np.array, shortwave_rad_s:np.array,
+    longwave_irrad:np.array, mask:np.array, parameter_sets:list, workers:int = None, chunk_size:int = CHUNK_SIZE,
+    outputs:list = None, prior_mol:np.array = None, stability_threshold:float = STABILITY_THRESHOLD):
+    """Estimates land surface energy fluxes for several sets of model parameters.
+
+    The inputs are masked and packed once and the models are run for every parameter set on the packed pixels, so
+    the results are the same as calling compute_energy_fluxes once per parameter set. Only the masking and packing
+    are shared: the parameter sets run one after another. The bands of all sets are returned together, use
+    iter_energy_fluxes_sweep to handle the bands of every set as soon as it finishes.
+
+    Args:
+        lst (np.array): Land surface temperature [K]
+        vza (np.array): LST view zenith angle [degrees]
+        lai (np.array): Leaf area index
+        lad (np.array): Leaf inclination distribution
+        frac_cover (np.array): Vegetation fractional cover
+        h_w_ratio (np.array): Vegetation height to width ratio
+        leaf_width (np.array): Leaf width [m]
+        veg_height (np.array): Vegetation height [m]
+        frac_green (np.array): Fraction of green vegetation
+        z_0M (np.array): Roughness length for momentum transport [m]
+        d_0 (np.array): Zero-plane displacement height [m]
+        ta (np.array): Air temperature [K]
+        u (np.array): Wind speed [m/s]
+        ea (np.array): Vapour pressure [mb]
+        p (np.array): Air pressure [mb]
+        shortwave_rad_c (np.array): Canopy net shortwave radiation [W/m^{2}]
+        shortwave_rad_s (np.array): Soil net shortwave radiation [W/m^{2}]
+        longwave_irrad (np.array): Longwave irradiance [W/m^{2}]
+        mask (np.array): Sentinel-2 mask, fluxes are estimated where it is 1
+        parameter_sets (list): Dicts of model parameters (see SWEEP_PARAMETERS), missing parameters take the defaults
+            of compute_energy_fluxes
+        workers (int, optional): Number of worker processes running the models. 1 runs them in this process. Defaults to all cores.
+        chunk_size (int, optional): Number of pixels per chunk of model runs. Defaults to CHUNK_SIZE.
+        outputs (list, optional): Names of the bands to return (see energy_flux_bands and DIAGNOSTIC_BANDS).
+            Defaults to BULK_BANDS.
+        prior_mol (np.array, optional): Monin-Obukhov length of a previous acquisition [m] to warm start the stability
+            iteration from (see _run_stability_model). Defaults to None
+        stability_threshold (float, optional): Relative difference to the prior Monin-Obukhov length accepted as
+            converged (see _run_stability_model). Defaults to STABILITY_THRESHOLD
+
+    Returns:
+        dict: Band name and data of the energy fluxes, the band names of the k-th parameter set end with _k
+    """
+    bands = {}
+    for _, set_bands in iter_energy_fluxes_sweep(lst, vza, lai, lad, frac_cover, h_w_ratio, leaf_width, veg_height,
+                                                 frac_green, z_0M, d_0, ta, u, ea, p, shortwave_rad_c, shortwave_rad_s,
+                                                 longwave_irrad, mask, parameter_sets, workers, chunk_size, outputs,
+                                                 prior_mol, stability_threshold):
+        bands.update(set_bands)
+    return bands
+
+
+def iter_energy_fluxes_sweep(lst:np.array, vza:np.array, lai:np.array, lad:np.array, frac_cover:np.array,
+    h_w_ratio:np.array, leaf_width:np.array, veg_height:np.array, frac_green:np.array, z_0M:np.array, d_0:np.array,
+    ta:np.array, u:np.array, ea:np.array, p:np.array, shortwave_rad_c:np.array, shortwave_rad_s:np.array,
+    longwave_irrad:np.array, mask:np.array, parameter_sets:list, workers:int = None, chunk_size:int = CHUNK_SIZE,
+    outputs:list = None, prior_mol:np.array = None, stability_threshold:float = STABILITY_THRESHOLD):
+    """Estimates land surface energy fluxes for several sets of model parameters, one set at a time.
+
+    Takes the arguments of compute_energy_fluxes_sweep. The inputs are masked and packed once, then the bands of
+    every parameter set are yielded as soon as its models finished, so that only one set is held in memory if the
+    caller writes or discards them before asking for the next one.
+
+    Yields:
+        tuple: Index of the parameter set and dict of its band names (ending with _k for the k-th set) and data
+    """
+    if outputs is None:
+        outputs = BULK_BANDS
+    _check_outputs(outputs)
+    for parameters in parameter_sets:
+        for name in parameters:
+            if name not in SWEEP_PARAMETERS:
+                raise ValueError("Unknown energy fluxes parameter {}, must be one of {}".format(name, list(SWEEP_PARAMETERS)))
+    inputs = {'lst': lst, 'vza': vza, 'lai': lai, 'lad': lad, 'frac_cover': frac_cover, 'h_w_ratio': h_w_ratio,
+              'leaf_width': leaf_width, 'veg_height': veg_height, 'frac_green': frac_green, 'z_0M': z_0M, 'd_0': d_0,
+              'ta': ta, 'u': u, 'ea': ea, 'p': p, 'shortwave_rad_c': shortwave_rad_c, 'shortwave_rad_s': shortwave_rad_s,
+              'longwave_irrad': longwave_irrad, 'prior_mol': prior_mol}
+    pixels, inputs = _pack_inputs(inputs, mask)
+    for k, parameters in enumerate(parameter_sets):
+        parameters = dict(SWEEP_PARAMETERS, **parameters)
+        packed = _packed_fluxes(pixels, inputs, outputs, stability_threshold=stability_threshold, workers=workers,
+                                chunk_size=chunk_size, **parameters)
+        yield k, _unpack_fluxes(pixels, packed, "_{}".format(k))
+
+
+def _input_products(lst:str, lst_vza:str, lai:str, csp:str, fgv:str, ar:str, mi:str, nsr:str, li:str, mask:str,
+    prior_fluxes:str = None, landcover:bool = False):
+    """Products and bands read by energy_fluxes and energy_fluxes_sweep."""
+    products = [
+        (lst, ['sharpened_LST']),
+        (lst_vza, ['sat_zenith_tn']),
+        (lai, ['lai']),
+        (csp, ['veg_inclination_distribution', 'veg_fractional_cover', 'veg_height_width_ratio',
+               'veg_leaf_width', 'veg_height']),
+        (fgv, ['frac_green']),
+        (ar, ['roughness_length', 'zero_plane_displacement']),
+        (mi, ['air_temperature', 'wind_speed', 'vapour_pressure', 'air_pressure']),
+        (nsr, ['net_shortwave_radiation_canopy', 'net_shortwave_radiation_soil']),
+        (li, ['longwave_irradiance']),
+        (mask, ['mask'])
+    ]
+    if prior_fluxes is not None:
+        products.append((prior_fluxes, ['monin_obukhov_length']))
+    if landcover:
+        products.append((csp, ['igbp_classification']))
+    return products
+
 
 def energy_fluxes(lst:str, lst_vza:str, lai:str, csp:str, fgv:str, ar:str, mi:str, nsr:str, li:str, mask:str, output_file:str, soil_roughness:float = .01, alpha_pt:float = 1.28,
     atmospheric_measurement_height:float = 100.0, green_vegetation_emissivity:float = 0.99, soil_emissivity:float = 0.99, save_component_fluxes:bool = True,
-    save_component_temperature:bool = True, save_aerodynamic_parameters:bool = True):
+    save_component_temperature:bool = True, save_aerodynamic_parameters:bool = True, block_size:int = None,
+    workers:int = None, chunk_size:int = CHUNK_SIZE, outputs:list = None, prior_fluxes:str = None,
+    stability_threshold:float = STABILITY_THRESHOLD, surrogate:sg.surrogate_options = None):
     """Estimates land surface energy fluxes (latent, sensible, ground heat and net radiation) using One-Source Energy Balance model for bare soil pixels and Two-Source Energy Balance
     model for vegetated pixels.
 
@@ -29,154 +732,106 @@ def energy_fluxes(lst:str, lst_vza:str, lai:str, csp:str, fgv:str, ar:str, mi:st
         save_component_fluxes (bool, optional): Save component fluxes data. Defaults to True.
         save_component_temperature (bool, optional): Save component temperature data. Defaults to True.
         save_aerodynamic_parameters (bool, optional): Save aerodynamic parameters. Defaults to True.
+        block_size (int, optional): Process the scene in blocks of block_size x block_size pixels to bound memory use. Defaults to the whole scene
+        workers (int, optional): Number of worker processes running the models. 1 runs them in this process. Defaults to all cores.
+        chunk_size (int, optional): Number of pixels per chunk of model runs. Defaults to CHUNK_SIZE.
+        outputs (list, optional): Names of the bands to save (see energy_flux_bands and DIAGNOSTIC_BANDS). Defaults to
+            the bands selected by the save_* flags.
+        prior_fluxes (str, optional): Energy fluxes product of a previous acquisition of the same tile, with the
+            monin_obukhov_length band, to warm start the stability iteration from (see _run_stability_model). Its
+            friction velocity is not used. Defaults to None
+        stability_threshold (float, optional): Relative difference to the prior Monin-Obukhov length accepted as
+            converged (see _run_stability_model). Defaults to STABILITY_THRESHOLD
+        surrogate (surrogate_options, optional): Quick-look mode: run TSEB exactly on a sample of the vegetated pixels,
+            stratified by landcover, LAI and LST, and predict the others with a surrogate model. Defaults to None
     """
-    # Read the required data
-    lst = su.read_snappy_product(lst, 'sharpened_LST')[0].astype(np.float32)
-    vza = su.read_snappy_product(lst_vza, 'sat_zenith_tn')[0].astype(np.float32)
-    lai, geo_coding = su.read_snappy_product(lai, 'lai')
-    lai = lai.astype(np.float32)
-    lad = su.read_snappy_product(csp, 'veg_inclination_distribution')[0].astype(np.float32)
-    frac_cover = su.read_snappy_product(csp, 'veg_fractional_cover')[0].astype(np.float32)
-    h_w_ratio = su.read_snappy_product(csp, 'veg_height_width_ratio')[0].astype(np.float32)
-    leaf_width = su.read_snappy_product(csp, 'veg_leaf_width')[0].astype(np.float32)
-    veg_height = su.read_snappy_product(csp, 'veg_height')[0].astype(np.float32)
-    landcover_band = su.read_snappy_product(csp, 'igbp_classification')[0].astype(np.float32)
-    frac_green = su.read_snappy_product(fgv, 'frac_green')[0].astype(np.float32)
-    z_0M = su.read_snappy_product(ar, 'roughness_length')[0].astype(np.float32)
-    d_0 = su.read_snappy_product(ar, 'zero_plane_displacement')[0].astype(np.float32)
-    ta = su.read_snappy_product(mi, 'air_temperature')[0].astype(np.float32)
-    u = su.read_snappy_product(mi, 'wind_speed')[0].astype(np.float32)
-    ea = su.read_snappy_product(mi, 'vapour_pressure')[0].astype(np.float32)
-    p = su.read_snappy_product(mi, 'air_pressure')[0].astype(np.float32)
-    shortwave_rad_c = su.read_snappy_product(nsr, 'net_shortwave_radiation_canopy')[0].astype(np.float32)
-    shortwave_rad_s = su.read_snappy_product(nsr, 'net_shortwave_radiation_soil')[0].astype(np.float32)
-    longwave_irrad = su.read_snappy_product(li, 'longwave_irradiance')[0].astype(np.float32)
-    mask = su.read_snappy_product(mask, 'mask')[0].astype(np.float32)
-
-    # Model outputs
-    t_s = np.full(lai.shape, np.nan, np.float32)
-    t_c = np.full(lai.shape, np.nan, np.float32)
-    t_ac = np.full(lai.shape, np.nan, np.float32)
-    h_s = np.full(lai.shape, np.nan, np.float32)
-    h_c = np.full(lai.shape, np.nan, np.float32)
-    le_s = np.full(lai.shape, np.nan, np.float32)
-    le_c = np.full(lai.shape, np.nan, np.float32)
-    g = np.full(lai.shape, np.nan, np.float32)
-    ln_s = np.full(lai.shape, np.nan, np.float32)
-    ln_c = np.full(lai.shape, np.nan, np.float32)
-    r_s = np.full(lai.shape, np.nan, np.float32)
-    r_x = np.full(lai.shape, np.nan, np.float32)
-    r_a = np.full(lai.shape, np.nan, np.float32)
-    u_friction = np.full(lai.shape, np.nan, np.float32)
-    mol = np.full(lai.shape, np.nan, np.float32)
-    n_iterations = np.full(lai.shape, np.nan, np.float32)
-    flag = np.full(lai.shape, 255)
+    def compute(bands):
+        ([lst], [vza], [lai], [lad, frac_cover, h_w_ratio, leaf_width, veg_height],
+         [frac_green], [z_0M, d_0], [ta, u, ea, p], [shortwave_rad_c, shortwave_rad_s],
+         [longwave_irrad], [mask]) = bands[:10]
+        extra = [b for [b] in bands[10:]]
+        prior_mol = extra.pop(0) if prior_fluxes is not None else None
+        landcover = extra.pop(0) if surrogate is not None else None
+        return {'turbulentFluxes': compute_energy_fluxes(lst, vza, lai, lad, frac_cover, h_w_ratio, leaf_width, veg_height,
+                                                         frac_green, z_0M, d_0, ta, u, ea, p, shortwave_rad_c,
+                                                         shortwave_rad_s, longwave_irrad, mask, soil_roughness, alpha_pt,
+                                                         atmospheric_measurement_height, green_vegetation_emissivity,
+                                                         soil_emissivity, save_component_fluxes,
+                                                         save_component_temperature, save_aerodynamic_parameters,
+                                                         workers, chunk_size, outputs, prior_mol,
+                                                         stability_threshold, surrogate, landcover)}
 
-    # ======================================
-    # First process bare soil cases
-    i = np.logical_and(lai <= 0, mask == 1)
-    t_s[i] = lst[i]
+    # Read the required data block by block, opening each product only once per block
+    products = _input_products(lst, lst_vza, lai, csp, fgv, ar, mi, nsr, li, mask, prior_fluxes, surrogate is not None)
+    su.map_blocks(products, compute, {'turbulentFluxes': (output_file, 'turbulentFluxes')}, block_size,
+                  geo_coding_product=2)
 
-    # Calculate soil fluxes
-    [flag[i], ln_s[i], le_s[i], h_s[i], g[i], r_a[i], u_friction[i], mol[i],
-    n_iterations[i]] = TSEB.OSEB(lst[i],
-                                 ta[i],
-                                 u[i],
-                                 ea[i],
-                                 p[i],
-                                 shortwave_rad_s[i],
-                                 longwave_irrad[i],
-                                 soil_emissivity,
-                                 z_0M[i],
-                                 d_0[i],
-                                 atmospheric_measurement_height,
-                                 atmospheric_measurement_height,
-                                 calcG_params=[[1], 0.35])
 
-    # Set canopy fluxes to 0
-    ln_c[i] = 0.0
-    le_c[i] = 0.0
-    h_c[i] = 0.0
+def energy_fluxes_sweep(lst:str, lst_vza:str, lai:str, csp:str, fgv:str, ar:str, mi:str, nsr:str, li:str, mask:str,
+    output_file:str, parameter_sets:list, outputs:list = None, block_size:int = None, workers:int = None,
+    chunk_size:int = CHUNK_SIZE, prior_fluxes:str = None, stability_threshold:float = STABILITY_THRESHOLD):
+    """Estimates land surface energy fluxes for several sets of model parameters, e.g. for calibration.
 
-    # ======================================
-    # Then process vegetated cases
-    i = np.logical_and(lai > 0, mask == 1)
-    # Emissivity of canopy containing green and non-green elements.
-    emissivity_veg = green_vegetation_emissivity * frac_green[i] + 0.91 * (1 - frac_green[i])
-
-    # Caculate component fluxes
-    [flag[i], t_s[i], t_c[i], t_ac[i], ln_s[i], ln_c[i], le_c[i], h_c[i], le_s[i], h_s[i],
-    g[i], r_s[i], r_x[i], r_a[i], u_friction[i], mol[i],
-    n_iterations[i]] = TSEB.TSEB_PT(lst[i],
-                                    vza[i],
-                                    ta[i],
-                                    u[i],
-                                    ea[i],
-                                    p[i],
-                                    shortwave_rad_c[i],
-                                    shortwave_rad_s[i],
-                                    longwave_irrad[i],
-                                    lai[i],
-                                    veg_height[i],
-                                    emissivity_veg,
-                                    soil_emissivity,
-                                    z_0M[i],
-                                    d_0[i],
-                                    atmospheric_measurement_height,
-                                    atmospheric_measurement_height,
-                                    f_c=frac_cover[i],
-                                    f_g=frac_green[i],
-                                    w_C=h_w_ratio[i],
-                                    leaf_width=leaf_width[i],
-                                    z0_soil=soil_roughness,
-                                    alpha_PT=alpha_pt,
-                                    x_LAD=lad[i],
-                                    calcG_params=[[1], 0.35],
-                                    resistance_form=[0, {}])
+    The inputs are read, masked and packed once for all parameter sets. Only this input I/O and packing is shared:
+    the parameter sets run one after another and the bands of every set are written to the product as soon as the
+    set finishes, so that one set of output bands is held in memory at a time. The bands of all parameter sets are
+    written to a single product, the band names of the k-th parameter set end with _k.
 
-    # Calculate the bulk fluxes
-    le = le_c + le_s
-    h = h_c + h_s
-    r_ns = shortwave_rad_c + shortwave_rad_s
-    r_nl = ln_c + ln_s
-    r_n = r_ns + r_nl
-
-    band_data = [
-            {'band_name': 'sensible_heat_flux', 'band_data': h},
-            {'band_name': 'latent_heat_flux', 'band_data': le},
-            {'band_name': 'ground_heat_flux', 'band_data': g},
-            {'band_name': 'net_radiation', 'band_data': r_n},
-            {'band_name': 'quality_flag', 'band_data': flag}
-            ]
+    Args:
+        lst (str): Sharpened land surface temperature product (from sharpen)
+        lst_vza (str): LST view zenith angle product (from S3 wrap)
+        lai (str): Plant biophysical properties product
+        csp (str): Vegetation structural parameters product
+        fgv (str): Fraction of green vegetation product
+        ar (str): Aerodynamic roughness product
+        mi (str): Meteorological inputs product (from prepare)
+        nsr (str): Net shortwave radiation product
+        li (str): Longwave irradiance product
+        mask (str): Sentinel-2 mask product
+        output_file (str): Path to store the stacked land surface energy fluxes product
+        parameter_sets (list): Dicts of model parameters (see SWEEP_PARAMETERS), missing parameters take their defaults
+        outputs (list, optional): Names of the bands to save for every parameter set. Defaults to BULK_BANDS.
+        block_size (int, optional): Process the scene in blocks of block_size x block_size pixels to bound memory use. Defaults to the whole scene
+        workers (int, optional): Number of worker processes running the models. 1 runs them in this process. Defaults to all cores.
+        chunk_size (int, optional): Number of pixels per chunk of model runs. Defaults to CHUNK_SIZE.
+        prior_fluxes (str, optional): Energy fluxes product of a previous acquisition of the same tile to warm start
+            the stability iteration from. Defaults to None
+        stability_threshold (float, optional): Relative difference to the prior Monin-Obukhov length accepted as
+            converged (see _run_stability_model). Defaults to STABILITY_THRESHOLD
+    """
+    for k, parameters in enumerate(parameter_sets):
+        print("INFO: Energy fluxes parameter set {}: {}".format(k, dict(SWEEP_PARAMETERS, **parameters)))
 
-    if save_component_fluxes:
-        band_data.extend(
-                [
-                    {'band_name': 'sensible_heat_flux_canopy', 'band_data': h_c},
-                    {'band_name': 'sensible_heat_flux_soil', 'band_data': h_s},
-                    {'band_name': 'latent_heat_flux_canopy', 'band_data': le_c},
-                    {'band_name': 'latent_heat_flux_soil', 'band_data': le_s},
-                    {'band_name': 'net_longwave_radiation_canopy', 'band_data': ln_c},
-                    {'band_name': 'net_longwave_radiation_soil', 'band_data': ln_s}
-                ]
-        )
-    if save_component_temperature:
-        band_data.extend(
-                [
-                    {'band_name': 'temperature_canopy', 'band_data': t_c}, 
-                    {'band_name': 'temperature_soil', 'band_data': t_s},
-                    {'band_name': 'temperature_canopy_air', 'band_data': t_ac}
-                ]
-        )
-    if save_aerodynamic_parameters:
-        band_data.extend(
-                [ 
-                    {'band_name': 'resistance_surface', 'band_data': r_a}, 
-                    {'band_name': 'resistance_canopy', 'band_data': r_x},
-                    {'band_name': 'resistance_soil', 'band_data': r_s},
-                    {'band_name': 'friction_velocity', 'band_data': u_friction},
-                    {'band_name': 'monin_obukhov_length', 'band_data': mol}
-                ]
-        )
-    
-    su.write_snappy_product(output_file, band_data, 'turbulentFluxes', geo_coding)
+    products = _input_products(lst, lst_vza, lai, csp, fgv, ar, mi, nsr, li, mask, prior_fluxes)
+    template = products[2][0]
+    geo_coding, _, width, height = su.get_product_info(template)[1:]
+    windows = [None] if block_size is None else su.block_windows(template, block_size)
+    product = None
+    try:
+        for window in windows:
+            bands = [b for b, _ in su.read_snappy_products(products, window=window)]
+            ([lst_data], [vza], [lai_data], [lad, frac_cover, h_w_ratio, leaf_width, veg_height],
+             [frac_green], [z_0M, d_0], [ta, u, ea, p], [shortwave_rad_c, shortwave_rad_s],
+             [longwave_irrad], [mask_data]) = bands[:10]
+            prior_mol = bands[10][0] if prior_fluxes is not None else None
+            bands = None
+            sweep = iter_energy_fluxes_sweep(lst_data, vza, lai_data, lad, frac_cover, h_w_ratio, leaf_width, veg_height,
+                                             frac_green, z_0M, d_0, ta, u, ea, p, shortwave_rad_c, shortwave_rad_s,
+                                             longwave_irrad, mask_data, parameter_sets, workers, chunk_size, outputs,
+                                             prior_mol, stability_threshold)
+            for k, set_bands in sweep:
+                band_data = [{'band_name': name, 'band_data': data} for name, data in set_bands.items()]
+                set_bands = None
+                if product is None:
+                    # The bands of the first set stand in for the band names and data types of all sets
+                    suffix = "_{}".format(k)
+                    all_bands = [{'band_name': b['band_name'][:-len(suffix)] + "_{}".format(j), 'band_data': b['band_data']}
+                                 for j in range(len(parameter_sets)) for b in band_data]
+                    product = su.create_snappy_product(output_file, all_bands, 'turbulentFluxes', geo_coding, width,
+                                                       height)
+                    all_bands = None
+                su.write_snappy_product(output_file, band_data, 'turbulentFluxes', geo_coding, window, product)
+                band_data = None
+    finally:
+        if product is not None:
+            su.close_snappy_product(product)
@@ -0,0 +1,136 @@
+import os
+import functools
+import numpy as np
+
+# Default grid of the table: sun zenith angle [degrees] and effective leaf area index (LAI / fraction of green vegetation)
+SZA_MAX = 80.
+SZA_STEP = 0.25
+LAI_MAX = 16.
+LAI_STEP = 0.01
+
+
+def _campbell(sza:np.array, lai:np.array, w_C:float, Omega0:float, x_LAD:float):
+    from pyTSEB import TSEB
+
+    return TSEB.calc_F_theta_campbell(sza, lai, w_C=w_C, Omega0=Omega0, x_LAD=x_LAD)
+
+
+class fipar_table():
+    """Table of the fraction of intercepted PAR of pyTSEB calc_F_theta_campbell for fixed structural parameters,
+    evaluated with bilinear interpolation in sun zenith angle and effective LAI.
+
+    Pixels outside of the grid (or with missing values) are evaluated with the exact function. max_error is an
+    empirical bound: the largest absolute error measured at the cell centres and edge midpoints of the grid, where
+    the bilinear error of a smooth function typically peaks. It is not a guaranteed bound for every point of a cell.
+    """
+
+    def __init__(self, w_C:float = 1, Omega0:float = 1, x_LAD:float = 1, sza_max:float = SZA_MAX,
+                 sza_step:float = SZA_STEP, lai_max:float = LAI_MAX, lai_step:float = LAI_STEP, cache_file:str = None):
+        """
+        Args:
+            w_C (float, optional): Canopy width to height ratio. Defaults to 1
+            Omega0 (float, optional): Nadir view clumping index. Defaults to 1
+            x_LAD (float, optional): Chi parameter of the leaf angle distribution. Defaults to 1
+            sza_max (float, optional): Largest sun zenith angle of the grid [degrees]. Defaults to SZA_MAX
+            sza_step (float, optional): Sun zenith angle step of the grid [degrees]. Defaults to SZA_STEP
+            lai_max (float, optional): Largest effective LAI of the grid. Defaults to LAI_MAX
+            lai_step (float, optional): Effective LAI step of the grid. Defaults to LAI_STEP
+            cache_file (str, optional): File the table is loaded from, or saved to if it does not exist or was built
+                with other settings. Defaults to building the table without a cache
+        """
+        self.parameters = np.array([w_C, Omega0, x_LAD, sza_max, sza_step, lai_max, lai_step], np.float64)
+        self.sza = np.linspace(0, sza_max, int(round(sza_max / sza_step)) + 1)
+        self.lai = np.linspace(0, lai_max, int(round(lai_max / lai_step)) + 1)
+        if cache_file is not None and os.path.exists(cache_file):
+            with np.load(cache_file) as cache:
+                if np.array_equal(cache["parameters"], self.parameters):
+                    self.values, self.max_error = cache["values"], float(cache["max_error"])
+                    self.corners = self._corners()
+                    return
+        self.values = _campbell(*np.meshgrid(self.sza, self.lai, indexing="ij"), w_C, Omega0, x_LAD)
+        self.values = np.asarray(self.values, np.float64)
+        self.corners = self._corners()
+        self.max_error = self._max_error()
+        if cache_file is not None:
+            tmp_file = "{}.{}.tmp".format(cache_file, os.getpid())
+            with open(tmp_file, "wb") as fp:
+                np.savez(fp, parameters=self.parameters, values=self.values, max_error=self.max_error)
+            os.replace(tmp_file, cache_file)
+
+    def _max_error(self):
+        """Largest absolute interpolation error on the grid of the cell centres and edge midpoints."""
+        w_C, Omega0, x_LAD = self.parameters[:3]
+        sza = np.linspace(0, self.sza[-1], 2 * len(self.sza) - 1)
+        max_error = 0.
+        # Row by row to bound the memory of the refined grid
+        for row in sza:
+            lai = np.linspace(0, self.lai[-1], 2 * len(self.lai) - 1)
+            exact = _campbell(np.full(len(lai), row), lai, w_C, Omega0, x_LAD)
+            max_error = max(max_error, float(np.max(np.abs(self._interpolate(np.full(len(lai), row), lai) - exact))))
+        return max_error
+
+    def _corners(self):
+        """Values and LAI slopes of the lower and upper sun zenith angle rows of every cell, stored together
+        so that a single gather per pixel fetches the whole cell."""
+        values = self.values.astype(np.float32)
+        slopes = np.diff(values, axis=1, append=values[:, -1:])
+        return np.stack([values[:-1], slopes[:-1], values[1:], slopes[1:]], axis=-1).reshape(-1, 4)
+
+    def _interpolate(self, sza:np.array, lai:np.array):
+        n_sza, n_lai = self.values.shape
+        x = np.multiply(sza, np.float32((n_sza - 1) / self.sza[-1]), dtype=np.float32)
+        y = np.multiply(lai, np.float32((n_lai - 1) / self.lai[-1]), dtype=np.float32)
+        i = x.astype(np.intp)
+        np.minimum(i, n_sza - 2, out=i)
+        j = y.astype(np.intp)
+        np.minimum(j, n_lai - 2, out=j)
+        x -= i
+        y -= j
+        i *= n_lai
+        i += j
+        cell = np.take(self.corners, i, axis=0)
+        bottom = cell[:, 1] * y
+        bottom += cell[:, 0]
+        top = cell[:, 3] * y
+        top += cell[:, 2]
+        top -= bottom
+        top *= x
+        bottom += top
+        return bottom
+
+    def __call__(self, sza:np.array, lai:np.array):
+        """Fraction of intercepted PAR.
+
+        Args:
+            sza (np.array): Sun zenith angle [degrees]
+            lai (np.array): Effective leaf area index
+
+        Returns:
+            np.array: Fraction of intercepted PAR (float32), interpolated on the grid (see max_error)
+        """
+        sza, lai = np.broadcast_arrays(np.asarray(sza), np.asarray(lai))
+        shape = sza.shape
+        sza, lai = sza.reshape(-1), lai.reshape(-1)
+        inside = (sza >= self.sza[0]) & (sza <= self.sza[-1]) & (lai >= self.lai[0]) & (lai <= self.lai[-1])
+        if np.all(inside):
+            return self._interpolate(sza, lai).reshape(shape)
+        fipar = np.empty(sza.shape, np.float32)
+        fipar[inside] = self._interpolate(sza[inside], lai[inside])
+        fipar[~inside] = _campbell(sza[~inside], lai[~inside], *self.parameters[:3])
+        return fipar.reshape(shape)
+
+
+@functools.lru_cache(maxsize=None)
+def get_fipar_table(cache_file:str = None, w_C:float = 1, Omega0:float = 1, x_LAD:float = 1):
+    """Returns the table of calc_F_theta_campbell with the default grid, built once per process.
+
+    Args:
+        cache_file (str, optional): File the table is loaded from or saved to. Defaults to no cache file
+        w_C (float, optional): Canopy width to height ratio. Defaults to 1
+        Omega0 (float, optional): Nadir view clumping index. Defaults to 1
+        x_LAD (float, optional): Chi parameter of the leaf angle distribution. Defaults to 1
+
+    Returns:
+        fipar_table: Table of the fraction of intercepted PAR
+    """
+    return fipar_table(w_C, Omega0, x_LAD, cache_file=cache_file)
@@ -1,8 +1,113 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-from pyTSEB import TSEB
 import senet.core.snappy_utils as su
+from senet.core.packed_pixels import packed_pixels
+from senet.core.fipar_table import fipar_table
 
-def fraction_green(sza_file:str, biophysical_file:str, min_frac_green:float, output_file:str):
+# Maximum number of fixed-point iterations of the fraction of green vegetation
+MAX_ITERATIONS = 50
+# Change of the fraction of green vegetation below which a pixel has converged
+TOLERANCE = 0.02
+# Number of pixels per chunk iterated in parallel
+CHUNK_SIZE = 65536
+
+def _converge_chunk(sza:np.array, fapar:np.array, lai:np.array, min_frac_green:float, fipar_table:fipar_table = None):
+    """Runs the fixed-point iteration of the fraction of green vegetation on 1-D arrays of pixels.
+
+    Only the unconverged pixels are kept in the compact arrays of every iteration, so the cost of an
+    iteration depends on the number of unconverged pixels.
+
+    Args:
+        fipar_table (fipar_table, optional): Table evaluating calc_F_theta_campbell. Defaults to the exact function
+
+    Returns:
+        np.array, list: Fraction of green vegetation and number of unconverged pixels of every iteration
+    """
+    from pyTSEB import TSEB
+
+    f_g = np.ones(len(lai), np.float32)
+    active = np.arange(len(lai))
+    f_g_active = f_g[active]
+    sizes = []
+    for c in range(MAX_ITERATIONS):
+        if active.size == 0:
+            break
+        sizes.append(active.size)
+        if fipar_table is None:
+            fipar = TSEB.calc_F_theta_campbell(sza, lai / f_g_active, w_C=1, Omega0=1, x_LAD=1)
+        else:
+            fipar = fipar_table(sza, lai / f_g_active)
+        f_g_new = np.clip((fapar / fipar).astype(np.float32), min_frac_green, 1.)
+        f_g[active] = f_g_new
+        # Keep the pixels that did not converge
+        keep = ~np.logical_or(np.isnan(f_g_new), np.abs(f_g_new - f_g_active) < TOLERANCE)
+        active, sza, fapar, lai, f_g_active = active[keep], sza[keep], fapar[keep], lai[keep], f_g_new[keep]
+    return f_g, sizes
+
+def converge_fraction_green(sza:np.array, fapar:np.array, lai:np.array, min_frac_green:float, workers:int = None,
+    chunk_size:int = CHUNK_SIZE, fipar_table:fipar_table = None):
+    """Iterates the fraction of vegetation which is green until it converges, in parallel chunks of pixels.
+
+    Args:
+        sza (np.array): Sun zenith angle [degrees]
+        fapar (np.array): Fraction of absorbed photosynthetically active radiation
+        lai (np.array): Leaf area index
+        min_frac_green (float): Minimum fraction of vegetation which is green. Range from 0.01 to 1
+        workers (int, optional): Number of chunks iterated at the same time. Defaults to all cores
+        chunk_size (int, optional): Number of pixels per chunk. Defaults to CHUNK_SIZE
+        fipar_table (fipar_table, optional): Table evaluating calc_F_theta_campbell, trading an interpolation error
+            within an empirical bound (see fipar_table.max_error) for speed (see get_fipar_table). Defaults to the
+            exact function
+
+    Returns:
+        np.array, list: Fraction of green vegetation and number of unconverged pixels of every iteration
+    """
+    # For pixels where LAI or FAPAR are below tolerance threshold of the S2 biophysical
+    # processor, assume that the soil is bare and f_g = 1
+    pixels = packed_pixels(~np.logical_or(lai <= 0.2, fapar <= 0.1))
+    sza, fapar, lai = pixels.pack(sza), pixels.pack(fapar), pixels.pack(lai)
+    chunks = [slice(start, start + chunk_size) for start in range(0, len(pixels), chunk_size)]
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    # Every pixel converges independently, so every chunk runs the whole iteration on its own
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(chunks)))) as executor:
+        results = list(executor.map(lambda s: _converge_chunk(sza[s], fapar[s], lai[s], min_frac_green, fipar_table), chunks))
+    f_g = np.concatenate([f for f, _ in results]) if results else pixels.full(1)
+    sizes = [0] * max([len(s) for _, s in results] + [0])
+    for _, chunk_sizes in results:
+        for c, size in enumerate(chunk_sizes):
+            sizes[c] += size
+    return pixels.unpack(f_g, 1), sizes
+
+def compute_fraction_green(sza:np.array, fapar:np.array, lai:np.array, min_frac_green:float, workers:int = None,
+    chunk_size:int = CHUNK_SIZE, fipar_table:fipar_table = None):
+    """Estimates the fraction of vegetation which is green based on the leaf area index (LAI),
+    fraction of absorbed photosynthetically active radiation (FAPAR) and sun zenith angle.
+
+    Args:
+        sza (np.array): Sun zenith angle [degrees]
+        fapar (np.array): Fraction of absorbed photosynthetically active radiation
+        lai (np.array): Leaf area index
+        min_frac_green (float): Minimum fraction of vegetation which is green. Range from 0.01 to 1
+        workers (int, optional): Number of chunks iterated at the same time. Defaults to all cores
+        chunk_size (int, optional): Number of pixels per chunk. Defaults to CHUNK_SIZE
+        fipar_table (fipar_table, optional): Table evaluating calc_F_theta_campbell, trading an interpolation error
+            within an empirical bound (see fipar_table.max_error) for speed (see get_fipar_table). Defaults to the
+            exact function
+
+    Returns:
+        dict: Band name and data of the fraction of green vegetation
+    """
+    if (min_frac_green > 1) or (min_frac_green<0.01):
+        raise ValueError("min_frac_green must be between 0.01 and 1!")
+
+    f_g, _ = converge_fraction_green(sza, fapar, lai, min_frac_green, workers, chunk_size, fipar_table)
+    return {'frac_green': f_g}
+
+def fraction_green(sza_file:str, biophysical_file:str, min_frac_green:float, output_file:str, block_size:int = None,
+    workers:int = None, chunk_size:int = CHUNK_SIZE, fipar_table:fipar_table = None):
     """Estimates the fraction of vegetation which is green based on the leaf area index (LAI),
     fraction of absorb ed photosynthetically active radiation (FAPAR) and sun zenith angle bands.
     Bare ground takes 0 value while green live vegetation 1.
@@ -12,32 +117,25 @@ def fraction_green(sza_file:str, biophysical_file:str, min_frac_green:float, out
         biophysical_file (str, pathlike): Path to Sentinel-2 biophysical product
         min_frac_green (float): Minimum fraction of vegetation which is green. Range from 0.01 to 1
         output_file (str): Product containing the fraction of green vegetation data
+        block_size (int, optional): Process the scene in blocks of block_size x block_size pixels to bound memory use. Defaults to the whole scene
+        workers (int, optional): Number of chunks iterated at the same time. Defaults to all cores
+        chunk_size (int, optional): Number of pixels per chunk. Defaults to CHUNK_SIZE
+        fipar_table (fipar_table, optional): Table evaluating calc_F_theta_campbell, trading an interpolation error
+            within an empirical bound (see fipar_table.max_error) for speed (see get_fipar_table). Defaults to the
+            exact function
     """
     if (min_frac_green > 1) or (min_frac_green<0.01):
         raise ValueError("min_frac_green must be between 0.01 and 1!")
-    # Read the required data
-    fapar, geo_coding = su.read_snappy_product(biophysical_file, 'fapar')
-    fapar = fapar.astype(np.float32)
-    lai = su.read_snappy_product(biophysical_file, 'lai')[0].astype(np.float32)
-    sza = su.read_snappy_product(sza_file, 'sun_zenith')[0].astype(np.float32)
-
-    # Calculate fraction of vegetation which is green
-    f_g = np.ones(lai.shape, np.float32)
-    # Iterate until f_g converges
-    converged = np.zeros(lai.shape, dtype=bool)
-    # For pixels where LAI or FAPAR are below tolerance threshold of the S2 biophysical
-    # processor, assume that the soil is bare and f_g = 1
-    converged[np.logical_or(lai <= 0.2, fapar <= 0.1)] = True
-    for c in range(50):
-        f_g_old = f_g.copy()
-        fipar = TSEB.calc_F_theta_campbell(sza[~converged],
-                                           lai[~converged]/f_g[~converged],
-                                           w_C=1, Omega0=1, x_LAD=1)
-        f_g[~converged] = fapar[~converged] / fipar
-        f_g = np.clip(f_g, min_frac_green, 1.)
-        converged = np.logical_or(np.isnan(f_g), np.abs(f_g - f_g_old) < 0.02)
-        if np.all(converged):
-            break
 
-    su.write_snappy_product(output_file, [{'band_name': 'frac_green', 'band_data': f_g}],
-                            'fracGreen', geo_coding)
+    sizes = []
+    def compute(bands):
+        [fapar, lai], [sza] = bands
+        f_g, block_sizes = converge_fraction_green(sza, fapar, lai, min_frac_green, workers, chunk_size, fipar_table)
+        sizes.extend([0] * (len(block_sizes) - len(sizes)))
+        for c, size in enumerate(block_sizes):
+            sizes[c] += size
+        return {'fracGreen': {'frac_green': f_g}}
+
+    su.map_blocks([(biophysical_file, ['fapar', 'lai']), (sza_file, ['sun_zenith'])], compute,
+                  {'fracGreen': (output_file, 'fracGreen')}, block_size)
+    print("INFO: Unconverged pixels of every fraction of green vegetation iteration: {}".format(sizes))
@@ -0,0 +1,143 @@
+import os
+import numpy as np
+
+import senet.core.snappy_utils as su
+from senet.core.leaf_spectra import compute_leaf_spectra
+from senet.core.frac_green import compute_fraction_green
+from senet.core.structural_params import compute_str_parameters, auxdata
+from senet.core.aerodynamic_roughness import compute_aerodynamic_roughness
+from senet.core.longwave_irradiance import compute_longwave_irradiance
+from senet.core.net_shortwave_radiation import compute_net_shortwave_radiation
+from senet.core.energy_fluxes import compute_energy_fluxes
+from senet.core.daily_evapotranspiration import compute_daily_evapotranspiration
+
+# Stages run by the fused pipeline and the product name each one is written with
+STAGES = {
+    "leaf_spectra": "leafSpectra",
+    "fraction_green": "fracGreen",
+    "str_parameters": "landcoverParams",
+    "aerodynamic_roughness": "aerodynamicRoughness",
+    "longwave_irradiance": "longwaveIrradiance",
+    "net_shortwave_radiation": "netShortwaveRadiation",
+    "energy_fluxes": "turbulentFluxes",
+    "daily_evapotranspiration": "dailySpectra",
+}
+
+
+def fused_pipeline(sza_file:str, biophysical_file:str, landcover_map:str, mask_file:str, lst_file:str, lst_geom_file:str,
+    meteo_file:str, outputs:dict, landcover_band:str = "land_cover_CCILandCover-2015", min_frac_green:float = 0.01,
+    lookup_table:str = os.path.join(auxdata, "LUT/ESA_CCI_LUT.csv"), soil_roughness:float = .01, alpha_pt:float = 1.28,
+    atmospheric_measurement_height:float = 100.0, green_vegetation_emissivity:float = 0.99, soil_emissivity:float = 0.99,
+    soil_ref_vis:float = 0.15, soil_ref_nir:float = 0.25, block_size:int = None, prior_fluxes_file:str = None):
+    """Runs the stages from leaf spectra to daily evapotranspiration keeping the intermediate results in memory.
+
+    The results are the same as running leaf_spectra, fraction_green, str_parameters, aerodynamic_roughness,
+    longwave_irradiance, net_shortwave_radiation, energy_fluxes and daily_evapotranspiration one after the other,
+    but only the products of the stages listed in outputs are written. With block_size, all stages run on one
+    block of the scene at a time, so memory use depends on the block size instead of the scene size. All stages
+    are per-pixel, so blocks need no overlap and the results do not depend on the block size.
+
+    Args:
+        sza_file (str): Path to Sentinel-2 sun zenith angle product
+        biophysical_file (str): Path to Sentinel-2 biophysical product
+        landcover_map (str): Path to landcover product
+        mask_file (str): Path to Sentinel-2 mask product
+        lst_file (str): Path to sharpened land surface temperature product (from sharpen)
+        lst_geom_file (str): Path to S3 observation geometry product (from warp)
+        meteo_file (str): Path to meteorological product (from prepare)
+        outputs (dict): Path to store the product of each stage to write, keyed by stage name (see STAGES)
+        landcover_band (str, optional): Name of landcover band. Defaults to "land_cover_CCILandCover-2015"
+        min_frac_green (float, optional): Minimum fraction of vegetation which is green. Defaults to 0.01
+        lookup_table (str, optional): Path to LUT table data. Defaults to "../auxdata/LUT/ESA_CCI_LUT.csv"
+        soil_roughness (float, optional): Soil roughness [m]. Defaults to .01
+        alpha_pt (float, optional): Alpha pt. Defaults to 1.28
+        atmospheric_measurement_height (float, optional): Atmospheric measurement height [m]. Defaults to 100.0
+        green_vegetation_emissivity (float, optional): Green vegetation emissivity. Defaults to 0.99
+        soil_emissivity (float, optional): Soil emissivity. Defaults to 0.99
+        soil_ref_vis (float, optional): Visible soil reflectance. Defaults to 0.15
+        soil_ref_nir (float, optional): Near infrared soil reflectance. Defaults to 0.25
+        block_size (int, optional): Process the scene in blocks of block_size x block_size pixels. Defaults to the whole scene
+        prior_fluxes_file (str, optional): Energy fluxes product of a previous acquisition to warm start the stability
+            iteration from (see energy_fluxes). Defaults to None
+    """
+    for stage in outputs:
+        if stage not in STAGES:
+            raise ValueError("Unknown stage {}, must be one of {}".format(stage, list(STAGES)))
+
+    # All energy flux bands are kept if the fluxes product is written, otherwise only the latent heat flux
+    flux_bands = None if "energy_fluxes" in outputs else ['latent_heat_flux']
+
+    def compute(bands):
+        ([lai, fapar, lai_cab, lai_cw], [sun_zenith], [landcover], [mask], [lst], [vza, sza],
+         [ta, u, ea, p, sdn, sdn_24]) = bands[:7]
+        prior_mol = bands[7][0] if prior_fluxes_file is not None else None
+        bands = None
+        results = {}
+
+        def keep(stage, stage_bands):
+            # Products are stored as float32 (or uint8 for uint8 bands), cast the in-memory results the same way
+            # so that the later stages see the values they would read back from disk
+            for name, data in stage_bands.items():
+                if np.asarray(data).dtype != np.uint8:
+                    stage_bands[name] = np.asarray(data, dtype=np.float32)
+            if stage in outputs:
+                results[stage] = stage_bands
+            return stage_bands
+
+        leaf = keep("leaf_spectra", compute_leaf_spectra(lai_cab, lai_cw))
+        lai_cab = lai_cw = None
+
+        frac_green = keep("fraction_green", compute_fraction_green(sun_zenith, fapar, lai, min_frac_green))
+        sun_zenith = fapar = None
+
+        params = compute_str_parameters(landcover, lai, frac_green['frac_green'], True, True, True, True, True, True,
+                                        lookup_table)
+        if params is None:
+            raise RuntimeError("Look-up table {} misses structural parameters".format(lookup_table))
+        params = keep("str_parameters", params)
+        landcover = None
+
+        roughness = keep("aerodynamic_roughness",
+                         compute_aerodynamic_roughness(lai, params['veg_height'], params['veg_height_width_ratio'],
+                                                       params['veg_fractional_cover'], params['igbp_classification'],
+                                                       soil_roughness))
+
+        longwave = keep("longwave_irradiance", compute_longwave_irradiance(ta, ea, p, atmospheric_measurement_height))
+
+        shortwave = keep("net_shortwave_radiation",
+                         compute_net_shortwave_radiation(leaf['refl_vis_c'], leaf['refl_nir_c'], leaf['trans_vis_c'],
+                                                         leaf['trans_nir_c'], lai, params['veg_inclination_distribution'],
+                                                         params['veg_fractional_cover'], params['veg_height_width_ratio'],
+                                                         p, sdn, sza, soil_ref_vis, soil_ref_nir))
+        leaf = sza = None
+
+        fluxes = keep("energy_fluxes",
+                      compute_energy_fluxes(lst, vza, lai, params['veg_inclination_distribution'],
+                                            params['veg_fractional_cover'], params['veg_height_width_ratio'],
+                                            params['veg_leaf_width'], params['veg_height'], frac_green['frac_green'],
+                                            roughness['roughness_length'], roughness['zero_plane_displacement'],
+                                            ta, u, ea, p, shortwave['net_shortwave_radiation_canopy'],
+                                            shortwave['net_shortwave_radiation_soil'],
+                                            longwave['longwave_irradiance'], mask, soil_roughness, alpha_pt,
+                                            atmospheric_measurement_height, green_vegetation_emissivity,
+                                            soil_emissivity, outputs=flux_bands, prior_mol=prior_mol))
+        params = roughness = longwave = shortwave = frac_green = prior_mol = None
+
+        keep("daily_evapotranspiration", compute_daily_evapotranspiration(fluxes['latent_heat_flux'], sdn, sdn_24))
+        return results
+
+    print("INFO: Running leaf spectra to daily evapotranspiration in memory...")
+    products = [
+        (biophysical_file, ['lai', 'fapar', 'lai_cab', 'lai_cw']),
+        (sza_file, ['sun_zenith']),
+        (landcover_map, [landcover_band]),
+        (mask_file, ['mask']),
+        (lst_file, ['sharpened_LST']),
+        (lst_geom_file, ['sat_zenith_tn', 'solar_zenith_tn']),
+        (meteo_file, ['air_temperature', 'wind_speed', 'vapour_pressure', 'air_pressure',
+                      'clear_sky_solar_radiation', 'average_daily_solar_irradiance'])
+    ]
+    if prior_fluxes_file is not None:
+        products.append((prior_fluxes_file, ['monin_obukhov_length']))
+    su.map_blocks(products, compute, {stage: (file_path, STAGES[stage]) for stage, file_path in outputs.items()},
+                  block_size)
@@ -1,23 +1,50 @@
+import uuid
+import functools
 import tempfile
 import os.path as pth
 import numpy as np
+from xml.sax.saxutils import escape
 
-from pyDMS.pyDMSUtils import saveImg, openRaster, getRasterInfo
+import senet.core.dimap_utils as du
 
 #Since the conda environment is not active
 #make sure to set the env_variables needed for gdal
 import os
 environment_variables = os.environ.copy()
 os.environ = environment_variables
-import gdal
+cur_path = pth.dirname(pth.abspath(__file__))
+
+
+@functools.lru_cache(maxsize=None)
+def _gdal():
+    """Imports GDAL on first use, after pointing PROJ and GDAL to their data files.
+
+    Every module reaches GDAL (and pyDMS, which imports it) through this function, so the data file
+    environment is set before the first GDAL import of the process.
+    """
+    if os.name == 'nt':
+        os.environ["PROJ_LIB"] = pth.join(cur_path, "../Library/share/proj")
+        os.environ["GDAL_DATA"] = pth.join(cur_path, "../Library/share/gdal")
+    else:
+        os.environ["PROJ_LIB"] = pth.join(cur_path, "../share/proj")
+        os.environ["GDAL_DATA"] = pth.join(cur_path, "../share/gdal")
+    import gdal
+    return gdal
+
+
+def _pydms_utils():
+    """Imports the raster utilities of pyDMS on first use, after GDAL."""
+    _gdal()
+    from pyDMS import pyDMSUtils
+    return pyDMSUtils
 
 
 def slope_from_dem(dem_file_path, output=None):
 
     if not output:
-        output = dem_file_path.replace('.tif', '_slope.tif')
+        output = pth.splitext(dem_file_path)[0]+'_slope.tif'
 
-    gdal.DEMProcessing(output, dem_file_path, "slope", computeEdges=True)
+    _gdal().DEMProcessing(output, dem_file_path, "slope", computeEdges=True)
     return output
 
 
@@ -26,12 +53,12 @@ def aspect_from_dem(dem_file_path, output=None):
     if not output:
         output = pth.splitext(dem_file_path)[0]+'_aspect.tif'
 
-    gdal.DEMProcessing(output, dem_file_path, "aspect", computeEdges=True)
+    _gdal().DEMProcessing(output, dem_file_path, "aspect", computeEdges=True)
     return output
 
 
 def save_image(data, geotransform, projection, filename):
-    return saveImg(data, geotransform, projection, filename)
+    return _pydms_utils().saveImg(data, geotransform, projection, filename)
 
 
 def resample_with_gdalwarp(src, template, resample_alg="cubicspline"):
@@ -39,7 +66,7 @@ def resample_with_gdalwarp(src, template, resample_alg="cubicspline"):
     proj, gt, sizeX, sizeY, extent, _ = raster_info(template)
 
     # Resample with GDAL warp
-    out_ds = gdal.Warp("",
+    out_ds = _gdal().Warp("",
                        src,
                        format="MEM",
                        dstSRS=proj,
@@ -51,7 +78,7 @@ def resample_with_gdalwarp(src, template, resample_alg="cubicspline"):
 
 
 def raster_info(raster):
-    return getRasterInfo(raster)
+    return _pydms_utils().getRasterInfo(raster)
 
 
 def raster_data(raster, bands=1, rect=None):
@@ -62,7 +89,7 @@ def raster_data(raster, bands=1, rect=None):
         else:
             return fid.GetRasterBand(band).ReadAsArray()
 
-    fid, closeOnExit = openRaster(raster)
+    fid, closeOnExit = _pydms_utils().openRaster(raster)
     if type(bands) == int:
         bands = [bands]
 
@@ -80,6 +107,7 @@ def raster_data(raster, bands=1, rect=None):
 
 
 def merge_raster_layers(input_list, output_filename, separate=False):
+    gdal = _gdal()
     merge_list = []
     for input_file in input_list:
         bands = raster_info(input_file)[5]
@@ -94,3 +122,206 @@ def merge_raster_layers(input_list, output_filename, separate=False):
             merge_list.append(input_file)
     fp = gdal.BuildVRT(output_filename, merge_list, separate=separate)
     return fp
+
+
+# GDAL names of the DIMAP band data types that VRT bands can read directly
+_VRT_DATA_TYPES = {
+    "uint8": "Byte",
+    "int16": "Int16",
+    "uint16": "UInt16",
+    "int32": "Int32",
+    "uint32": "UInt32",
+    "float32": "Float32",
+    "float64": "Float64",
+}
+
+
+def dimap_to_vrt(src_file_path, vrt_file_path=None, bands=None):
+    """Builds a GDAL VRT that reads the ENVI band images of a BEAM-DIMAP product in place.
+
+    Args:
+        src_file_path (str): Path to the .dim file
+        vrt_file_path (str, optional): Path of the VRT, on disk or in /vsimem/. Defaults to a new /vsimem/ file
+        bands (list, optional): Names of the bands to include. Defaults to all bands
+
+    Returns:
+        str: Path to the VRT
+    """
+    info = du.read_dimap_info(src_file_path)
+    if info["geo_coding"] is None:
+        raise du.DimapNotSupportedError(src_file_path + " has no map geocoding")
+    if bands is None:
+        bands = [b["band_name"] for b in info["bands"]]
+
+    lines = ['<VRTDataset rasterXSize="{}" rasterYSize="{}">'.format(info["width"], info["height"]),
+             "  <SRS>{}</SRS>".format(escape(info["geo_coding"].crs_wkt)),
+             "  <GeoTransform>{}</GeoTransform>".format(", ".join(repr(v) for v in du.geotransform(info["geo_coding"])))]
+    for index, band_name in enumerate(bands, start=1):
+        band = du._find_band(info, band_name, src_file_path)
+        if band["virtual"] or band["data_type"] not in _VRT_DATA_TYPES or band["log10_scaled"] \
+                or (band["width"], band["height"]) != (info["width"], info["height"]):
+            raise du.DimapNotSupportedError(src_file_path + " band " + band_name + " cannot be read through a VRT")
+        img_path = escape(os.path.abspath(band["img_path"]))
+        factor, offset = band["scaling_factor"], band["scaling_offset"]
+        scaled = factor != 1.0 or offset != 0.0
+        if scaled:
+            # Scaled bands are read through the ENVI driver and converted to geophysical values
+            lines.append('  <VRTRasterBand dataType="Float32" band="{}">'.format(index))
+            lines.append("    <Description>{}</Description>".format(escape(band_name)))
+            lines.append("    <ComplexSource>")
+            lines.append('      <SourceFilename relativeToVRT="0">{}</SourceFilename>'.format(img_path))
+            lines.append("      <SourceBand>1</SourceBand>")
+            lines.append("      <ScaleOffset>{!r}</ScaleOffset>".format(offset))
+            lines.append("      <ScaleRatio>{!r}</ScaleRatio>".format(factor))
+            lines.append("    </ComplexSource>")
+        else:
+            item_size = np.dtype(du.DATA_TYPES[band["data_type"]]).itemsize
+            lines.append('  <VRTRasterBand dataType="{}" band="{}" subClass="VRTRawRasterBand">'.format(
+                _VRT_DATA_TYPES[band["data_type"]], index))
+            lines.append("    <Description>{}</Description>".format(escape(band_name)))
+            lines.append('    <SourceFilename relativeToVRT="0">{}</SourceFilename>'.format(img_path))
+            lines.append("    <ImageOffset>0</ImageOffset>")
+            lines.append("    <PixelOffset>{}</PixelOffset>".format(item_size))
+            lines.append("    <LineOffset>{}</LineOffset>".format(item_size * info["width"]))
+            lines.append("    <ByteOrder>MSB</ByteOrder>")
+        if band["no_data_value_used"]:
+            lines.append("    <NoDataValue>{!r}</NoDataValue>".format(band["no_data_value"] * factor + offset))
+        lines.append("  </VRTRasterBand>")
+    lines.append("</VRTDataset>")
+    vrt = "\n".join(lines)
+
+    if vrt_file_path is None:
+        vrt_file_path = "/vsimem/{}.vrt".format(uuid.uuid4().hex)
+    if vrt_file_path.startswith("/vsimem/"):
+        _gdal().FileFromMemBuffer(vrt_file_path, vrt)
+    else:
+        with open(vrt_file_path, "w") as fp:
+            fp.write(vrt)
+    return vrt_file_path
+
+
+# Feature cubes up to this size are kept in GDAL memory (/vsimem/), larger ones in a temporary file on disk
+CUBE_MEMORY_BYTES = 1 << 30
+
+
+class feature_cube():
+    """Contiguous float32 stack of raster layers, readable by GDAL as one multi-band raster.
+
+    The layers are written band after band into a single little-endian raw file, in /vsimem/ if the cube is
+    small enough and in a temporary file otherwise, and exposed through a VRT of VRTRawRasterBands. Every
+    reader of the VRT then reads the raw float32 data directly, without decoding the source products again.
+    """
+
+    def __init__(self, width, height, projection, geotransform, n_bands, max_memory_bytes=CUBE_MEMORY_BYTES,
+                 temp_dir=None):
+        """
+        Args:
+            width (int): Raster width in pixels
+            height (int): Raster height in pixels
+            projection (str): Projection as WKT
+            geotransform (tuple): GDAL geotransform
+            n_bands (int): Number of bands that will be appended
+            max_memory_bytes (int, optional): Largest cube kept in memory. Defaults to CUBE_MEMORY_BYTES
+            temp_dir (str, optional): Folder of the raw file of large cubes. Defaults to the system temporary folder
+        """
+        self.width, self.height = width, height
+        self.projection, self.geotransform = projection, geotransform
+        self.nbytes = 4 * width * height * n_bands
+        self.in_memory = self.nbytes <= max_memory_bytes
+        name = "feature_cube_" + uuid.uuid4().hex
+        if self.in_memory:
+            self.raw_path = "/vsimem/{}.raw".format(name)
+        else:
+            self.raw_path = pth.join(temp_dir or tempfile.gettempdir(), name + ".raw")
+        self.vrt_path = "/vsimem/{}.vrt".format(name)
+        self.bands = []
+        self._fp = _gdal().VSIFOpenL(self.raw_path, "wb")
+
+    def append(self, band_name, data, no_data_value=None):
+        """Appends a band to the cube.
+
+        Args:
+            band_name (str): Band description
+            data (np.array): Band data with the raster shape
+            no_data_value (float, optional): No data value of the band. Defaults to None
+        """
+        data = np.ascontiguousarray(data, dtype="<f4")
+        if data.shape != (self.height, self.width):
+            raise ValueError("Band {} has shape {} instead of {}".format(band_name, data.shape, (self.height, self.width)))
+        _gdal().VSIFWriteL(data.tobytes(), 1, data.nbytes, self._fp)
+        self.bands.append((band_name, no_data_value))
+
+    def append_raster(self, raster):
+        """Appends all bands of a raster readable by GDAL, keeping their descriptions and no data values."""
+        fid = _gdal().Open(raster)
+        for index in range(1, fid.RasterCount + 1):
+            band = fid.GetRasterBand(index)
+            self.append(band.GetDescription(), band.ReadAsArray(), band.GetNoDataValue())
+        fid = None
+
+    def to_vrt(self):
+        """Finishes the cube and returns the path to its VRT."""
+        if self._fp is not None:
+            _gdal().VSIFCloseL(self._fp)
+            self._fp = None
+        lines = ['<VRTDataset rasterXSize="{}" rasterYSize="{}">'.format(self.width, self.height),
+                 "  <SRS>{}</SRS>".format(escape(self.projection)),
+                 "  <GeoTransform>{}</GeoTransform>".format(", ".join(repr(v) for v in self.geotransform))]
+        band_bytes = 4 * self.width * self.height
+        for index, (band_name, no_data_value) in enumerate(self.bands):
+            lines.append('  <VRTRasterBand dataType="Float32" band="{}" subClass="VRTRawRasterBand">'.format(index + 1))
+            lines.append("    <Description>{}</Description>".format(escape(band_name)))
+            lines.append('    <SourceFilename relativeToVRT="0">{}</SourceFilename>'.format(escape(self.raw_path)))
+            lines.append("    <ImageOffset>{}</ImageOffset>".format(index * band_bytes))
+            lines.append("    <PixelOffset>4</PixelOffset>")
+            lines.append("    <LineOffset>{}</LineOffset>".format(4 * self.width))
+            lines.append("    <ByteOrder>LSB</ByteOrder>")
+            if no_data_value is not None:
+                lines.append("    <NoDataValue>{!r}</NoDataValue>".format(no_data_value))
+            lines.append("  </VRTRasterBand>")
+        lines.append("</VRTDataset>")
+        _gdal().FileFromMemBuffer(self.vrt_path, "\n".join(lines))
+        return self.vrt_path
+
+    def remove(self):
+        """Removes the raw file and the VRT of the cube."""
+        if self._fp is not None:
+            _gdal().VSIFCloseL(self._fp)
+            self._fp = None
+        for file_path in [self.vrt_path, self.raw_path]:
+            remove_gdal_file(file_path)
+
+
+def product_to_gdal(src_file_path, bands=None):
+    """Makes the bands of a product readable by GDAL.
+
+    BEAM-DIMAP products are exposed through an in-memory VRT pointing at their band images. Other
+    products are copied to a temporary GeoTIFF with snappy.
+
+    Args:
+        src_file_path (str): Path to the product
+        bands (list, optional): Names of the bands to include. Defaults to all bands
+
+    Returns:
+        str: Path to a file that GDAL can open. Remove it with remove_gdal_file
+    """
+    if os.path.splitext(src_file_path)[1].lower() == ".dim":
+        try:
+            return dimap_to_vrt(src_file_path, bands=bands)
+        except (du.DimapNotSupportedError, OSError):
+            pass
+
+    import senet.core.snappy_utils as su
+    temp_file = tempfile.NamedTemporaryFile(suffix=".tif", delete=False)
+    temp_file_path = temp_file.name
+    temp_file.close()
+    su.copy_bands_to_file(src_file_path, temp_file_path, bands)
+    return temp_file_path
+
+
+def remove_gdal_file(file_path):
+    """Removes a file created by product_to_gdal or dimap_to_vrt."""
+    if file_path.startswith("/vsimem/"):
+        _gdal().Unlink(file_path)
+    elif os.path.exists(file_path):
+        os.remove(file_path)
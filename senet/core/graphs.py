@@ -3,6 +3,8 @@ import os
 
 path =  os.path.dirname(os.path.abspath(__file__))
 auxdata = os.path.join(path, "../auxdata")
+# Pixel size of the Sentinel 2 grid produced by sentinel_2_preprocessing.xml [m]
+S2_RESOLUTION = 20
 
 def s2_preprocessing(gpt_path:str, S2_L2A:str, AOI:str,
     out_refl:str, out_sun_zenith:str, out_mask:str, out_bio:str):
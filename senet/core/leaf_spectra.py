@@ -46,27 +46,32 @@ def watercloud_model(param:np.array, a:float, b:float, c:float):
 
     return result
 
-def leaf_spectra(biophysical_file:str, output_file:str):
+def compute_leaf_spectra(lai_cab:np.array, lai_cw:np.array):
     """Estimates leaf reflectance and transmittance based on plant chlorophyl and water content.
-    
+
     Args:
-        biophysical_file (str, path-like): Path to biophysical file exported from sentinel 2 pre-processing 
-        output_file (str, path-like): Path to store the output leaf spectral properties in BEAM-DIMAP product
+        lai_cab (np.array): Canopy chlorophyll content [μg/cm^{2}]
+        lai_cw (np.array): Canopy water content [g/cm^{2}]
+
+    Returns:
+        dict: Band name and data of the leaf spectral properties
     """
-    # Read the required data
-    lai_cab, geo_coding = su.read_snappy_product(biophysical_file, 'lai_cab')
-    lai_cw = su.read_snappy_product(biophysical_file, 'lai_cw')[0]
-    
     cab = np.clip(np.array(lai_cab), 0.0, 140.0)
     refl_vis, trans_vis = cab_to_vis_spectrum(cab)
 
     cw = np.clip(np.array(lai_cw), 0.0, 0.1)
     refl_nir, trans_nir = cw_to_nir_spectrum(cw)
 
-    su.write_snappy_product(output_file, [
-        {'band_name': 'refl_vis_c', 'band_data': refl_vis},
-        {'band_name': 'refl_nir_c', 'band_data': refl_nir},
-        {'band_name': 'trans_vis_c', 'band_data': trans_vis},
-        {'band_name': 'trans_nir_c', 'band_data': trans_nir}
-        ],
-        'leafSpectra', geo_coding)
+    return {'refl_vis_c': refl_vis, 'refl_nir_c': refl_nir, 'trans_vis_c': trans_vis, 'trans_nir_c': trans_nir}
+
+def leaf_spectra(biophysical_file:str, output_file:str, block_size:int = None):
+    """Estimates leaf reflectance and transmittance based on plant chlorophyl and water content.
+    
+    Args:
+        biophysical_file (str, path-like): Path to biophysical file exported from sentinel 2 pre-processing 
+        output_file (str, path-like): Path to store the output leaf spectral properties in BEAM-DIMAP product
+        block_size (int, optional): Process the scene in blocks of block_size x block_size pixels to bound memory use. Defaults to the whole scene
+    """
+    su.map_blocks([(biophysical_file, ['lai_cab', 'lai_cw'])],
+                  lambda bands: {'leafSpectra': compute_leaf_spectra(*bands[0])},
+                  {'leafSpectra': (output_file, 'leafSpectra')}, block_size)
@@ -1,9 +1,24 @@
 import numpy as np
 
-import pyTSEB.net_radiation as rad
 import senet.core.snappy_utils as su
 
-def longwave_irradiance(meteo_product:str, output_file:str, at_band:str = "air_temperature", vp_band:str = "vapour_pressure", ap_band:str = "air_pressure", at_height:float = 100.0):
+def compute_longwave_irradiance(at:np.array, vp:np.array, ap:np.array, at_height:float = 100.0):
+    """Estimates atmosphere longwave irradiance [W/m^{2}] based on meteorological inputs.
+
+    Args:
+        at (np.array): Air temperature [K]
+        vp (np.array): Vapour pressure [mb]
+        ap (np.array): Air pressure [mb]
+        at_height (float, optional): Reference height of data. Defaults to 100.0.
+
+    Returns:
+        dict: Band name and data of the longwave irradiance
+    """
+    import pyTSEB.net_radiation as rad
+
+    return {'longwave_irradiance': rad.calc_longwave_irradiance(vp, at, ap, at_height)}
+
+def longwave_irradiance(meteo_product:str, output_file:str, at_band:str = "air_temperature", vp_band:str = "vapour_pressure", ap_band:str = "air_pressure", at_height:float = 100.0, block_size:int = None):
     """Estimates atmosphere longwave irradiance [W/m^{2}] based on meteorological inputs.
 
     Args:
@@ -13,17 +28,8 @@ def longwave_irradiance(meteo_product:str, output_file:str, at_band:str = "air_t
         vp_band (str, optional): Band name that contains vapour pressure data. Defaults to "vapour_pressure".
         ap_band (str, optional): Band name that contains air pressure data. Defaults to "air_pressure".
         at_height (float, optional): Reference height of data. Defaults to 100.0.
+        block_size (int, optional): Process the scene in blocks of block_size x block_size pixels to bound memory use. Defaults to the whole scene
     """
-
-    at, geo_coding = su.read_snappy_product(meteo_product, at_band)
-    at = at.astype(np.float32)
-    vp = su.read_snappy_product(meteo_product, vp_band)[0].astype(np.float32)
-    ap = su.read_snappy_product(meteo_product, ap_band)[0].astype(np.float32)
-
-    irrad = rad.calc_longwave_irradiance(vp, at, ap, at_height)
-    
-    band_data = [
-            {'band_name': 'longwave_irradiance', 'band_data': irrad}
-    ]
-
-    su.write_snappy_product(output_file, band_data, 'longwaveIrradiance', geo_coding)
+    su.map_blocks([(meteo_product, [at_band, vp_band, ap_band])],
+                  lambda bands: {'longwaveIrradiance': compute_longwave_irradiance(*bands[0], at_height)},
+                  {'longwaveIrradiance': (output_file, 'longwaveIrradiance')}, block_size)
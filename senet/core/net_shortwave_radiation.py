@@ -1,47 +1,45 @@
 import numpy as np
 
-import pyTSEB.net_radiation as rad
-import pyTSEB.clumping_index as ci
-
 import senet.core.snappy_utils as su
+from senet.core.packed_pixels import packed_pixels
 
-def net_shortwave_radiation(lsp_product:str, lai_product:str, csp_product:str, mi_product:str, sza_product:str, output_file:str, soil_ref_vis:float = 0.15, soil_ref_nir:float = 0.25):
+def compute_net_shortwave_radiation(refl_vis_c:np.array, refl_nir_c:np.array, trans_vis_c:np.array, trans_nir_c:np.array,
+    lai:np.array, lad:np.array, frac_cover:np.array, hw_ratio:np.array, p:np.array, irradiance:np.array, sza:np.array,
+    soil_ref_vis:float = 0.15, soil_ref_nir:float = 0.25):
     """Estimates net shortwave radiation based on meteorological and biophysical inputs.
 
     Args:
-        lsp_product (str): Path to leaf spectra product (output of leaf reflectance and transmittance)
-        lai_product (str): Path to LAI biophysical product
-        csp_product (str): Path to vegetation structural parameters product
-        mi_product (str): Path to meteorological product (from prepare)
-        sza_product (str): Path to sun zenith angle product (from Warp to template)
-        output_file (str): Path to store net shortwave radation result
+        refl_vis_c (np.array): Leaf reflectance on visible spectrum
+        refl_nir_c (np.array): Leaf reflectance on NIR spectrum
+        trans_vis_c (np.array): Leaf transmittance on visible spectrum
+        trans_nir_c (np.array): Leaf transmittance on NIR spectrum
+        lai (np.array): Leaf area index
+        lad (np.array): Leaf inclination distribution
+        frac_cover (np.array): Vegetation fractional cover
+        hw_ratio (np.array): Vegetation height to width ratio
+        p (np.array): Air pressure [mb]
+        irradiance (np.array): Clear sky solar irradiance [W/m^{2}]
+        sza (np.array): Sun zenith angle [degrees]
         soil_ref_vis (float, optional): Visible soil reflectance. Defaults to 0.15
         soil_ref_nir (float, optional): Near infrared soil reflectance. Defaults to 0.25
-    """
 
-    refl_vis_c, geo_coding = su.read_snappy_product(lsp_product, 'refl_vis_c')
-    refl_vis_c = refl_vis_c.astype(np.float32)
-    refl_nir_c = su.read_snappy_product(lsp_product, 'refl_nir_c')[0].astype(np.float32)
-    trans_vis_c = su.read_snappy_product(lsp_product, 'trans_vis_c')[0].astype(np.float32)
-    trans_nir_c = su.read_snappy_product(lsp_product, 'trans_nir_c')[0].astype(np.float32)
+    Returns:
+        dict: Band name and data of the canopy and soil net shortwave radiation
+    """
+    import pyTSEB.net_radiation as rad
+    import pyTSEB.clumping_index as ci
 
-    lai = su.read_snappy_product(lai_product, 'lai')[0].astype(np.float32)
+    # Pixels with leaf area index, packed as bare soil pixels followed by vegetated pixels
+    pixels = packed_pixels(lai <= 0, lai > 0)
+    bare, veg = pixels.groups
+    [refl_vis_c, refl_nir_c, trans_vis_c, trans_nir_c, lai, lad, frac_cover, hw_ratio, p, irradiance, sza] = [
+        pixels.pack(a) for a in [refl_vis_c, refl_nir_c, trans_vis_c, trans_nir_c, lai, lad, frac_cover, hw_ratio, p,
+                                 irradiance, sza]]
 
-
-    lad = su.read_snappy_product(csp_product, 'veg_inclination_distribution')[0].astype(np.float32)
-    frac_cover = su.read_snappy_product(csp_product, 'veg_fractional_cover')[0].astype(np.float32)
-    hw_ratio = su.read_snappy_product(csp_product, 'veg_height_width_ratio')[0].astype(np.float32)
-    
-    
-    p = su.read_snappy_product(mi_product, 'air_pressure')[0].astype(np.float32)
-    irradiance = su.read_snappy_product(mi_product, 'clear_sky_solar_radiation')[0].astype(np.float32)
-    
-    sza = su.read_snappy_product(sza_product, 'solar_zenith_tn')[0].astype(np.float32)
-   
-    net_rad_c = np.zeros(lai.shape, np.float32)
-    net_rad_s = np.zeros(lai.shape, np.float32)
-    soil_ref_vis = np.full(lai.shape, soil_ref_vis, np.float32)
-    soil_ref_nir = np.full(lai.shape, soil_ref_nir, np.float32)
+    net_rad_c = pixels.full(0)
+    net_rad_s = pixels.full(0)
+    soil_ref_vis = pixels.full(soil_ref_vis)
+    soil_ref_nir = pixels.full(soil_ref_nir)
 
     #Estimate diffuse and direct irradiance
     difvis, difnir, fvis, fnir = rad.calc_difuse_ratio(irradiance, sza, p)
@@ -50,37 +48,60 @@ def net_shortwave_radiation(lsp_product:str, lai_product:str, csp_product:str, m
     irradiance_dif = irradiance * skyl
 
     # Net shortwave radition for bare soil
-    i = lai <= 0
-    spectra_soil = fvis[i] * soil_ref_vis[i] + fnir[i] * soil_ref_nir[i]
-    net_rad_s[i] = (1. - spectra_soil) * (irradiance_dir[i] + irradiance_dif[i])
+    spectra_soil = fvis[bare] * soil_ref_vis[bare] + fnir[bare] * soil_ref_nir[bare]
+    net_rad_s[bare] = (1. - spectra_soil) * (irradiance_dir[bare] + irradiance_dif[bare])
     
     # Net shortwave radiation for vegetated areas
-    i = lai > 0
-    F = lai[i] / frac_cover[i] 
+    F = lai[veg] / frac_cover[veg] 
     # Clumping index
-    omega0 = ci.calc_omega0_Kustas(lai[i], frac_cover[i], lad[i], isLAIeff=True)
-    omega = ci.calc_omega_Kustas(omega0, sza[i], hw_ratio[i])
+    omega0 = ci.calc_omega0_Kustas(lai[veg], frac_cover[veg], lad[veg], isLAIeff=True)
+    omega = ci.calc_omega_Kustas(omega0, sza[veg], hw_ratio[veg])
     lai_eff = F * omega
-    [net_rad_c[i], net_rad_s[i]] = rad.calc_Sn_Campbell(lai[i],
-                                                        sza[i],
-                                                        irradiance_dir[i],
-                                                        irradiance_dif[i],
-                                                        fvis[i],
-                                                        fnir[i],
-                                                        refl_vis_c[i],
-                                                        trans_vis_c[i],
-                                                        refl_nir_c[i],
-                                                        trans_nir_c[i],
-                                                        soil_ref_vis[i],
-                                                        soil_ref_nir[i],
-                                                        lad[i],
-                                                        lai_eff
-                                                        )
-    
+    [net_rad_c[veg], net_rad_s[veg]] = rad.calc_Sn_Campbell(lai[veg],
+                                                            sza[veg],
+                                                            irradiance_dir[veg],
+                                                            irradiance_dif[veg],
+                                                            fvis[veg],
+                                                            fnir[veg],
+                                                            refl_vis_c[veg],
+                                                            trans_vis_c[veg],
+                                                            refl_nir_c[veg],
+                                                            trans_nir_c[veg],
+                                                            soil_ref_vis[veg],
+                                                            soil_ref_nir[veg],
+                                                            lad[veg],
+                                                            lai_eff
+                                                            )
 
-    band_data = [
-            {'band_name': 'net_shortwave_radiation_canopy', 'band_data': net_rad_c},
-            {'band_name': 'net_shortwave_radiation_soil', 'band_data': net_rad_s}
-    ]
+    return {'net_shortwave_radiation_canopy': pixels.unpack(net_rad_c, 0),
+            'net_shortwave_radiation_soil': pixels.unpack(net_rad_s, 0)}
+
+def net_shortwave_radiation(lsp_product:str, lai_product:str, csp_product:str, mi_product:str, sza_product:str, output_file:str, soil_ref_vis:float = 0.15, soil_ref_nir:float = 0.25,
+    block_size:int = None):
+    """Estimates net shortwave radiation based on meteorological and biophysical inputs.
+
+    Args:
+        lsp_product (str): Path to leaf spectra product (output of leaf reflectance and transmittance)
+        lai_product (str): Path to LAI biophysical product
+        csp_product (str): Path to vegetation structural parameters product
+        mi_product (str): Path to meteorological product (from prepare)
+        sza_product (str): Path to sun zenith angle product (from Warp to template)
+        output_file (str): Path to store net shortwave radation result
+        soil_ref_vis (float, optional): Visible soil reflectance. Defaults to 0.15
+        soil_ref_nir (float, optional): Near infrared soil reflectance. Defaults to 0.25
+        block_size (int, optional): Process the scene in blocks of block_size x block_size pixels to bound memory use. Defaults to the whole scene
+    """
+    def compute(bands):
+        ([refl_vis_c, refl_nir_c, trans_vis_c, trans_nir_c], [lai], [lad, frac_cover, hw_ratio],
+         [p, irradiance], [sza]) = bands
+        return {'netShortwaveRadiation': compute_net_shortwave_radiation(refl_vis_c, refl_nir_c, trans_vis_c, trans_nir_c,
+                                                                         lai, lad, frac_cover, hw_ratio, p, irradiance,
+                                                                         sza, soil_ref_vis, soil_ref_nir)}
 
-    su.write_snappy_product(output_file, band_data, 'netShortwaveRadiation', geo_coding)
+    su.map_blocks([
+        (lsp_product, ['refl_vis_c', 'refl_nir_c', 'trans_vis_c', 'trans_nir_c']),
+        (lai_product, ['lai']),
+        (csp_product, ['veg_inclination_distribution', 'veg_fractional_cover', 'veg_height_width_ratio']),
+        (mi_product, ['air_pressure', 'clear_sky_solar_radiation']),
+        (sza_product, ['solar_zenith_tn'])
+    ], compute, {'netShortwaveRadiation': (output_file, 'netShortwaveRadiation')}, block_size)
@@ -0,0 +1,58 @@
+import numpy as np
+
+
+class packed_pixels():
+    """Pixels of a scene that take part in a computation, stored as contiguous 1-D arrays.
+
+    The index set is computed once from one or more disjoint boolean masks (e.g. bare soil and vegetated
+    pixels). Pixels are packed mask by mask, in raster order within each mask, so the pixels of every
+    mask form a contiguous slice of the packed arrays and can be used without further copies. Results
+    stay packed until they are unpacked to full scene arrays for writing.
+    """
+
+    def __init__(self, *masks:np.array):
+        """
+        Args:
+            *masks (np.array): Disjoint boolean arrays with the shape of the scene
+        """
+        self.shape = masks[0].shape
+        indices = [np.flatnonzero(mask) for mask in masks]
+        self.index = np.concatenate(indices) if indices else np.empty(0, np.intp)
+        bounds = np.cumsum([0] + [len(index) for index in indices])
+        # Slice of the packed arrays holding the pixels of each mask
+        self.groups = [slice(int(bounds[k]), int(bounds[k + 1])) for k in range(len(indices))]
+
+    def __len__(self):
+        return len(self.index)
+
+    def pack(self, data:np.array, group:slice = None):
+        """Gathers the packed pixels of a scene array.
+
+        Args:
+            data (np.array): Array with the shape of the scene
+            group (slice, optional): Gather only the pixels of one group (see groups). Defaults to all packed pixels
+
+        Returns:
+            np.array: 1-D array with the values of the packed pixels
+        """
+        index = self.index if group is None else self.index[group]
+        return np.take(np.reshape(data, -1), index)
+
+    def full(self, fill_value:float = np.nan, dtype=np.float32):
+        """Returns a new packed array filled with a value."""
+        return np.full(len(self.index), fill_value, dtype)
+
+    def unpack(self, data:np.array, fill_value:float = np.nan, dtype=np.float32):
+        """Scatters packed values into a new scene array.
+
+        Args:
+            data (np.array): 1-D array with the values of the packed pixels
+            fill_value (float, optional): Value of the pixels that are not packed. Defaults to np.nan
+            dtype (np.dtype, optional): Data type of the scene array. Defaults to np.float32
+
+        Returns:
+            np.array: Array with the shape of the scene
+        """
+        out = np.full(int(np.prod(self.shape)), fill_value, dtype)
+        out[self.index] = data
+        return out.reshape(self.shape)
@@ -0,0 +1,134 @@
+import os
+import json
+import pickle
+import hashlib
+from datetime import date
+from collections import namedtuple
+import numpy as np
+
+# Largest number of days between the acquisition a model was trained on and the one it is reused for
+MAX_AGE_DAYS = 16
+# A reused model is replaced when its residual RMSE grows beyond this ratio of the RMSE of its training scene. The
+# RMSE of the training scene is in-sample, so it is lower than the RMSE of any other scene even without drift, and
+# the ratio leaves room for that optimism as well as for the drift that is tolerated
+DRIFT_RATIO = 2.0
+
+# A trained sharpener of the store:
+#   date: acquisition date the sharpener was trained on
+#   model: trained sharpener
+#   residual_rmse: RMSE of the residual analysis on the good quality pixels of the training scene [K], in-sample
+stored_model = namedtuple("stored_model", ["date", "model", "residual_rmse"])
+
+
+def residual_rmse(residual:np.array, quality:np.array, good_quality_flags:list):
+    """Root mean square of the residuals of the sharpening on the good quality low resolution pixels.
+
+    Args:
+        residual (np.array): Residuals of the residual analysis
+        quality (np.array): Low resolution quality mask
+        good_quality_flags (list): Good quality mask values
+
+    Returns:
+        float: Residual RMSE, NaN if there are no valid pixels
+    """
+    valid = np.isin(quality, good_quality_flags) & np.isfinite(residual)
+    if not np.any(valid):
+        return float("nan")
+    return float(np.sqrt(np.mean(np.square(residual[valid], dtype=np.float64))))
+
+
+class sharpener_models():
+    """Store of the trained sharpeners of a tile, to be reused for nearby acquisitions.
+
+    The relationship between the high resolution predictors and LST changes slowly between consecutive
+    overpasses, so a sharpener trained on one acquisition can sharpen the next ones. The sharpeners of a key
+    (e.g. tile, area of interest and sharpener configuration) are pickled in their own folder, one file per
+    acquisition date, together with the residual RMSE of their training scene. A reused sharpener is checked
+    against that RMSE (see drifted) so that a new one is trained when it no longer fits the scene.
+
+    The RMSE of the training scene is measured on the pixels the sharpener was trained on, so it is biased low:
+    a sharpener that still fits has a higher RMSE on any other scene. drift_ratio has to cover that bias, which is
+    why its default is well above 1. A rejected sharpener costs an application and a residual analysis on top of
+    the training of the new one, so a ratio that is too low makes reuse slower than always training.
+    """
+
+    def __init__(self, store_dir:str, max_age_days:int = MAX_AGE_DAYS, drift_ratio:float = DRIFT_RATIO, **key):
+        """
+        Args:
+            store_dir (str): Folder of the store
+            max_age_days (int, optional): Largest age of a reused sharpener in days. Defaults to MAX_AGE_DAYS
+            drift_ratio (float, optional): Largest ratio between the residual RMSE of a reused sharpener and the
+                in-sample RMSE of its training scene. Defaults to DRIFT_RATIO
+            **key: Values identifying the sharpeners, which must be serializable to JSON or have a stable str
+        """
+        self.store_dir = store_dir
+        self.max_age_days = max_age_days
+        self.drift_ratio = drift_ratio
+        self.key = key
+        digest = hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+        self.folder = os.path.join(store_dir, digest[:16])
+
+    def sub(self, **key):
+        """Returns the store of the sharpeners that depend on additional values, in a subfolder of this store."""
+        return sharpener_models(self.folder, self.max_age_days, self.drift_ratio, **key)
+
+    def path(self, model_date:date):
+        """Path to the pickle file of the sharpener of a date."""
+        return os.path.join(self.folder, model_date.isoformat() + ".pkl")
+
+    def latest(self, acquisition_date:date):
+        """Loads the stored sharpener closest in time to an acquisition.
+
+        Args:
+            acquisition_date (date): Date of the acquisition to sharpen
+
+        Returns:
+            stored_model: Closest sharpener within max_age_days, or None if there is none
+        """
+        if not os.path.isdir(self.folder):
+            return None
+        dates = []
+        for name in os.listdir(self.folder):
+            stem, extension = os.path.splitext(name)
+            try:
+                model_date = date.fromisoformat(stem)
+            except ValueError:
+                continue
+            if extension == ".pkl" and abs((acquisition_date - model_date).days) <= self.max_age_days:
+                dates.append(model_date)
+        for model_date in sorted(dates, key=lambda d: (abs((acquisition_date - d).days), d)):
+            try:
+                with open(self.path(model_date), "rb") as fp:
+                    return pickle.load(fp)
+            except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError) as e:
+                # e.g. pickled with another version of the regressor library
+                print("INFO: Skipping sharpener of {} that cannot be loaded: {}".format(model_date, e))
+        return None
+
+    def drifted(self, stored:stored_model, rmse:float):
+        """True if the residual RMSE of a reused sharpener exceeds drift_ratio times the in-sample RMSE of its
+        training scene, i.e. it no longer fits the scene."""
+        return not rmse <= self.drift_ratio * stored.residual_rmse
+
+    def store(self, model_date:date, model, rmse:float):
+        """Stores a trained sharpener.
+
+        Args:
+            model_date (date): Acquisition date the sharpener was trained on
+            model: Trained sharpener, which must be picklable
+            rmse (float): Residual RMSE of the training scene
+        """
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder, exist_ok=True)
+            with open(os.path.join(self.folder, "key.json"), "w") as fp:
+                json.dump(self.key, fp, indent=4, sort_keys=True, default=str)
+        tmp_file = "{}.{}.tmp".format(self.path(model_date), os.getpid())
+        try:
+            with open(tmp_file, "wb") as fp:
+                pickle.dump(stored_model(model_date, model, rmse), fp, protocol=pickle.HIGHEST_PROTOCOL)
+        except (TypeError, AttributeError, pickle.PicklingError) as e:
+            os.remove(tmp_file)
+            print("INFO: The sharpener of {} cannot be stored: {}".format(model_date, e))
+            return
+        os.replace(tmp_file, self.path(model_date))
+        print("INFO: Stored sharpener of {} in {}".format(model_date, self.folder))
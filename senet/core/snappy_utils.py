@@ -2,44 +2,325 @@ import numpy as np
 
 import os
 import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 environment_variables = os.environ.copy()
 os.environ = environment_variables
 
-snappy_dir = os.path.join(os.path.expanduser("~"), ".snap", "snap-python")
-if os.path.isdir(snappy_dir):    
-    sys.path.append(snappy_dir)
-else:
-    dir_path = os.path.dirname(os.path.realpath(__file__))
-    snappy_dir = os.path.join(dir_path, "..", "..", "..", "snap-python")
-    sys.path.append(snappy_dir)
-from snappy import ProductIO, Product, ProductData, ProductUtils, String
+import senet.core.dimap_utils as du
 
+# Backend used for BEAM-DIMAP products. "auto" reads and writes them in pure Python (without starting
+# the JVM) and falls back to snappy for anything the pure Python backend cannot handle, "snappy" always
+# goes through snappy.
+IO_BACKEND = os.environ.get("SENET_IO_BACKEND", "auto")
+# Number of pixels in the row blocks of products read in pure Python, which have no tiling
+DIMAP_BLOCK_PIXELS = 1 << 20
+# Number of products whose metadata is kept in memory
+METADATA_CACHE_SIZE = 128
 
-def read_snappy_product(file_path, band_name=None):
-    prod = ProductIO.readProduct(file_path)
+_snappy_module = None
+_metadata_cache = OrderedDict()
+_metadata_lock = threading.Lock()
+
+
+def _snappy():
+    """Imports snappy on first use. Importing snappy starts the JVM."""
+    global _snappy_module
+    if _snappy_module is None:
+        snappy_dir = os.path.join(os.path.expanduser("~"), ".snap", "snap-python")
+        if os.path.isdir(snappy_dir):
+            sys.path.append(snappy_dir)
+        else:
+            dir_path = os.path.dirname(os.path.realpath(__file__))
+            snappy_dir = os.path.join(dir_path, "..", "..", "..", "snap-python")
+            sys.path.append(snappy_dir)
+        import snappy
+        _snappy_module = snappy
+    return _snappy_module
+
+
+def _cached_metadata(kind, file_path, load):
+    """Returns the metadata of a product from the in-memory cache, loading it on a miss.
+
+    Entries are keyed on the absolute path and are reloaded when the modification time or size of the
+    product changes. The least recently used entries are evicted beyond METADATA_CACHE_SIZE products.
+    """
+    key = (kind, os.path.abspath(file_path))
+    try:
+        stat = os.stat(file_path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        signature = None
+    with _metadata_lock:
+        entry = _metadata_cache.get(key)
+        if entry is not None and signature is not None and entry[0] == signature:
+            _metadata_cache.move_to_end(key)
+            return entry[1]
+    value = load(file_path)
+    if signature is not None:
+        with _metadata_lock:
+            _metadata_cache[key] = (signature, value)
+            _metadata_cache.move_to_end(key)
+            while len(_metadata_cache) > METADATA_CACHE_SIZE:
+                _metadata_cache.popitem(last=False)
+    return value
+
+
+def clear_metadata_cache():
+    """Empties the in-memory product metadata cache."""
+    with _metadata_lock:
+        _metadata_cache.clear()
+
+
+def _load_dimap_info(file_path):
+    try:
+        info = du.read_dimap_info(file_path)
+    except Exception:
+        return None
+    # Only map geocodings can be carried over to the written products
+    if info["geo_coding"] is None:
+        return None
+    return info
+
+
+def _dimap_info(file_path):
+    """Returns the header of a product that can be read in pure Python, or None if snappy must be used."""
+    if IO_BACKEND == "snappy" or os.path.splitext(file_path)[1].lower() != ".dim" or not os.path.isfile(file_path):
+        return None
+    return _cached_metadata("dimap", file_path, _load_dimap_info)
+
+
+def _load_snappy_info(file_path):
+    prod = _snappy().ProductIO.readProduct(file_path)
+    try:
+        tile_size = prod.getPreferredTileSize()
+        return {
+            "name": prod.getName(),
+            "product_type": prod.getProductType(),
+            "width": prod.getSceneRasterWidth(),
+            "height": prod.getSceneRasterHeight(),
+            "geo_coding": prod.getSceneGeoCoding(),
+            "tile_size": (tile_size.width, tile_size.height) if tile_size is not None else None,
+            "bands": [{"band_name": band.getName(), "description": band.getDescription(), "unit": band.getUnit()}
+                      for band in prod.getBands()],
+        }
+    finally:
+        prod.closeIO()
+
+
+def _product_info(file_path):
+    """Returns the cached header of a product, read in pure Python when possible and with snappy otherwise."""
+    info = _dimap_info(file_path)
+    if info is not None:
+        return info
+    return _cached_metadata("snappy", file_path, _load_snappy_info)
+
+
+# Band.readPixels has Java overloads that fill buffers of these types directly
+_NATIVE_READ_TYPES = (np.dtype(np.int32), np.dtype(np.float32), np.dtype(np.float64))
+# Number of rows read at a time when the output buffer cannot be filled directly
+_READ_CHUNK_ROWS = 512
+
+
+def _read_pixels(band, window, dtype=np.float32, out=None):
+    """Reads the pixels of a band window into a new or caller-supplied buffer.
+
+    Args:
+        band (snappy.Band): Band to read
+        window (tuple): Pixel window (x, y, width, height) to read
+        dtype (np.dtype, optional): Data type of the new buffer. Ignored if out is given. Defaults to np.float32
+        out (np.array, optional): Preallocated (height, width) buffer to fill. Defaults to None
+
+    Returns:
+        np.array: Band data
+    """
+    x, y, width, height = window
+    if out is None:
+        out = np.empty((height, width), dtype)
+    elif out.shape != (height, width):
+        raise ValueError("Output buffer shape {} does not match window shape {}".format(out.shape, (height, width)))
+
+    if out.dtype in _NATIVE_READ_TYPES and out.flags.c_contiguous:
+        band.readPixels(x, y, width, height, out)
+    else:
+        # Go through a small float32 buffer so that no full-size temporary is created
+        buffer = np.empty((min(_READ_CHUNK_ROWS, height), width), np.float32)
+        for row in range(0, height, _READ_CHUNK_ROWS):
+            rows = min(_READ_CHUNK_ROWS, height - row)
+            band.readPixels(x, y + row, width, rows, buffer[:rows])
+            out[row:row + rows] = buffer[:rows]
+    return out
+
+
+def _check_window(window, width, height):
+    """Returns the window, or the whole scene if window is None, after checking it lies inside the scene."""
+    if window is None:
+        return (0, 0, width, height)
+    x, y, w, h = window
+    if x < 0 or y < 0 or w <= 0 or h <= 0 or x + w > width or y + h > height:
+        raise ValueError("Window {} is outside the {}x{} scene".format(tuple(window), width, height))
+    return (x, y, w, h)
+
+
+def split_windows(width, height, block_width, block_height):
+    """Splits a scene into blocks, row by row.
+
+    Args:
+        width (int): Scene width in pixels
+        height (int): Scene height in pixels
+        block_width (int): Block width in pixels
+        block_height (int): Block height in pixels
+
+    Yields:
+        tuple: Pixel window (x, y, width, height) of each block. Blocks at the right and bottom edges can be smaller
+    """
+    for y in range(0, height, block_height):
+        for x in range(0, width, block_width):
+            yield (x, y, min(block_width, width - x), min(block_height, height - y))
+
+
+def block_windows(file_path, block_size=None):
+    """Iterates over the blocks of a product, following the product's native tiling.
+
+    Args:
+        file_path (str): Path to product
+        block_size (int, tuple, optional): Block size in pixels, as a single value or (width, height).
+            Defaults to the preferred tile size of the product
+
+    Yields:
+        tuple: Pixel window (x, y, width, height) of each block
+    """
+    info = _product_info(file_path)
+    width, height = info['width'], info['height']
+    if block_size is None:
+        if 'tile_size' not in info:
+            # Band images are stored row by row, so full-width row blocks are contiguous on disk
+            block_size = (width, max(1, DIMAP_BLOCK_PIXELS // width))
+        else:
+            block_size = info['tile_size'] or (width, height)
+    if np.isscalar(block_size):
+        block_size = (block_size, block_size)
+    for window in split_windows(width, height, *block_size):
+        yield window
+
+
+def read_snappy_product(file_path, band_name=None, dtype=np.float32, out=None, window=None):
+    """Reads a band of a product.
+
+    Args:
+        file_path (str): Path to product
+        band_name (str, optional): Name of the band to read. Defaults to the first band of the product
+        dtype (np.dtype, optional): Data type of the returned array. Defaults to np.float32
+        out (np.array, optional): Preallocated buffer with the shape of the window to read the data into. Defaults to None
+        window (tuple, optional): Pixel window (x, y, width, height) to read. Defaults to the whole scene
+
+    Returns:
+        tuple: Band data and product geocoding
+    """
+    info = _dimap_info(file_path)
+    if info is not None:
+        try:
+            window = _check_window(window, info['width'], info['height'])
+            data = du.read_dimap_band(file_path, band_name, dtype, out, window, info)
+            return data, info['geo_coding']
+        except du.DimapNotSupportedError:
+            pass
+
+    prod = _snappy().ProductIO.readProduct(file_path)
     width = prod.getSceneRasterWidth()
     height = prod.getSceneRasterHeight()
     geo_coding = prod.getSceneGeoCoding()
-    data = np.empty((height, width))
     if band_name is not None:
         band = prod.getBand(band_name)
     else:
         band = prod.getBandAt(0)
     try:
-        band.readPixels(0, 0, width, height, data)
-    except AttributeError:
+        if band is None:
+            raise RuntimeError(file_path + " does not contain band " + band_name)
+        data = _read_pixels(band, _check_window(window, width, height), dtype, out)
+    finally:
         prod.closeIO()
-        raise RuntimeError(file_path + " does not contain band " + band_name)
-    prod.closeIO()
     return data, geo_coding
 
 
-def write_snappy_product(file_path, bands, product_name, geo_coding):
+def read_snappy_bands(file_path, band_names, dtype=np.float32, out=None, window=None):
+    """Reads several bands of a product, opening the product only once.
+
+    Args:
+        file_path (str): Path to product
+        band_names (list): Names of the bands to read
+        dtype (np.dtype, optional): Data type of the returned arrays. Defaults to np.float32
+        out (list, optional): Preallocated buffers with the shape of the window, one for each band. Defaults to None
+        window (tuple, optional): Pixel window (x, y, width, height) to read. Defaults to the whole scene
+
+    Returns:
+        tuple: List with the band arrays (in the order of band_names) and the product geocoding
+    """
+    if out is None:
+        out = [None] * len(band_names)
+    info = _dimap_info(file_path)
+    if info is not None:
+        try:
+            window = _check_window(window, info['width'], info['height'])
+            data = [du.read_dimap_band(file_path, band_name, dtype, buffer, window, info)
+                    for band_name, buffer in zip(band_names, out)]
+            return data, info['geo_coding']
+        except du.DimapNotSupportedError:
+            pass
+
+    prod = _snappy().ProductIO.readProduct(file_path)
+    width = prod.getSceneRasterWidth()
+    height = prod.getSceneRasterHeight()
+    geo_coding = prod.getSceneGeoCoding()
+    data = []
     try:
-        (height, width) = bands[0]['band_data'].shape
-    except AttributeError:
-        raise RuntimeError(bands[0]['band_name'] + "contains no data.")
-    product = Product(product_name, product_name, width, height)
+        window = _check_window(window, width, height)
+        for band_name, buffer in zip(band_names, out):
+            band = prod.getBand(band_name)
+            if band is None:
+                raise RuntimeError(file_path + " does not contain band " + band_name)
+            data.append(_read_pixels(band, window, dtype, buffer))
+    finally:
+        prod.closeIO()
+    return data, geo_coding
+
+
+def read_snappy_products(products, max_workers=4, window=None):
+    """Reads bands from several products concurrently. Each product is opened only once.
+
+    Args:
+        products (list): List of (file_path, band_names) or (file_path, band_names, dtype) tuples
+        max_workers (int, optional): Number of products read at the same time. Defaults to 4
+        window (tuple, optional): Pixel window (x, y, width, height) to read from every product. Defaults to the whole scene
+
+    Returns:
+        list: (bands, geo_coding) tuple for each product, in the order of products
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(read_snappy_bands, *product, window=window) for product in products]
+        return [future.result() for future in futures]
+
+
+def create_snappy_product(file_path, bands, product_name, geo_coding, width, height):
+    """Creates an empty BEAM-DIMAP product on disk, to be filled block by block with write_snappy_product.
+
+    Args:
+        file_path (str): Path to store the product
+        bands (list): Band dictionaries with 'band_name' and optionally 'description' and 'unit' keys
+        product_name (str): Name of the product
+        geo_coding (snappy.GeoCoding, du.DimapGeoCoding): Geocoding of the product
+        width (int): Scene width in pixels
+        height (int): Scene height in pixels
+
+    Returns:
+        snappy.Product, du.dimap_writer: Product opened for writing. Close it with close_snappy_product
+    """
+    if isinstance(geo_coding, du.DimapGeoCoding):
+        return du.dimap_writer(file_path, bands, product_name, geo_coding, width, height)
+
+    snappy = _snappy()
+    product = snappy.Product(product_name, product_name, width, height)
     product.setSceneGeoCoding(geo_coding)
 
     # Ensure that output is saved in BEAM-DIMAP format, otherwise writeHeader does not work.
@@ -48,22 +329,114 @@ def write_snappy_product(file_path, bands, product_name, geo_coding):
     # Bands have to be created before header is written but header has to be written before band
     # data is written.
     for b in bands:
-        band = product.addBand(b['band_name'], ProductData.TYPE_FLOAT32)
+        data_type = snappy.ProductData.TYPE_UINT8 if du.write_data_type(b) == "uint8" else snappy.ProductData.TYPE_FLOAT32
+        band = product.addBand(b['band_name'], data_type)
         if 'description' in b.keys():
             band.setDescription(b['description'])
         if 'unit' in b.keys():
             band.setUnit(b['unit'])
-    product.setProductWriter(ProductIO.getProductWriter('BEAM-DIMAP'))
-    product.writeHeader(String(file_path))
+    product.setProductWriter(snappy.ProductIO.getProductWriter('BEAM-DIMAP'))
+    product.writeHeader(snappy.String(file_path))
+    return product
+
+
+def close_snappy_product(product):
+    """Closes a product created with create_snappy_product."""
+    if isinstance(product, du.dimap_writer):
+        product.close()
+    else:
+        product.closeIO()
+
+
+def write_snappy_product(file_path, bands, product_name, geo_coding, window=None, product=None):
+    """Writes bands to a BEAM-DIMAP product.
+
+    Without product, a new product the size of the band data is created, written and closed. With a
+    product from create_snappy_product, the band data is written into the given window of that product,
+    which is left open for the next block.
+
+    Args:
+        file_path (str): Path to store the product
+        bands (list): Band dictionaries with 'band_name', 'band_data' and optionally 'description' and 'unit' keys
+        product_name (str): Name of the product
+        geo_coding (snappy.GeoCoding, du.DimapGeoCoding): Geocoding of the product. Products with a geocoding
+            read in pure Python are also written in pure Python
+        window (tuple, optional): Pixel window (x, y, width, height) covered by the band data. Defaults to the whole scene
+        product (snappy.Product, du.dimap_writer, optional): Open product from create_snappy_product. Defaults to None
+    """
+    try:
+        (height, width) = bands[0]['band_data'].shape
+    except AttributeError:
+        raise RuntimeError(bands[0]['band_name'] + "contains no data.")
+    if product is None:
+        if window is not None:
+            raise ValueError("Writing a window requires a product from create_snappy_product")
+        if isinstance(geo_coding, du.DimapGeoCoding):
+            du.write_dimap_product(file_path, bands, product_name, geo_coding)
+            return
+        product = create_snappy_product(file_path, bands, product_name, geo_coding, width, height)
+        write_snappy_product(file_path, bands, product_name, geo_coding, product=product)
+        close_snappy_product(product)
+        return
+
+    if isinstance(product, du.dimap_writer):
+        window = _check_window(window, product.width, product.height)
+    else:
+        window = _check_window(window, product.getSceneRasterWidth(), product.getSceneRasterHeight())
+    if window[2:] != (width, height):
+        raise ValueError("Band data shape {} does not match window {}".format((height, width), window))
     for b in bands:
-        band = product.getBand(b['band_name'])
-        band.writePixels(0, 0, width, height, b['band_data'].astype(np.float32))
-    product.closeIO()
+        if isinstance(product, du.dimap_writer):
+            product.write(b['band_name'], b['band_data'], window)
+        else:
+            band = product.getBand(b['band_name'])
+            # Integer bands are written from int32 pixels
+            dtype = np.int32 if du.write_data_type(b) == "uint8" else np.float32
+            band.writePixels(window[0], window[1], width, height, np.ascontiguousarray(b['band_data'], dtype=dtype))
+
+
+def map_blocks(products, function, outputs, block_size=None, geo_coding_product=0, max_workers=4, pass_window=False):
+    """Applies a per-pixel function to products block by block, writing the results block by block.
+
+    Only one block of the inputs and outputs is held in memory at a time. As every output pixel only
+    depends on the input pixels at the same position, the results do not depend on the block size.
+
+    Args:
+        products (list): (file_path, band_names) tuples of the bands read for every block
+        function (callable): Called with the list of band lists of a block, in the order of products. Returns a
+            dict mapping output keys to dicts of band name and band data
+        outputs (dict): (file_path, product_name) of every output key to write. Other keys are ignored
+        block_size (int, tuple, optional): Block size in pixels, as a single value or (width, height). Defaults to the whole scene
+        geo_coding_product (int, optional): Index of the product whose geocoding is given to the outputs. Defaults to 0
+        max_workers (int, optional): Number of products read at the same time. Defaults to 4
+        pass_window (bool, optional): Also pass the pixel window (x, y, width, height) of the block to function. Defaults to False
+    """
+    template = products[geo_coding_product][0]
+    geo_coding, _, width, height = get_product_info(template)[1:]
+    windows = [None] if block_size is None else block_windows(template, block_size)
+    opened = {}
+    try:
+        for window in windows:
+            bands = [b for b, _ in read_snappy_products(products, max_workers, window)]
+            results = function(bands, window or (0, 0, width, height)) if pass_window else function(bands)
+            bands = None
+            for key, result in results.items():
+                if key not in outputs:
+                    continue
+                file_path, product_name = outputs[key]
+                band_data = [{'band_name': name, 'band_data': data} for name, data in result.items()]
+                if key not in opened:
+                    opened[key] = create_snappy_product(file_path, band_data, product_name, geo_coding, width, height)
+                write_snappy_product(file_path, band_data, product_name, geo_coding, window, opened[key])
+    finally:
+        for product in opened.values():
+            close_snappy_product(product)
 
 
 def copy_bands_to_file(src_file_path, dst_file_path, bands=None):
     # Get info from source product
-    src_prod = ProductIO.readProduct(src_file_path)
+    snappy = _snappy()
+    src_prod = snappy.ProductIO.readProduct(src_file_path)
     prod_name = src_prod.getName()
     prod_type = src_prod.getProductType()
     width = src_prod.getSceneRasterWidth()
@@ -72,10 +445,10 @@ def copy_bands_to_file(src_file_path, dst_file_path, bands=None):
         bands = src_prod.getBandNames()
 
     # Copy geocoding and selected bands from source to destination product
-    dst_prod = Product(prod_name, prod_type, width, height)
-    ProductUtils.copyGeoCoding(src_prod.getBandAt(0), dst_prod)
+    dst_prod = snappy.Product(prod_name, prod_type, width, height)
+    snappy.ProductUtils.copyGeoCoding(src_prod.getBandAt(0), dst_prod)
     for band in bands:
-        r = ProductUtils.copyBand(band, src_prod, dst_prod, True)
+        r = snappy.ProductUtils.copyBand(band, src_prod, dst_prod, True)
         if r is None:
             src_prod.closeIO()
             raise RuntimeError(src_file_path + " does not contain band " + band)
@@ -90,31 +463,17 @@ def copy_bands_to_file(src_file_path, dst_file_path, bands=None):
         file_type = 'GeoTIFF-BigTIFF'
     else:
         file_type = 'GeoTIFF-BigTIFF'
-    ProductIO.writeProduct(dst_prod, dst_file_path, file_type)
+    snappy.ProductIO.writeProduct(dst_prod, dst_file_path, file_type)
     src_prod.closeIO()
     dst_prod.closeIO()
 
 
 def get_bands_info(src_file_path):
-    # Get info from source product
-    src_prod = ProductIO.readProduct(src_file_path)
-    bands = src_prod.getBands()
-    bands_info = []
-    for band in bands:
-        bands_info.append({'band_name': band.getName(), 'description': band.getDescription(),
-                           'unit': band.getUnit()})
-    src_prod.closeIO()
-    return bands_info
+    info = _product_info(src_file_path)
+    return [{'band_name': band['band_name'], 'description': band['description'], 'unit': band['unit']}
+            for band in info['bands']]
 
 
 def get_product_info(src_file_path):
-    # Get info from source product
-    prod = ProductIO.readProduct(src_file_path)
-    width = prod.getSceneRasterWidth()
-    height = prod.getSceneRasterHeight()
-    geo_coding = prod.getSceneGeoCoding()
-    name = prod.getName()
-    prod_type = prod.getProductType()
-    prod.closeIO()
-
-    return name, geo_coding, prod_type,  width, height
+    info = _product_info(src_file_path)
+    return info['name'], info['geo_coding'], info['product_type'], info['width'], info['height']
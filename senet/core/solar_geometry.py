@@ -0,0 +1,201 @@
+import os
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# Spacing in pixels of the coarse grid the location dependent terms are evaluated on
+COARSE_STEP = 16
+# Number of rows of the blocks interpolated in parallel
+BLOCK_ROWS = 256
+
+# Position of the sun for a location and time:
+#   declination: declination angle [radians]
+#   hour_angle: hour angle [radians]
+#   cos_zenith: cosine of the solar zenith angle, i.e. cosine of the incidence angle over a flat surface
+#   cos_aspect_coef, sin_aspect_coef: coefficients of sin(slope) * cos(aspect) and sin(slope) * sin(aspect)
+#       in the cosine of the incidence angle over a tilted surface (see incidence_angle)
+sun_position = namedtuple("sun_position", ["declination", "hour_angle", "cos_zenith", "cos_aspect_coef",
+                                           "sin_aspect_coef"])
+
+
+def declination_angle(doy:int):
+    """Calculates the Earth declination angle.
+
+    Args:
+        doy (int, float): Day of year
+
+    Returns:
+        float: Declination angle [radians]
+    """
+
+    declination = np.radians(23.45) * np.sin((2.0 * np.pi * doy / 365.0) - 1.39)
+
+    return declination
+
+
+def hour_angle(ftime:float, declination:float, lon:float, stdlon:float = .0):
+    """Calculates the hour angle.
+
+    Args:
+        ftime (float): Time of the day [decimal hours]
+        declination (float): Declination angle [radians]
+        lon (float): Longitude of the site [degrees]
+        stdlon (float, optional): Longitude of the standard meridian that represents ftime time zone. Defaults to 0.
+
+    Returns:
+        float: hour angle [radians]
+    """
+
+    EOT = 0.258 * np.cos(declination) - 7.416 * np.sin(declination) - \
+          3.648 * np.cos(2.0 * declination) - 9.228 * np.sin(2.0 * declination)
+    LC = (stdlon - lon) / 15.
+    time_corr = (-EOT / 60.) + LC
+    solar_time = ftime - time_corr
+    # Get the hour angle
+    w = np.radians((12.0 - solar_time) * 15.)
+
+    return w
+
+
+def incidence_angle_tilted(lat:float, lon:float, doy:int, ftime:float, stdlon:float = .0, A_ZS:float = .0, slope:float = .0):
+    """Calculates the incidence solar angle over a tilted flat surface.
+
+    Args:
+        lat (float, np.array): Latitude [degrees]
+        lon (float, np.array): Longitude [degrees]
+        doy (int): Day of year
+        ftime (float): Time of the day [decimal hours]
+        stdlon (float, optional): Longitude of the standard meridian that represents ftime time zone. Defaults to .0
+        A_ZS (float, np.array, optional): Surface azimuth angle, measured clockwise from north [degrees]. Defaults to .0
+        slope (float, optional): Slope angle [degrees]. Defaults to .0
+
+    Returns:
+        [float, np.array]: Cosine of the incidence angle
+    """
+
+    # Get the declination and hour angle
+    delta = declination_angle(doy)
+    omega = hour_angle(ftime, delta, lon, stdlon=stdlon)
+
+    # Convert remaining angles into radians
+    lat, A_ZS, slope = map(np.radians, [lat, A_ZS, slope])
+
+    cos_theta_i = (np.sin(delta) * np.sin(lat) * np.cos(slope)
+                   + np.sin(delta) * np.cos(lat) * np.sin(slope) * np.cos(A_ZS)
+                   + np.cos(delta) * np.cos(lat) * np.cos(slope) * np.cos(omega)
+                   - np.cos(delta) * np.sin(lat) * np.sin(slope) * np.cos(A_ZS) * np.cos(omega)
+                   - np.cos(delta) * np.sin(slope) * np.sin(A_ZS) * np.sin(omega))
+
+    return cos_theta_i
+
+
+def solar_position(lat:np.array, lon:np.array, doy:int, ftime:float, stdlon:float = .0):
+    """Calculates the declination, hour angle and the terms of the incidence angle of the sun in one call.
+
+    Args:
+        lat (float, np.array): Latitude [degrees]
+        lon (float, np.array): Longitude [degrees]
+        doy (int): Day of year
+        ftime (float): Time of the day [decimal hours]
+        stdlon (float, optional): Longitude of the standard meridian that represents ftime time zone. Defaults to .0
+
+    Returns:
+        sun_position: Position of the sun
+    """
+    delta = declination_angle(doy)
+    omega = hour_angle(ftime, delta, lon, stdlon=stdlon)
+    lat = np.radians(lat)
+    sin_delta, cos_delta = np.sin(delta), np.cos(delta)
+    sin_lat, cos_lat, cos_omega = np.sin(lat), np.cos(lat), np.cos(omega)
+
+    return sun_position(delta, omega,
+                        sin_delta * sin_lat + cos_delta * cos_lat * cos_omega,
+                        sin_delta * cos_lat - cos_delta * sin_lat * cos_omega,
+                        -cos_delta * np.sin(omega))
+
+
+def terrain_terms(slope:np.array, aspect:np.array):
+    """Trigonometric terms of the terrain used by incidence_angle, which can be computed once per tile.
+
+    Args:
+        slope (np.array): Slope angle [degrees]
+        aspect (np.array): Surface azimuth angle, measured clockwise from north [degrees]
+
+    Returns:
+        tuple: cos(slope), sin(slope) * cos(aspect) and sin(slope) * sin(aspect) as float32 arrays
+    """
+    slope, aspect = np.radians(slope), np.radians(aspect)
+    sin_slope = np.sin(slope)
+    return (np.cos(slope).astype(np.float32), (sin_slope * np.cos(aspect)).astype(np.float32),
+            (sin_slope * np.sin(aspect)).astype(np.float32))
+
+
+def _coarse_nodes(size:int, step:int):
+    """Pixel positions of the coarse grid nodes, including the last pixel, and the lower node and weight of
+    every pixel."""
+    nodes = np.unique(np.r_[0:size:step, size - 1])
+    if len(nodes) == 1:
+        nodes = np.r_[nodes, nodes]
+    pixels = np.arange(size)
+    lower = np.minimum(np.searchsorted(nodes, pixels, side="right") - 1, len(nodes) - 2)
+    weight = (pixels - nodes[lower]) / np.maximum(nodes[lower + 1] - nodes[lower], 1)
+    return nodes, lower, weight.astype(np.float32)
+
+
+def incidence_angle(lat:np.array, lon:np.array, doy:int, ftime:float, stdlon:float = .0, terrain:tuple = None,
+                    coarse_step:int = COARSE_STEP, workers:int = None):
+    """Calculates the cosine of the solar incidence angle over a scene.
+
+    The location dependent terms (see solar_position) are smooth, so they are evaluated on a grid of every
+    coarse_step-th pixel and bilinearly interpolated in float32, which gives errors of the order of 1e-7 at the
+    resolution of Sentinel 2. The interpolation and the combination with the terrain terms run in parallel
+    blocks of rows.
+
+    Args:
+        lat (np.array): Latitude of every pixel [degrees]. Only the coarse grid pixels are read
+        lon (np.array): Longitude of every pixel [degrees]. Only the coarse grid pixels are read
+        doy (int): Day of year
+        ftime (float): Time of the day [decimal hours]
+        stdlon (float, optional): Longitude of the standard meridian that represents ftime time zone. Defaults to .0
+        terrain (tuple, optional): Terrain terms from terrain_terms. Defaults to a flat surface
+        coarse_step (int, optional): Spacing of the coarse grid in pixels. Defaults to COARSE_STEP
+        workers (int, optional): Number of blocks processed at the same time. Defaults to all cores
+
+    Returns:
+        np.array: Cosine of the incidence angle (float32)
+    """
+    height, width = np.shape(lat)
+    rows, row_lower, row_weight = _coarse_nodes(height, coarse_step)
+    cols, col_lower, col_weight = _coarse_nodes(width, coarse_step)
+    col_upper = col_lower + 1
+    grid = np.ix_(rows, cols)
+    position = solar_position(np.asarray(lat[grid], np.float64), np.asarray(lon[grid], np.float64), doy, ftime, stdlon)
+    coarse = [np.asarray(term, np.float32) for term in
+              ([position.cos_zenith] if terrain is None else position[2:])]
+    cos_theta = np.empty((height, width), np.float32)
+
+    def interpolate(start):
+        stop = min(start + BLOCK_ROWS, height)
+        lower, weight = row_lower[start:stop], row_weight[start:stop, np.newaxis]
+        out = cos_theta[start:stop]
+        for k, term in enumerate(coarse):
+            # Along the rows on the coarse columns, then along the columns
+            term_rows = np.take(term, lower, axis=0)
+            term_rows += (np.take(term, lower + 1, axis=0) - term_rows) * weight
+            value = np.take(term_rows, col_lower, axis=1)
+            step = np.take(term_rows, col_upper, axis=1)
+            step -= value
+            step *= col_weight
+            value += step
+            if terrain is not None:
+                value *= terrain[k][start:stop]
+            if k == 0:
+                out[...] = value
+            else:
+                out += value
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        list(executor.map(interpolate, range(0, height, BLOCK_ROWS)))
+    return cos_theta
@@ -0,0 +1,97 @@
+import os
+import json
+import uuid
+import shutil
+import hashlib
+import contextlib
+import numpy as np
+
+
+class static_layers():
+    """Store of the raster layers that do not change between the acquisitions of a tile (e.g. landcover
+    derived parameters).
+
+    The layers of a key (e.g. tile, area of interest and resolution) are stored in their own folder as .npy
+    files, which are loaded as read-only memory maps so that a block of a layer is read without loading the
+    whole scene. Layers are built once, in a temporary folder that is only moved into the store when all
+    layers were written, so that an interrupted build is never loaded.
+    """
+
+    def __init__(self, store_dir:str, **key):
+        """
+        Args:
+            store_dir (str): Folder of the store
+            **key: Values identifying the layers, which must be serializable to JSON or have a stable str
+        """
+        self.store_dir = store_dir
+        self.key = key
+        digest = hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+        self.folder = os.path.join(store_dir, digest[:16])
+
+    def sub(self, **key):
+        """Returns the store of the layers that depend on additional values, in a subfolder of this store."""
+        return static_layers(self.folder, **key)
+
+    def path(self, name:str):
+        """Path to the .npy file of a layer."""
+        return os.path.join(self.folder, name + ".npy")
+
+    def has(self, *names:str):
+        """True if all the given layers are stored."""
+        return all(os.path.exists(self.path(name)) for name in names)
+
+    def load(self, name:str, window:tuple = None):
+        """Loads a layer as a read-only memory map.
+
+        Args:
+            name (str): Layer name
+            window (tuple, optional): Pixel window (x, y, width, height) to return. Defaults to the whole scene
+
+        Returns:
+            np.memmap: Layer data
+        """
+        data = np.load(self.path(name), mmap_mode="r")
+        if window is None:
+            return data
+        x, y, width, height = window
+        return data[y:y + height, x:x + width]
+
+    @contextlib.contextmanager
+    def build(self, layers:dict, shape:tuple):
+        """Creates layers to be filled, which are stored when the context exits without an error.
+
+        Args:
+            layers (dict): Data type of every layer name
+            shape (tuple): Scene shape (height, width)
+
+        Yields:
+            dict: Writable memory map of every layer name
+        """
+        temp_dir = os.path.join(self.store_dir, "tmp-" + uuid.uuid4().hex)
+        os.makedirs(temp_dir)
+        try:
+            arrays = {name: np.lib.format.open_memmap(os.path.join(temp_dir, name + ".npy"), "w+", dtype, shape)
+                      for name, dtype in layers.items()}
+            yield arrays
+            for array in arrays.values():
+                array.flush()
+            if not os.path.exists(self.folder):
+                os.makedirs(self.folder, exist_ok=True)
+            with open(os.path.join(self.folder, "key.json"), "w") as fp:
+                json.dump(self.key, fp, indent=4, sort_keys=True, default=str)
+            for name in layers:
+                os.replace(os.path.join(temp_dir, name + ".npy"), self.path(name))
+            print("INFO: Stored static layers {} in {}".format(", ".join(layers), self.folder))
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    def store(self, layers:dict):
+        """Stores whole scene layers.
+
+        Args:
+            layers (dict): Data of every layer name, all with the same shape
+        """
+        shape = next(iter(layers.values())).shape
+        with self.build({name: data.dtype for name, data in layers.items()}, shape) as arrays:
+            for name, data in layers.items():
+                arrays[name][...] = data
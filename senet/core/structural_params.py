@@ -1,30 +1,138 @@
 import numpy as np
 import senet.core.snappy_utils as su
 import os
+import hashlib
+import functools
+import contextlib
+from senet.core.static_layers import static_layers
 path =  os.path.dirname(os.path.abspath(__file__))
 auxdata = os.path.join(path, "../auxdata")
 
-def _estimate_param_value(landcover:np.array, lut:dict, band:str): 
-    """Get LUT value for a category.
+def read_lookup_table(lookup_table:str):
+    """Reads a landcover look-up table (LUT).
 
     Args:
-        landcover (np.array): Array with landcover values
-        lut (dict): Dictionary with landcover values as keys and auxiliary values
-        band (str): lut dictionary key value 
+        lookup_table (str): Path to the semicolon separated LUT
 
     Returns:
-        float: Value for a specific band
+        dict: LUT column names as keys and column values as lists
     """
-    param_value = np.ones(landcover.shape) + np.nan
+    with open(lookup_table, 'r') as fp:
+        lines = fp.readlines()
+    headers = lines[0].rstrip().split(';')
+    values = [x.rstrip().split(';') for x in lines[1:]]
+    return {key: [float(x[idx]) for x in values if len(x) == len(headers)]
+            for idx, key in enumerate(headers)}
+
+@functools.lru_cache(maxsize=None)
+def _lookup_columns(lookup_table:str):
+    """Reads a LUT once per process.
+
+    Every column is returned as an array with one extra NaN row, which is the value of the pixels
+    without a landcover class (see _landcover_index).
+
+    Args:
+        lookup_table (str): Path to the semicolon separated LUT
+
+    Returns:
+        dict: LUT column names as keys and read-only column arrays
+    """
+    columns = {}
+    for key, values in read_lookup_table(lookup_table).items():
+        column = np.append(np.array(values, np.float64), np.nan)
+        column.setflags(write=False)
+        columns[key] = column
+    return columns
 
-    for lc_class in np.unique(landcover[~np.isnan(landcover)]):
-        lc_pixels = np.where(landcover == lc_class)
-        lc_index = lut['landcover_class'].index(lc_class)
-        param_value[lc_pixels] = lut[band][lc_index]
+def _landcover_index(landcover:np.array, classes:np.array):
+    """Converts landcover classes to the LUT rows of the classes.
+
+    Args:
+        landcover (np.array): Landcover classes
+        classes (np.array): landcover_class column of the LUT, including the NaN row
+
+    Returns:
+        np.array: LUT row of every pixel (the NaN row for pixels without a class), as uint8 if the LUT is small enough
+    """
+    n_rows = len(classes) - 1
+    # Rows of the sorted classes, keeping the first row of repeated classes
+    sorted_classes, first_row = np.unique(classes[:-1], return_index=True)
+    position = np.minimum(np.searchsorted(sorted_classes, landcover), len(sorted_classes) - 1)
+    found = sorted_classes[position] == landcover
+    missing = ~found & ~np.isnan(landcover)
+    if np.any(missing):
+        raise ValueError(f"{landcover[missing][0]} is not a class of the look-up table")
+    index = np.where(found, first_row[position], n_rows)
+    return index.astype(np.min_scalar_type(n_rows))
+
+# Parameters that only depend on the landcover, which can be kept in a static_layers store of the tile
+STATIC_BANDS = ['veg_fractional_cover', 'veg_height_width_ratio', 'veg_leaf_width', 'veg_inclination_distribution',
+                'igbp_classification']
+
+def _check_lookup_table(lut:dict):
+    """Prints the parameters missing in a LUT and returns False if any is missing."""
+    PARAMS = ['veg_height', 'lai_max', 'is_herbaceous', 'veg_fractional_cover',
+              'veg_height_width_ratio', 'veg_leaf_width', 'veg_inclination_distribution',
+              'igbp_classification'
+              ]
+
+    for param in PARAMS:
+        if param not in lut.keys():
+            print(f'Error: Missing {param} in the look-up table')
+            return False
+    return True
+
+def _veg_height(lc_index:np.array, lai:np.array, fg:np.array, lut:dict):
+    """Vegetation height of the LUT, depending on the plant area index in herbaceous vegetation."""
+    param_value = np.take(lut['veg_height'].astype(np.float32), lc_index)
+
+    # Vegetation height in herbaceous vegetation depends on plant area index
+    herbaceous = np.flatnonzero(np.take(lut['is_herbaceous'] == 1, lc_index))
+    if herbaceous.size:
+        pai = np.take(lai, herbaceous) / np.take(fg, herbaceous)
+        height = np.take(param_value, herbaceous)
+        np.put(param_value, herbaceous, 0.1 * height + 0.9 * height * np.minimum((pai / height)**3.0, 1.0))
     return param_value
 
+def compute_str_parameters(landcover:np.array, lai:np.array, fg:np.array, produce_vh:bool, produce_fc:bool,
+    produce_chwr:bool, produce_lw:bool, produce_lid:bool, produce_igbp:bool, lookup_table:str = os.path.join(auxdata, "LUT/ESA_CCI_LUT.csv")):
+    """Produces maps of vegetation structural parameters required for TSEB model, based on a land cover map and a look-up table (LUT).
+
+    Args:
+        landcover (np.array): Landcover classes
+        lai (np.array): Leaf area index
+        fg (np.array): Fraction of green vegetation
+        produce_vh (bool): Indicate if the vegetation height maps should be produced
+        produce_fc (bool): Indicate if the vegetation fractional cover maps should be produced
+        produce_chwr (bool): Indicate if the canopy to width ratio maps should be produced
+        produce_lw (bool): Indicate if the leaf width maps should be produced
+        produce_lid (bool): Indicate if the leaf inclination distribution maps should be produced
+        produce_igbp (bool): Indicate if the landcover map with IGBP classes should be produced
+        lookup_table (str, optional): Path to LUT table data. Defaults to "../auxdata/LUT/ESA_CCI_LUT.csv"
+
+    Returns:
+        dict: Band name and data of the structural parameters, or None if the LUT misses a parameter
+    """
+    lut = _lookup_columns(lookup_table)
+    if not _check_lookup_table(lut):
+        return None
+
+    # LUT row of every pixel, after which every parameter is a single gather
+    lc_index = _landcover_index(landcover, lut['landcover_class'])
+    bands = {}
+
+    if produce_vh:
+        bands['veg_height'] = _veg_height(lc_index, lai, fg, lut)
+
+    for produce, band_name in zip([produce_fc, produce_chwr, produce_lw, produce_lid, produce_igbp], STATIC_BANDS):
+        if produce:
+            bands[band_name] = np.take(lut[band_name], lc_index)
+
+    return bands
+
 def str_parameters(landcover_map:str, lai_map:str, fgv_map:str, landcover_band:str, produce_vh:bool, produce_fc:bool,
-    produce_chwr:bool, produce_lw:bool, produce_lid:bool, produce_igbp:bool, output_file:str, lookup_table:str = os.path.join(auxdata, "LUT/ESA_CCI_LUT.csv")):
+    produce_chwr:bool, produce_lw:bool, produce_lid:bool, produce_igbp:bool, output_file:str, lookup_table:str = os.path.join(auxdata, "LUT/ESA_CCI_LUT.csv"),
+    block_size:int = None, static:static_layers = None):
     """Produces maps of vegetation structural parameters required for TSEB model, based on a land cover map and a look-up table (LUT).
 
     Args:
@@ -40,70 +148,59 @@ def str_parameters(landcover_map:str, lai_map:str, fgv_map:str, landcover_band:s
         produce_igbp (bool): Indicate if the landcover map with IGBP classes should be produced
         output_file (str): Path to store product containing the maps of vegetation structural parameters
         lookup_table (str, optional): Path to LUT table data. Defaults to "../auxdata/LUT/ESA_CCI_LUT.csv"
+        block_size (int, optional): Process the scene in blocks of block_size x block_size pixels to bound memory use. Defaults to the whole scene
+        static (static_layers, optional): Store of the static layers of the tile. The landcover classes and the parameters
+            that only depend on them are stored on the first run and loaded afterwards, so that only the vegetation height
+            is computed and the landcover product is not read. Defaults to computing all parameters
     """
+    lut = _lookup_columns(lookup_table)
+    # Nothing is written if the LUT misses a parameter
+    if not _check_lookup_table(lut):
+        return
+    produced = [band for produce, band in zip([produce_fc, produce_chwr, produce_lw, produce_lid, produce_igbp],
+                                              STATIC_BANDS) if produce]
+    outputs = {'landcoverParams': (output_file, 'landcoverParams')}
 
-    # Read the required data
-    PARAMS = ['veg_height', 'lai_max', 'is_herbaceous', 'veg_fractional_cover',
-              'veg_height_width_ratio', 'veg_leaf_width', 'veg_inclination_distribution',
-              'igbp_classification'
-              ]
-    
-    landcover, geo_coding = su.read_snappy_product(landcover_map, landcover_band)
-    landcover = landcover.astype(np.float32)
-    lai = su.read_snappy_product(lai_map, 'lai')[0].astype(np.float32)
-    fg = su.read_snappy_product(fgv_map, 'frac_green')[0].astype(np.float32)
-    with open(lookup_table, 'r') as fp:
-        lines = fp.readlines()
-    headers = lines[0].rstrip().split(';')
-    values = [x.rstrip().split(';') for x in lines[1:]]
-    lut = {key: [float(x[idx]) for x in values if len(x) == len(headers)]
-            for idx, key in enumerate(headers)}
-    for param in PARAMS:
-        if param not in lut.keys():
-            print(f'Error: Missing {param} in the look-up table')
+    if static is not None:
+        with open(lookup_table, 'rb') as fp:
+            static = static.sub(lookup_table=hashlib.sha256(fp.read()).hexdigest(), landcover_band=landcover_band)
+        if static.has('landcover_index', *STATIC_BANDS):
+            def compute_static(bands, window):
+                [lai], [fg] = bands
+                params = {}
+                if produce_vh:
+                    params['veg_height'] = _veg_height(static.load('landcover_index', window), lai, fg, lut)
+                for band_name in produced:
+                    params[band_name] = static.load(band_name, window)
+                return {'landcoverParams': params}
+
+            su.map_blocks([(lai_map, ['lai']), (fgv_map, ['frac_green'])], compute_static, outputs, block_size,
+                          pass_window=True)
             return
 
-    band_data = []
-    param_value = np.ones(landcover.shape, np.float32) + np.nan
+    def compute(bands, window):
+        [landcover], [lai], [fg] = bands
+        lc_index = _landcover_index(landcover, lut['landcover_class'])
+        params = {}
+        if produce_vh:
+            params['veg_height'] = _veg_height(lc_index, lai, fg, lut)
+        for band_name in STATIC_BANDS:
+            if band_name in produced or layers is not None:
+                params[band_name] = np.take(lut[band_name], lc_index)
+        if layers is not None:
+            x, y, width, height = window
+            layers['landcover_index'][y:y + height, x:x + width] = lc_index
+            for band_name in STATIC_BANDS:
+                layers[band_name][y:y + height, x:x + width] = params[band_name]
+        return {'landcoverParams': {name: data for name, data in params.items()
+                                    if name == 'veg_height' or name in produced}}
 
-    if produce_vh:
-        for lc_class in np.unique(landcover[~np.isnan(landcover)]):
-            lc_pixels = np.where(landcover == lc_class)
-            lc_index = lut["landcover_class"].index(lc_class)
-            param_value[lc_pixels] = lut['veg_height'][lc_index]
-
-            # Vegetation height in herbaceous vegetation depends on plant area index
-            if lut["is_herbaceous"][lc_index] == 1:
-                pai = lai / fg
-                pai = pai[lc_pixels]
-                param_value[lc_pixels] = \
-                    0.1 * param_value[lc_pixels] + 0.9 * param_value[lc_pixels] *\
-                    np.minimum((pai / lut['veg_height'][lc_index])**3.0, 1.0)
-        band_data.append({'band_name': 'veg_height', 'band_data': param_value})
-    
-    if produce_fc:
-        band_name = 'veg_fractional_cover'
-        param_value = _estimate_param_value(landcover, lut, band_name)
-        band_data.append({'band_name': band_name, 'band_data': param_value})
-    
-    if produce_chwr:
-        band_name = 'veg_height_width_ratio'
-        param_value = _estimate_param_value(landcover, lut, band_name)
-        band_data.append({'band_name': band_name, 'band_data': param_value})
-
-    if produce_lw:
-        band_name = 'veg_leaf_width'
-        param_value = _estimate_param_value(landcover, lut, band_name)
-        band_data.append({'band_name': band_name, 'band_data': param_value})
-
-    if produce_lid:
-        band_name = 'veg_inclination_distribution'
-        param_value = _estimate_param_value(landcover, lut, band_name)
-        band_data.append({'band_name': band_name, 'band_data': param_value})
-
-    if produce_igbp:
-        band_name = 'igbp_classification'
-        param_value = _estimate_param_value(landcover, lut, band_name)
-        band_data.append({'band_name': band_name, 'band_data': param_value})
-
-    su.write_snappy_product(output_file, band_data, 'landcoverParams', geo_coding)
\ No newline at end of file
+    products = [(landcover_map, [landcover_band]), (lai_map, ['lai']), (fgv_map, ['frac_green'])]
+    build = contextlib.nullcontext()
+    if static is not None:
+        width, height = su.get_product_info(landcover_map)[3:]
+        layer_types = dict([('landcover_index', np.min_scalar_type(len(lut['landcover_class']) - 1))] +
+                           [(band_name, np.float32) for band_name in STATIC_BANDS])
+        build = static.build(layer_types, (height, width))
+    with build as layers:
+        su.map_blocks(products, compute, outputs, block_size, pass_window=True)
@@ -0,0 +1,126 @@
+from collections import namedtuple
+import numpy as np
+
+# Settings of the surrogate model of TSEB:
+#   sample_fraction: fraction of the pixels of every stratum run with the exact model
+#   min_stratum_samples: minimum number of pixels run with the exact model in every stratum
+#   lai_bins, lst_bins: number of LAI and LST quantile bins of the strata, within every landcover class
+#   n_estimators: number of trees of the regressor
+#   max_uncertainty: largest spread of the tree predictions, relative to the spread of the sampled outputs,
+#       accepted for a predicted pixel. Pixels above it are run with the exact model
+#   min_train_samples: minimum number of valid sampled pixels to fit the regressor, otherwise all pixels are exact
+#   seed: seed of the sampling and of the regressor
+surrogate_options = namedtuple("surrogate_options", ["sample_fraction", "min_stratum_samples", "lai_bins", "lst_bins",
+                                                     "n_estimators", "max_uncertainty", "min_train_samples", "seed"],
+                               defaults=(0.05, 20, 4, 4, 50, 0.1, 100, 0))
+
+
+def strata(landcover:np.array, lai:np.array, lst:np.array, options:surrogate_options):
+    """Assigns every pixel to a stratum of landcover class, LAI quantile bin and LST quantile bin.
+
+    Args:
+        landcover (np.array): Landcover class of every pixel, or None to stratify by LAI and LST only
+        lai (np.array): Leaf area index of every pixel
+        lst (np.array): Land surface temperature of every pixel [K]
+        options (surrogate_options): Surrogate settings
+
+    Returns:
+        np.array: Stratum index of every pixel, from 0 to the number of strata - 1
+    """
+    def quantile_bins(values, n_bins):
+        if len(values) == 0 or n_bins <= 1:
+            return np.zeros(len(values), np.intp)
+        edges = np.nanquantile(values, np.linspace(0, 1, n_bins + 1)[1:-1])
+        return np.digitize(values, edges)
+
+    classes = np.zeros(len(lai), np.intp) if landcover is None else np.unique(landcover, return_inverse=True)[1]
+    keys = (classes * options.lai_bins + quantile_bins(lai, options.lai_bins)) * options.lst_bins + \
+        quantile_bins(lst, options.lst_bins)
+    return np.unique(keys, return_inverse=True)[1].reshape(-1)
+
+
+def stratified_sample(stratum:np.array, options:surrogate_options):
+    """Draws a random sample of the pixels of every stratum.
+
+    Every stratum contributes sample_fraction of its pixels, but at least min_stratum_samples (or all of its
+    pixels if it has fewer).
+
+    Args:
+        stratum (np.array): Stratum index of every pixel (see strata)
+        options (surrogate_options): Surrogate settings
+
+    Returns:
+        np.array: Sorted indices of the sampled pixels
+    """
+    if len(stratum) == 0:
+        return np.empty(0, np.intp)
+    rng = np.random.default_rng(options.seed)
+    counts = np.bincount(stratum)
+    n_samples = np.maximum(np.minimum(counts, options.min_stratum_samples),
+                           np.ceil(counts * options.sample_fraction).astype(np.intp))
+    # Shuffle, then group by stratum keeping the shuffled order, and keep the first pixels of every stratum
+    order = rng.permutation(len(stratum))
+    order = order[np.argsort(stratum[order], kind="stable")]
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    rank = np.arange(len(order)) - starts[stratum[order]]
+    return np.sort(order[rank < n_samples[stratum[order]]])
+
+
+def fit_surrogate(features:np.array, targets:np.array, options:surrogate_options, workers:int = None):
+    """Fits an extremely randomized trees regressor of the model outputs.
+
+    Trees are fitted on bootstrap samples, so that the out-of-bag predictions give the error of the
+    surrogate on the sampled pixels.
+
+    Args:
+        features (np.array): Model inputs of the sampled pixels, with shape (pixels, inputs)
+        targets (np.array): Model outputs of the sampled pixels, with shape (pixels, outputs)
+        options (surrogate_options): Surrogate settings
+        workers (int, optional): Number of parallel jobs. Defaults to all cores
+
+    Returns:
+        sklearn.ensemble.ExtraTreesRegressor: Fitted regressor
+    """
+    from sklearn.ensemble import ExtraTreesRegressor
+
+    regressor = ExtraTreesRegressor(n_estimators=options.n_estimators, bootstrap=True, oob_score=True,
+                                    n_jobs=-1 if workers is None else workers, random_state=options.seed)
+    return regressor.fit(features, targets)
+
+
+def surrogate_error(regressor, targets:np.array):
+    """Out-of-bag error of the surrogate on the sampled pixels.
+
+    Args:
+        regressor (sklearn.ensemble.ExtraTreesRegressor): Regressor from fit_surrogate
+        targets (np.array): Model outputs of the sampled pixels, with shape (pixels, outputs)
+
+    Returns:
+        np.array, np.array: Root mean square error and mean bias (predicted - exact) of every output
+    """
+    error = np.reshape(regressor.oob_prediction_, targets.shape) - targets
+    with np.errstate(invalid="ignore"):
+        return np.sqrt(np.nanmean(error**2, axis=0)), np.nanmean(error, axis=0)
+
+
+def predict_surrogate(regressor, features:np.array, chunk_size:int = 65536):
+    """Predicts the model outputs and their uncertainty.
+
+    Args:
+        regressor (sklearn.ensemble.ExtraTreesRegressor): Regressor from fit_surrogate
+        features (np.array): Model inputs, with shape (pixels, inputs)
+        chunk_size (int, optional): Number of pixels predicted at once, bounding the memory of the per-tree predictions. Defaults to 65536
+
+    Returns:
+        np.array, np.array: Mean and standard deviation of the tree predictions, with shape (pixels, outputs)
+    """
+    n_outputs = regressor.n_outputs_
+    mean = np.empty((len(features), n_outputs))
+    spread = np.empty((len(features), n_outputs))
+    for start in range(0, len(features), chunk_size):
+        chunk = features[start:start + chunk_size]
+        predictions = np.stack([np.reshape(tree.predict(chunk), (len(chunk), n_outputs))
+                                for tree in regressor.estimators_])
+        mean[start:start + len(chunk)] = predictions.mean(axis=0)
+        spread[start:start + len(chunk)] = predictions.std(axis=0)
+    return mean, spread
@@ -1,5 +1,3 @@
-import tempfile
-import os
 import senet.core.gdal_utils as gu
 import senet.core.snappy_utils as su
 
@@ -40,15 +38,9 @@ def warp(source:str, template:str, output:str, resample_algorithm:str = "cubicsp
             +------------+-------------------+
             For more information see `here <https://gdal.org/programs/gdalwarp.html> _`.\n
     """
-    # Save source and template to GeoTIFF because it will need to be read by GDAL
-    temp_file = tempfile.NamedTemporaryFile(suffix=".tif", delete=False)
-    temp_source_path = temp_file.name
-    temp_file.close()
-    su.copy_bands_to_file(source, temp_source_path)
-    temp_file = tempfile.NamedTemporaryFile(suffix=".tif", delete=False)
-    temp_template_path = temp_file.name
-    temp_file.close()
-    su.copy_bands_to_file(template, temp_template_path)
+    # Make source and template readable by GDAL
+    temp_source_path = gu.product_to_gdal(source)
+    temp_template_path = gu.product_to_gdal(template)
 
     # Wrap the source based on tamplate
     wrapped = gu.resample_with_gdalwarp(temp_source_path, temp_template_path, resample_algorithm)
@@ -62,7 +54,7 @@ def warp(source:str, template:str, output:str, resample_algorithm:str = "cubicsp
 
     # Clean up
     try:
-        os.remove(temp_source_path)
-        os.remove(temp_template_path)
+        gu.remove_gdal_file(temp_source_path)
+        gu.remove_gdal_file(temp_template_path)
     except Exception:
         pass
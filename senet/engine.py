@@ -1,55 +1,395 @@
+import os
+import math
+import time
+from functools import partial
+from datetime import timedelta
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from senet.cache import step_cache
+from senet.sentinels import sentinel2, sentinel3
+from senet.timezone import get_offset
+from senet.core import graphs, snappy_utils, dimap_utils, gdal_utils, packed_pixels, ecmwf_utils, static_layers, \
+    solar_geometry, sharpener_models
+from senet.core.graphs import s2_preprocessing, elevation, landcover, s3_preprocessing
+from senet.core.leaf_spectra import leaf_spectra
+from senet.core.frac_green import fraction_green
+from senet.core.structural_params import str_parameters
+from senet.core.aerodynamic_roughness import aerodynamic_roughness
+from senet.core.warp_to_template import warp
+from senet.core.data_mining_sharpener import sharpen
+from senet.core.ecmwf_data_download import get
+from senet.core.ecmwf_data_preparation import prepare
+from senet.core.longwave_irradiance import longwave_irradiance
+from senet.core.net_shortwave_radiation import net_shortwave_radiation
+from senet.core.energy_fluxes import energy_fluxes
+from senet.core.daily_evapotranspiration import daily_evapotranspiration
+from senet.core.fused_pipeline import fused_pipeline
+
+# Maximum number of steps of each resource class running at the same time. "gpt" steps start a SNAP
+# GPT process with its own JVM heap, "cpu" steps run the Python processing and "network" steps download data.
+RESOURCE_LIMITS = {"gpt": 2, "cpu": 2, "network": 2}
+
+# A step of the processing graph. inputs and outputs are product keys, a step depends on the steps
+# producing its inputs. params and code (the functions, modules or files it runs) make up its cache key.
+step = namedtuple("step", ["name", "function", "inputs", "outputs", "resource", "params", "code"],
+                  defaults=(None, None))
+
+# Modules shared by all Python steps
+CORE_UTILS = [snappy_utils, dimap_utils, gdal_utils, packed_pixels]
+
+
+def _dependencies(steps:list):
+    """Maps every step name to the names of the steps producing its inputs."""
+    producers = {}
+    for s in steps:
+        for output in s.outputs:
+            if output in producers:
+                raise ValueError("Product {} is produced by both {} and {}".format(output, producers[output], s.name))
+            producers[output] = s.name
+    dependencies = {s.name: {producers[i] for i in s.inputs if i in producers} for s in steps}
+
+    # Check that the graph has no cycles
+    remaining = {name: set(deps) for name, deps in dependencies.items()}
+    while remaining:
+        ready = [name for name, deps in remaining.items() if not deps]
+        if not ready:
+            raise ValueError("Steps {} have cyclic dependencies".format(sorted(remaining)))
+        for name in ready:
+            del remaining[name]
+        for deps in remaining.values():
+            deps.difference_update(ready)
+    return dependencies
+
+
+def run_graph(steps:list, resource_limits:dict = None):
+    """Runs the steps of a processing graph, running independent steps concurrently.
+
+    A step starts as soon as all the steps producing its inputs have finished and its resource class
+    has a free slot. Steps that are ready at the same time start in the order they are given. If a step
+    fails no new steps are started, the running ones are awaited and the error is raised.
+
+    Args:
+        steps (list): Steps of the graph
+        resource_limits (dict, optional): Maximum number of concurrent steps of each resource class. Defaults to RESOURCE_LIMITS
+
+    Returns:
+        dict: (start, end) time of each step in seconds since the start of the run
+    """
+    limits = dict(RESOURCE_LIMITS)
+    if resource_limits is not None:
+        limits.update(resource_limits)
+    for s in steps:
+        if limits.get(s.resource, 0) < 1:
+            raise ValueError("No slots available for resource {} of step {}".format(s.resource, s.name))
+    dependencies = _dependencies(steps)
+
+    start = time.perf_counter()
+    timings = {}
+    done = set()
+    pending = list(steps)
+    running = {}
+    in_use = {resource: 0 for resource in limits}
+    error = None
+    with ThreadPoolExecutor(max_workers=sum(limits.values())) as executor:
+        while running or (pending and error is None):
+            if error is None:
+                for s in list(pending):
+                    if dependencies[s.name] <= done and in_use[s.resource] < limits[s.resource]:
+                        print("INFO: Starting step {}...".format(s.name))
+                        timings[s.name] = (time.perf_counter() - start, None)
+                        running[executor.submit(s.function)] = s
+                        in_use[s.resource] += 1
+                        pending.remove(s)
+            finished = wait(running, return_when=FIRST_COMPLETED)[0]
+            for future in finished:
+                s = running.pop(future)
+                in_use[s.resource] -= 1
+                timings[s.name] = (timings[s.name][0], time.perf_counter() - start)
+                if future.exception() is not None:
+                    print("INFO: Step {} failed: {}".format(s.name, future.exception()))
+                    error = error or future.exception()
+                else:
+                    print("INFO: Finished step {} in {:.1f} s".format(s.name, timings[s.name][1] - timings[s.name][0]))
+                    done.add(s.name)
+    if error is not None:
+        raise error
+    return timings
+
 
-from sentinels import sentinel2, sentinel3
- 
 class senet():
-    
-    def __init__(self, s2path, s3path):
-        pass
+    """Processing of a Sentinel 2 / Sentinel 3 pair to daily evapotranspiration.
+
+    The 16 processing steps are declared as a graph of products, so that independent branches (e.g. the
+    Sentinel 3 preprocessing and the ERA5 download) run while the Sentinel 2 branch is processed.
+    """
+
+    def __init__(self, s2path:str, s3path:str, aoi:str, gpt_path:str, output_folder:str, resource_limits:dict = None,
+        minfc:float = 0.01, landcover_band:str = "land_cover_CCILandCover-2015", moving_window_size:int = 30,
+        parallel_jobs:int = 3, cache:step_cache = None, fused:bool = False, block_size:int = None,
+        prior_fluxes:str = None, static_dir:str = None, model_dir:str = None):
+        """
+        Args:
+            s2path (str): Path to Sentinel 2 L2A product (.SAFE)
+            s3path (str): Path to Sentinel 3 SLSTR L2 LST product (.SEN3)
+            aoi (str): Area of interest as WKT geometry in WGS 84
+            gpt_path (str): Path to SNAP GPT
+            output_folder (str): Folder to store the Sentinel 2, Sentinel 3 and meteorological products
+            resource_limits (dict, optional): Maximum number of concurrent steps of each resource class. Defaults to RESOURCE_LIMITS
+            minfc (float, optional): Minimum fractional cover of fraction_green. Defaults to 0.01
+            landcover_band (str, optional): Name of landcover band. Defaults to "land_cover_CCILandCover-2015"
+            moving_window_size (int, optional): Moving window size of sharpen. Defaults to 30
+            parallel_jobs (int, optional): Parallel jobs of sharpen. Defaults to 3
+            cache (step_cache, optional): Cache to skip steps whose inputs, parameters and code did not change. Defaults to None
+            fused (bool, optional): Run the steps from leaf spectra to evapotranspiration in memory with fused_pipeline,
+                writing only the evapotranspiration product. Defaults to False
+            block_size (int, optional): Run the steps from leaf spectra to evapotranspiration in blocks of block_size x block_size
+                pixels to bound memory use. Defaults to the whole scene
+            prior_fluxes (str, optional): Energy fluxes product of a previous acquisition of the same tile to warm start
+                the stability iteration of energy_fluxes from. Defaults to None
+            static_dir (str, optional): Folder of the layers that do not change between the acquisitions of a tile
+                (see static_layers): elevation, landcover, slope, aspect, the location terms of the solar incidence angle
+                and the landcover structural parameters. They are computed on the first run of the tile and loaded
+                afterwards instead of running GPT and GDAL again. Defaults to None
+            model_dir (str, optional): Folder of the trained regressors of sharpen (see sharpener_models). The regressor of
+                the closest acquisition of the tile is reused while its residuals do not drift. Defaults to None
+        """
+        self.s2 = sentinel2(*os.path.split(os.path.normpath(s2path)))
+        self.s2.getmetadata()
+        self.s3 = sentinel3(*os.path.split(os.path.normpath(s3path)))
+        self.s3.getmetadata()
+        self.aoi = aoi
+        self.gpt_path = gpt_path
+        self.resource_limits = resource_limits
+        self.minfc = minfc
+        self.landcover_band = landcover_band
+        self.moving_window_size = moving_window_size
+        self.parallel_jobs = parallel_jobs
+        self.cache = cache
+        self.fused = fused
+        self.block_size = block_size
+        self.prior_fluxes = prior_fluxes
+        self.static = None
+        if static_dir is not None:
+            self.static = static_layers.static_layers(static_dir, tile=self.s2.tile_id, aoi=self.aoi,
+                                                      resolution=graphs.S2_RESOLUTION)
+        self.models = None
+        if model_dir is not None:
+            self.models = sharpener_models.sharpener_models(model_dir, tile=self.s2.tile_id, aoi=self.aoi,
+                                                            resolution=graphs.S2_RESOLUTION)
+        self.timings = None
+
+        s2_savepath = os.path.join(output_folder, "Sentinel-2", self.s2.tile_id, self.s2.name)
+        s3_savepath = os.path.join(output_folder, "Sentinel-3", self.s3.name)
+        meteo_datapath = os.path.join(output_folder, "Meteorological_Data")
+        for folder in [s2_savepath, s3_savepath, meteo_datapath]:
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+
+        self.start_date = str(self.s2.date - timedelta(days=1))
+        self.end_date = str(self.s2.date + timedelta(days=1))
+        s2_product = lambda suffix: os.path.join(s2_savepath, "{}_{}_{}.dim".format(self.s2.tile_id, self.s2.str_datetime, suffix))
+        meteo = "meteo_{}_{}".format(self.start_date, self.end_date)
+        self.paths = {
+            "s2_l2a": os.path.join(self.s2.path, self.s2.name),
+            "s3_l2": os.path.join(self.s3.path, self.s3.name),
+            "refl": s2_product("REFL"),
+            "sun_zenith": s2_product("SUN-ZEN-ANG"),
+            "mask": s2_product("MASK"),
+            "bio": s2_product("BIO"),
+            "elev": s2_product("ELEV"),
+            "lc": s2_product("LC"),
+            "leaf_spectra": s2_product("LEAF-REFL-TRAN"),
+            "fv": s2_product("FV"),
+            "str_param": s2_product("STR-PARAM"),
+            "aero_rough": s2_product("AERO-ROUGH"),
+            "net_rad": s2_product("NET-RAD"),
+            "en_flux": s2_product("EN-FLUX"),
+            "evap": s2_product("EVAP"),
+            "s3_obs_geom": os.path.join(s3_savepath, "LST_OBS-GEOM.dim"),
+            "s3_mask": os.path.join(s3_savepath, "LST_MASK.dim"),
+            "s3_lst": os.path.join(s3_savepath, "LST_data.dim"),
+            "s3_obs_geom_reproj": os.path.join(s3_savepath, "LST_OBS-GEOM-REPROJ.dim"),
+            "lst_sharp": os.path.join(s3_savepath, "LST_SHARP.dim"),
+            "ecmwf": os.path.join(meteo_datapath, meteo + ".nc"),
+            "meteo": os.path.join(meteo_datapath, meteo + "_PROC.dim"),
+            "long_irrad": os.path.join(meteo_datapath, "meteo_{}_LONG_IRRAD.dim".format(self.s2.date)),
+        }
+        if prior_fluxes is not None:
+            self.paths["prior_fluxes"] = prior_fluxes
+
+    def steps(self):
+        """Steps of the processing graph, in the order of the sequential pipeline."""
+        graph = lambda name: os.path.join(graphs.auxdata, name)
+        date_time_utc = str(self.s3.datetime.replace(second=0, microsecond=0))
+        # A reused regressor gives a different result than a new one, so the cache tells them apart
+        sharpen_params = {"date_time_utc": date_time_utc, "moving_window_size": self.moving_window_size}
+        if self.models is not None:
+            sharpen_params["models"] = self.models.folder
+        prior = ["prior_fluxes"] if self.prior_fluxes is not None else []
+        steps = [
+            step("S2_preprocessing", self._S2_preprocessing, ["s2_l2a"], ["refl", "sun_zenith", "mask", "bio"], "gpt",
+                 {"aoi": self.aoi}, [graphs, graph("sentinel_2_preprocessing.xml")]),
+            # The static layers are written with the geocoding of the mask product
+            step("S2_elevation", self._S2_elevation, ["refl", "mask"], ["elev"], "gpt",
+                 None, [graphs, graph("add_elevation.xml"), static_layers]),
+            step("S2_landcover", self._S2_landcover, ["mask"], ["lc"], "gpt",
+                 None, [graphs, graph("add_landcover.xml"), static_layers]),
+            step("leaf_refl_trans", self._leaf_refl_trans, ["bio"], ["leaf_spectra"], "cpu",
+                 None, [leaf_spectra] + CORE_UTILS),
+            step("fraction_vg", self._fraction_vg, ["sun_zenith", "bio"], ["fv"], "cpu",
+                 {"minfc": self.minfc}, [fraction_green] + CORE_UTILS),
+            step("struct_params", self._struct_params, ["lc", "bio", "fv"], ["str_param"], "cpu",
+                 {"landcover_band": self.landcover_band}, [str_parameters, static_layers] + CORE_UTILS),
+            step("aerodynamic_roughness", self._aerodynamic_roughness, ["bio", "str_param"], ["aero_rough"], "cpu",
+                 None, [aerodynamic_roughness] + CORE_UTILS),
+            step("S3_preprocessing", self._S3_preprocessing, ["s3_l2"], ["s3_obs_geom", "s3_mask", "s3_lst"], "gpt",
+                 {"aoi": self.aoi}, [graphs, graph("sentinel_3_preprocessing.xml")]),
+            step("warp", self._warp, ["s3_obs_geom", "refl"], ["s3_obs_geom_reproj"], "cpu",
+                 None, [warp] + CORE_UTILS),
+            step("sharpen", self._sharpen, ["refl", "s3_lst", "elev", "s3_obs_geom_reproj", "s3_mask"], ["lst_sharp"], "cpu",
+                 sharpen_params, [sharpen, static_layers, solar_geometry, sharpener_models] + CORE_UTILS),
+            step("download_ERA5", self._download_ERA5, [], ["ecmwf"], "network",
+                 {"aoi": self.aoi, "start_date": self.start_date, "end_date": self.end_date}, [get, ecmwf_utils]),
+            step("prepare_ERA5", self._prepare_ERA5, ["elev", "ecmwf"], ["meteo"], "cpu",
+                 {"aoi": self.aoi, "date_time_utc": str(self.s2.datetime)}, [prepare, ecmwf_utils] + CORE_UTILS),
+            step("longwave_irradiance", self._londwave_irradiance, ["meteo"], ["long_irrad"], "cpu",
+                 None, [longwave_irradiance] + CORE_UTILS),
+            step("net_irradiance", self._net_irradiance, ["leaf_spectra", "bio", "str_param", "meteo", "s3_obs_geom_reproj"],
+                 ["net_rad"], "cpu", None, [net_shortwave_radiation] + CORE_UTILS),
+            step("energy_fluxes", self._energy_fluxes, ["lst_sharp", "s3_obs_geom_reproj", "bio", "str_param", "fv",
+                 "aero_rough", "meteo", "net_rad", "long_irrad", "mask"] + prior, ["en_flux"], "cpu",
+                 None, [energy_fluxes] + CORE_UTILS),
+            step("evapotranspiration", self._evapotranspiration, ["en_flux", "meteo"], ["evap"], "cpu",
+                 None, [daily_evapotranspiration] + CORE_UTILS),
+        ]
+        if not self.fused:
+            return steps
+
+        # Replace the in-memory stages by a single step
+        fused_steps = ["leaf_refl_trans", "fraction_vg", "struct_params", "aerodynamic_roughness",
+                       "longwave_irradiance", "net_irradiance", "energy_fluxes", "evapotranspiration"]
+        code = [fused_pipeline] + [s.code[0] for s in steps if s.name in fused_steps] + CORE_UTILS
+        steps = [s for s in steps if s.name not in fused_steps]
+        steps.append(step("fused_pipeline", self._fused_pipeline, ["sun_zenith", "bio", "lc", "mask", "lst_sharp",
+                          "s3_obs_geom_reproj", "meteo"] + prior, ["evap"], "cpu",
+                          {"minfc": self.minfc, "landcover_band": self.landcover_band}, code))
+        return steps
+
+    def _cached(self, s:step):
+        """Wraps the function of a step so that it is skipped when its outputs are in the cache."""
+        return s._replace(function=partial(self.cache.run, s.name, s.function, [self.paths[i] for i in s.inputs],
+                                           [self.paths[o] for o in s.outputs], s.params, s.code))
 
     def get_evapotranspiration(self):
-        pass
+        """Runs the processing graph.
+
+        Returns:
+            str: Path to the daily evapotranspiration product
+        """
+        start = time.perf_counter()
+        steps = self.steps()
+        if self.cache is not None:
+            steps = [self._cached(s) for s in steps]
+        self.timings = run_graph(steps, self.resource_limits)
+        total = sum(end - begin for begin, end in self.timings.values())
+        print("INFO: Processing took {:.1f} s ({:.1f} s of steps)".format(time.perf_counter() - start, total))
+        return self.paths["evap"]
+
+    def _gpt_output(self, key):
+        # GPT graphs add the .dim extension themselves
+        return os.path.splitext(self.paths[key])[0]
 
     def _S2_preprocessing(self):
-        pass
+        S2_L2A = os.path.join(self.s2.path, self.s2.name, "MTD_MSIL2A.xml")
+        s2_preprocessing(self.gpt_path, S2_L2A, self.aoi, self._gpt_output("refl"), self._gpt_output("sun_zenith"),
+                         self._gpt_output("mask"), self._gpt_output("bio"))
+
+    def _static_product(self, key:str, product_name:str, band_names:list, run):
+        """Writes a product of the S2 grid from the static layers of the tile, or runs the function producing it
+        and stores its bands as static layers."""
+        if self.static is None:
+            run()
+        elif self.static.has(*band_names):
+            print("INFO: Writing {} from the static layers of tile {}".format(product_name, self.s2.tile_id))
+            geo_coding = snappy_utils.get_product_info(self.paths["mask"])[1]
+            bands = [{"band_name": name, "band_data": self.static.load(name)} for name in band_names]
+            snappy_utils.write_snappy_product(self.paths[key], bands, product_name, geo_coding)
+        else:
+            run()
+            bands = snappy_utils.read_snappy_bands(self.paths[key], band_names)[0]
+            self.static.store(dict(zip(band_names, bands)))
 
     def _S2_elevation(self):
-        pass
+        self._static_product("elev", "elevation", ["elevation"],
+                             lambda: elevation(self.gpt_path, self.paths["refl"], self._gpt_output("elev")))
 
     def _S2_landcover(self):
-        pass
+        self._static_product("lc", "landcover", [self.landcover_band],
+                             lambda: landcover(self.gpt_path, self.paths["mask"], self._gpt_output("lc")))
 
     def _leaf_refl_trans(self):
-        pass
+        leaf_spectra(self.paths["bio"], self.paths["leaf_spectra"], self.block_size)
 
     def _fraction_vg(self):
-        pass
+        fraction_green(self.paths["sun_zenith"], self.paths["bio"], self.minfc, self.paths["fv"], self.block_size)
 
     def _struct_params(self):
-        pass
+        str_parameters(self.paths["lc"], self.paths["bio"], self.paths["fv"], self.landcover_band,
+                       True, True, True, True, True, True, self.paths["str_param"], block_size=self.block_size,
+                       static=self.static)
 
     def _aerodynamic_roughness(self):
-        pass
+        aerodynamic_roughness(self.paths["bio"], self.paths["str_param"], self.paths["aero_rough"],
+                              block_size=self.block_size)
 
     def _S3_preprocessing(self):
-        pass
+        S3_L2 = os.path.join(self.s3.path, self.s3.name, self.s3.md_file)
+        s3_preprocessing(self.gpt_path, S3_L2, self.aoi, self.paths["s3_obs_geom"], self.paths["s3_mask"],
+                         self.paths["s3_lst"])
 
     def _warp(self):
-        pass
+        warp(self.paths["s3_obs_geom"], self.paths["refl"], self.paths["s3_obs_geom_reproj"])
 
     def _sharpen(self):
-        pass
+        date_time_utc = self.s3.datetime.replace(second=0, microsecond=0)
+        sharpen(self.paths["refl"], self.paths["s3_lst"], self.paths["elev"], self.paths["s3_obs_geom_reproj"],
+                self.paths["s3_mask"], date_time_utc, self.paths["lst_sharp"],
+                moving_window_size=self.moving_window_size, parallel_jobs=self.parallel_jobs, static=self.static,
+                models=self.models)
+
+    def _download_ERA5(self):
+        from shapely import wkt
+        # N/W/S/E over a slightly larger area to contain all the AOI
+        W, S, E, N = wkt.loads(self.aoi).bounds
+        area = "{}/{}/{}/{}".format(math.ceil(N), math.floor(W), math.floor(S), math.ceil(E))
+        get(area, self.start_date, self.end_date, self.paths["ecmwf"])
 
     def _prepare_ERA5(self):
-        pass
-    
+        from shapely import wkt
+        centroid = wkt.loads(self.aoi).centroid
+        time_zone = get_offset(lat=centroid.y, lng=centroid.x, date_time=self.s2.datetime)
+        prepare(self.paths["elev"], self.paths["ecmwf"], self.s2.datetime, time_zone, self.paths["meteo"])
+
     def _londwave_irradiance(self):
-        pass
+        longwave_irradiance(self.paths["meteo"], self.paths["long_irrad"], block_size=self.block_size)
 
     def _net_irradiance(self):
-        pass
+        net_shortwave_radiation(self.paths["leaf_spectra"], self.paths["bio"], self.paths["str_param"],
+                                self.paths["meteo"], self.paths["s3_obs_geom_reproj"], self.paths["net_rad"],
+                                block_size=self.block_size)
 
     def _energy_fluxes(self):
-        pass
+        energy_fluxes(self.paths["lst_sharp"], self.paths["s3_obs_geom_reproj"], self.paths["bio"],
+                      self.paths["str_param"], self.paths["fv"], self.paths["aero_rough"], self.paths["meteo"],
+                      self.paths["net_rad"], self.paths["long_irrad"], self.paths["mask"], self.paths["en_flux"],
+                      block_size=self.block_size, prior_fluxes=self.prior_fluxes)
 
     def _evapotranspiration(self):
-        pass
\ No newline at end of file
+        daily_evapotranspiration(self.paths["en_flux"], self.paths["meteo"], self.paths["evap"], self.block_size)
+
+    def _fused_pipeline(self):
+        fused_pipeline(self.paths["sun_zenith"], self.paths["bio"], self.paths["lc"], self.paths["mask"],
+                       self.paths["lst_sharp"], self.paths["s3_obs_geom_reproj"], self.paths["meteo"],
+                       {"daily_evapotranspiration": self.paths["evap"]}, landcover_band=self.landcover_band,
+                       min_frac_green=self.minfc, block_size=self.block_size, prior_fluxes_file=self.prior_fluxes)
@@ -1,8 +1,4 @@
-import pandas as pd
-from sentinelsat import read_geojson, geojson_to_wkt
-from creodias_finder import query
 from datetime import datetime
-import requests
 
 CDS_URL = "https://catalogue.dataspace.copernicus.eu/odata/v1/Products?$filter=Collection/Name"
 
@@ -20,6 +16,8 @@ def get_data_DIAS(area: str, start_date: str, end_date: str, platform: str = "Se
     Returns:
         list: List of available products in CreoDIAS based on the query.
     """
+    from creodias_finder import query
+
     data = []
     results = query.query(
         platform,
@@ -46,6 +44,10 @@ def get_data(area: str, start_date: str, end_date: str, platform: str, product_t
     Returns:
         DataFrame: APIHUB response with the available data converted to DataFrame
     """
+    import requests
+    import pandas as pd
+    from sentinelsat import read_geojson, geojson_to_wkt
+
     footprint = geojson_to_wkt(read_geojson(area))
     query_products = (f"{CDS_URL} eq '{platform}' and OData.CSC.Intersects(area=geography'SRID=4326;{footprint}') and"
                       f" ContentDate/Start gt {start_date}T00:00:00.000Z and "
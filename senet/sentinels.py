@@ -2,11 +2,8 @@
 import os
 import logging
 import xml.etree.ElementTree as Etree
-import lxml.etree as lEtree
 import fnmatch
 import datetime
-import pyproj
-import urllib
 
 # Define a lambda function to convert dates
 convert = lambda x: datetime.datetime.strptime(x, '%Y-%m-%dT%H:%M:%S.%fZ')
@@ -88,6 +85,7 @@ class sentinel2():
         Args:
             root (eTree.Element): S2 tile metadata from eTree.Element type object
         """
+        import pyproj
 
         logging.info("  - Parsing Tile Metadata file...")
         epsg = root[1][0][1].text
@@ -194,6 +192,10 @@ class sentinel3():
             path (str, path-like): Path to file
             file (str): Name of the file
         """
+        import urllib.request
+        import lxml.etree as lEtree
+        import pyproj
+
         logging.info("  - Reading {}".format(os.path.join(self.path, self.name, file)))
         tree = lEtree.parse(os.path.join(self.path, self.name, file))
         root = tree.getroot()
@@ -1,6 +1,4 @@
 import datetime
-from timezonefinder import TimezoneFinder
-from pytz import timezone, utc
 
 def get_offset(*, lat:float, lng:float, date_time:datetime.datetime):
     """Location's time zone offset from UTC in hours.
@@ -14,6 +12,9 @@ def get_offset(*, lat:float, lng:float, date_time:datetime.datetime):
     Returns:
         float: Time zone offset
     """
+    from timezonefinder import TimezoneFinder
+    from pytz import timezone, utc
+
     tf = TimezoneFinder()
     tz_target = timezone(tf.certain_timezone_at(lng=lng, lat=lat))
     # ATTENTION: tz_target could be None! handle error case